@@ -24,11 +24,28 @@
 # *
 # **************************************************************************
 
+import os
 import pwem
 
+from .constants import *
+
 __version__ = '1.0.0'
 
 
 class Plugin(pwem.Plugin):
     _pathVars = []
-    _url = "https://github.com/scipion-em/scipion-em-datamanager"
\ No newline at end of file
+    _url = "https://github.com/scipion-em/scipion-em-datamanager"
+
+    @classmethod
+    def _defineVariables(cls):
+        cls._defineVar(DATAMANAGER_CACHE, DATAMANAGER_CACHE_DEFAULT)
+        cls._defineVar(DATAMANAGER_CACHE_SIZE, DATAMANAGER_CACHE_SIZE_DEFAULT)
+
+    @classmethod
+    def getCachePath(cls, *paths):
+        return os.path.join(cls.getVar(DATAMANAGER_CACHE), *paths)
+
+    @classmethod
+    def getCacheSize(cls):
+        """ Maximum size of the thumbnails cache in bytes. """
+        return int(cls.getVar(DATAMANAGER_CACHE_SIZE)) * 1024 * 1024
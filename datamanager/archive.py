@@ -0,0 +1,170 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Zip archive of the deposition thumbnails, written while they are produced.
+"""
+
+import os
+import shutil
+import time
+from zipfile import BadZipFile, ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+# Formats that are already compressed, deflating them only wastes time
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.zip', '.gz')
+
+
+def getCompressType(path):
+    return ZIP_STORED if path.lower().endswith(STORED_EXTENSIONS) else ZIP_DEFLATED
+
+
+class ThumbnailsArchive:
+    """
+    Adds files to a zip archive as soon as they are produced. Names in the
+    archive are relative to rootDir, the thumbnails (staging) folder.
+    If keepFiles is False, files are removed from rootDir once archived.
+    Files copied from other archives are added when closing, after the ones
+    produced, so a file produced again replaces the old copy. The number and (uncompressed) bytes of the files archived are counted.
+    """
+    def __init__(self, zipPath, rootDir, keepFiles=True):
+        self.zipPath = zipPath
+        self.rootDir = rootDir
+        self.keepFiles = keepFiles
+        self._zip = ZipFile(zipPath, 'w', ZIP_DEFLATED)
+        self._names = set()
+        self._sources = {}
+        self._copies = []  # (zipPath, arcname) to copy when closing
+        self.files = 0
+        self.bytes = 0
+
+    def getArcname(self, path):
+        return os.path.relpath(path, self.rootDir)
+
+    def add(self, source, target=None):
+        """ Archive a file or folder. If target (a path inside rootDir) is given,
+        source is archived with its name and copied there when keeping files. """
+        target = target or source
+        if os.path.isdir(source):
+            for base, dirs, files in os.walk(source):
+                for file in sorted(files):
+                    fn = os.path.join(base, file)
+                    self._write(fn, os.path.join(target, os.path.relpath(fn, source)))
+            if not self.keepFiles and source == target:
+                shutil.rmtree(source, ignore_errors=True)
+        else:
+            self._write(source, target)
+
+    def _write(self, source, target):
+        arcname = self.getArcname(target)
+        if arcname in self._names:
+            return
+        self._names.add(arcname)
+        self._zip.write(source, arcname, compress_type=getCompressType(source))
+        self.files += 1
+        self.bytes += os.path.getsize(source)
+        if source != target:
+            if self.keepFiles:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(source, target)
+        elif not self.keepFiles:
+            os.remove(source)
+
+    def addChunks(self, chunks, target):
+        """ Archive the content given in chunks (bytes) as target, a path inside rootDir,
+        also written there when keeping files. """
+        arcname = self.getArcname(target)
+        if arcname in self._names:
+            return
+        self._names.add(arcname)
+        copy = None
+        if self.keepFiles:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            copy = open(target, 'wb')
+        info = ZipInfo(arcname, date_time=time.localtime()[:6])
+        info.compress_type = getCompressType(target)
+        try:
+            with self._zip.open(info, 'w') as dst:
+                for chunk in chunks:
+                    dst.write(chunk)
+                    self.bytes += len(chunk)
+                    if copy is not None:
+                        copy.write(chunk)
+        finally:
+            if copy is not None:
+                copy.close()
+        self.files += 1
+
+    def _openSource(self, zipPath):
+        if zipPath not in self._sources:
+            source = None
+            if os.path.exists(zipPath):
+                try:
+                    source = ZipFile(zipPath)
+                except (BadZipFile, OSError) as e:
+                    print('Ignoring unreadable archive %s: %s' % (zipPath, e))
+            self._sources[zipPath] = source
+        return self._sources[zipPath]
+
+    def _getSourceNames(self, zipPath, arcname):
+        source = self._openSource(zipPath)
+        if source is None:
+            return []
+        return [n for n in source.namelist() if n == arcname or n.startswith(arcname + '/')]
+
+    def hasFromZip(self, zipPath, arcname):
+        """ Check if a file or folder is in another archive. """
+        return len(self._getSourceNames(zipPath, arcname)) > 0
+
+    def addFromZip(self, zipPath, arcname):
+        """ Copy a file or folder from another archive, with the same name, when closing.
+        The files with that name added before closing are kept instead. """
+        self._copies.append((zipPath, arcname))
+
+    def _copyFromZip(self, zipPath, arcname):
+        source = self._openSource(zipPath)
+        for name in self._getSourceNames(zipPath, arcname):
+            if name in self._names:
+                continue
+            self._names.add(name)
+            info = source.getinfo(name)
+            newInfo = ZipInfo(name, date_time=info.date_time)
+            newInfo.compress_type = getCompressType(name)
+            with source.open(info) as src, self._zip.open(newInfo, 'w') as dst:
+                shutil.copyfileobj(src, dst)
+            self.files += 1
+            self.bytes += info.file_size
+            if self.keepFiles:
+                source.extract(info, self.rootDir)
+
+    def close(self):
+        for zipPath, arcname in self._copies:
+            self._copyFromZip(zipPath, arcname)
+        self._copies = []
+        self._zip.close()
+        for source in self._sources.values():
+            if source is not None:
+                source.close()
+        self._sources = {}
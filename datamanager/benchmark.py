@@ -0,0 +1,377 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Benchmark of the CryoEM Workflow Viewer deposition on synthetic projects.
+
+It creates a Scipion project with small local mrc files (micrographs,
+coordinates, particles and volumes, in chains of four protocols) and
+measures, without any network access, these stages:
+
+- generate: creation of the synthetic project
+- outputs: getOutputDict of every output, with its thumbnails and archive
+- deposition: createDepositionStep (exportWorkflow plus the thumbnails archive)
+- incremental: createDepositionStep again, reusing the previous deposition
+
+It also measures, in a fresh interpreter, the time that importing the plugin
+protocols adds to Scipion startup (on top of pwem and pyworkflow) and checks
+it against IMPORT_TIME_BUDGET and that no heavy module is loaded by then.
+
+For every stage it reports wall and cpu time, peak RSS (of this process and
+of the rendering workers), files written and archive size, and optionally the
+peak of python allocations (traced, which slows down the stages). Run it in the Scipion environment:
+
+    scipion3 python -m datamanager.benchmark --protocols 40 --json bench.json
+    scipion3 python -m datamanager.benchmark --import-only  # exits with 1 if over budget
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pyworkflow.utils as pwutils
+from pyworkflow.project import Manager
+from pyworkflow.protocol import STATUS_FINISHED
+from pwem.objects import Micrograph, Coordinate, Particle, Volume
+from pwem.protocols import ProtImportMicrographs, ProtImportCoordinates, ProtImportParticles, ProtImportVolumes
+
+from datamanager.protocols import CryoEMWorkflowViewerDepositor
+
+SAMPLING_RATE = 1.0
+KINDS = ['micrographs', 'coordinates', 'particles', 'volume']
+
+IMPORT_TIME_BUDGET = 0.1  # seconds added by importing datamanager.protocols
+# Modules only needed when the protocols run, importing the protocols must not load them
+HEAVY_MODULES = ['requests', 'PIL', 'zipfile', 'pwem.emlib', 'datamanager.thumbnails',
+                 'datamanager.transfer', 'datamanager.onedata', 'datamanager.archive']
+IMPORT_SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+import pwem.protocols, pwem.objects, pyworkflow.protocol, pyworkflow.project
+baseline = time.perf_counter()
+loaded = set(sys.modules)
+import datamanager.protocols
+end = time.perf_counter()
+print(json.dumps({'baseline': baseline - start, 'plugin': end - baseline,
+                  'heavy': [m for m in %r if m in sys.modules and m not in loaded]}))
+'''
+
+
+def writeMrc(fileName, data):
+    """ Write a float32 image, stack or volume (z, y, x) as mrc. """
+    data = np.asarray(data, dtype=np.float32)
+    if data.ndim == 2:
+        data = data[None]
+    nz, ny, nx = data.shape
+    header = np.zeros(256, dtype=np.int32)
+    header[:4] = nx, ny, nz, 2
+    header[7:10] = nx, ny, nz  # mx, my, mz
+    header[16:19] = 1, 2, 3  # mapc, mapr, maps
+    header = header.view(np.float32)
+    header[10:13] = np.array([nx, ny, nz]) * SAMPLING_RATE  # cell dimensions
+    header[19:22] = data.min(), data.max(), data.mean()
+    header = header.view(np.int32)
+    header[52] = np.frombuffer(b'MAP ', dtype=np.int32)[0]
+    header[53] = 0x4444  # little endian stamp
+    with open(fileName, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(data.tobytes())
+
+
+def writeLog(prot, size):
+    """ Write a stdout log with a plugin version header and filler lines up to size bytes. """
+    pwutils.makePath(prot._getLogsPath())
+    line = b'00001: Iteration running, computing something rather long to log\n'
+    with open(prot.getStdoutLog(), 'wb') as f:
+        f.write(b'00000: Scipion: v3.0.0\n00000: %s plugin v: 3.0.0\n' % prot.getClassPackageName().encode())
+        f.write(line * max(0, size // len(line)))
+
+
+class SyntheticProject:
+    """ A Scipion project filled with finished protocols and synthetic outputs. """
+    def __init__(self, workDir, args):
+        self.args = args
+        self.rng = np.random.default_rng(0)
+        # linked from the user projects folder, named after workDir so that runs do not collide
+        name = os.path.basename(os.path.abspath(workDir))
+        manager = Manager()
+        pwutils.makePath(manager.PROJECTS)
+        self.link = manager.getProjectPath(name)
+        if os.path.islink(self.link):
+            os.remove(self.link)
+        self.project = manager.createProject(name, location=workDir)
+        # protocol paths are relative to the project folder, where Scipion runs them
+        os.chdir(self.project.getPath())
+        self.micrographs = None
+        self.micrographsProt = None
+        self.workersMaxRss = 0.
+
+    def removeLink(self):
+        """ Remove the project from the user projects folder. """
+        if os.path.islink(self.link):
+            os.remove(self.link)
+
+    def _newProtocol(self, protClass, label):
+        prot = self.project.newProtocol(protClass, objLabel=label)
+        self.project.saveProtocol(prot)
+        pwutils.makePath(prot._getExtraPath(), prot._getTmpPath())
+        writeLog(prot, int(self.args.log_size * 1024 * 1024))
+        return prot
+
+    def _finish(self, prot, **outputs):
+        prot._defineOutputs(**outputs)
+        prot.setStatus(STATUS_FINISHED)
+        self.project._storeProtocol(prot)
+
+    def addMicrographs(self, label):
+        prot = self._newProtocol(ProtImportMicrographs, label)
+        micSet = prot._createSetOfMicrographs()
+        micSet.setSamplingRate(SAMPLING_RATE)
+        size = self.args.mic_size
+        for i in range(self.args.micrographs):
+            fileName = prot._getExtraPath('mic_%04d.mrc' % (i + 1))
+            writeMrc(fileName, self.rng.standard_normal((size, size), dtype=np.float32))
+            mic = Micrograph(location=fileName)
+            mic.setMicName(os.path.basename(fileName))
+            micSet.append(mic)
+        self._finish(prot, outputMicrographs=micSet)
+        self.micrographs = micSet
+        self.micrographsProt = prot
+
+    def addCoordinates(self, label):
+        prot = self._newProtocol(ProtImportCoordinates, label)
+        prot.inputMicrographs.set(self.micrographsProt)
+        prot.inputMicrographs.setExtended('outputMicrographs')
+        coordSet = prot._createSetOfCoordinates(self.micrographs)
+        coordSet.setBoxSize(self.args.box)
+        size = self.args.mic_size
+        for mic in self.micrographs:
+            for x, y in self.rng.integers(0, size, (self.args.coordinates, 2)):
+                coord = Coordinate()
+                coord.setPosition(int(x), int(y))
+                coord.setMicrograph(mic)
+                coordSet.append(coord)
+        self._finish(prot, outputCoordinates=coordSet)
+
+    def addParticles(self, label):
+        prot = self._newProtocol(ProtImportParticles, label)
+        partSet = prot._createSetOfParticles()
+        partSet.setSamplingRate(SAMPLING_RATE)
+        box, n = self.args.box, self.args.particles
+        stackName = prot._getExtraPath('particles.mrcs')
+        writeMrc(stackName, self.rng.standard_normal((n, box, box), dtype=np.float32))
+        for i in range(n):
+            particle = Particle(location=(i + 1, stackName))
+            particle.setClassId(i % 4 + 1)
+            partSet.append(particle)
+        self._finish(prot, outputParticles=partSet)
+
+    def addVolume(self, label):
+        prot = self._newProtocol(ProtImportVolumes, label)
+        size = self.args.volume_size
+        fileName = prot._getExtraPath('volume.mrc')
+        writeMrc(fileName, self.rng.standard_normal((size, size, size), dtype=np.float32))
+        volume = Volume(location=fileName)
+        volume.setSamplingRate(SAMPLING_RATE)
+        self._finish(prot, outputVolume=volume)
+
+    def generate(self):
+        for i in range(self.args.protocols):
+            kind = KINDS[i % len(KINDS)]
+            getattr(self, 'add' + kind[0].upper() + kind[1:])('%s %d' % (kind, i + 1))
+
+    def newDepositor(self):
+        dep = self.project.newProtocol(CryoEMWorkflowViewerDepositor, apitoken='benchmark', entrytitle='benchmark',
+                                       numberOfThreads=self.args.threads, useCache=self.args.cache)
+        self.project.saveProtocol(dep)
+        pwutils.makePath(dep._getExtraPath(), dep._getTmpPath())
+        stopRendering = dep.stopRendering
+
+        def stopAndMeasure():
+            # read the peak of the workers before they exit
+            self.workersMaxRss = max(self.workersMaxRss, getWorkersMaxRss(dep._renderer))
+            stopRendering()
+        dep.stopRendering = stopAndMeasure
+        return dep
+
+    def iterOutputs(self):
+        for prot in self.project.getRuns():
+            if not isinstance(prot, CryoEMWorkflowViewerDepositor):
+                for _, output in prot.iterOutputAttributes():
+                    yield output
+
+
+def getFilesInfo(path):
+    """ Number and size of the files in a folder. """
+    count, size = 0, 0
+    for base, dirs, files in os.walk(path):
+        for fn in files:
+            count += 1
+            size += os.path.getsize(os.path.join(base, fn))
+    return count, size
+
+
+def getMaxRss(who):
+    return resource.getrusage(who).ru_maxrss / 1024.  # kB in linux
+
+
+def getWorkersMaxRss(renderer):
+    """ Peak RSS (MB) of the running rendering workers. They are children of the
+    fork server, not of this process, so it is read from /proc (only in linux). """
+    maxRss = 0.
+    executor = renderer._executor
+    for pid in (executor._processes or {}) if executor is not None else {}:
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        maxRss = max(maxRss, int(line.split()[1]) / 1024.)
+        except OSError:
+            pass
+    return maxRss
+
+
+@contextmanager
+def measure(name, results, outputDir=None, archivePath=None, traceMemory=False, project=None):
+    """ Measure a stage and append its results. Peak RSS values are those of the whole
+    process (and of the rendering workers of the project) at the end of the stage,
+    they never decrease. """
+    if traceMemory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    yield
+    result = {'stage': name, 'wallTime': time.perf_counter() - wall, 'cpuTime': time.process_time() - cpu,
+              'maxRssMB': getMaxRss(resource.RUSAGE_SELF)}
+    if project is not None:
+        result['maxRssWorkersMB'] = project.workersMaxRss
+    if traceMemory:
+        result['peakTracedMB'] = tracemalloc.get_traced_memory()[1] / 1024. ** 2
+        tracemalloc.stop()
+    if outputDir is not None:
+        result['filesWritten'], result['bytesWritten'] = getFilesInfo(outputDir)
+    if archivePath is not None and os.path.exists(archivePath):
+        result['archiveSize'] = os.path.getsize(archivePath)
+    results.append(result)
+
+
+def printResults(results):
+    columns = ['stage', 'wallTime', 'cpuTime', 'maxRssMB', 'maxRssWorkersMB', 'peakTracedMB',
+               'filesWritten', 'bytesWritten', 'archiveSize']
+    print(' '.join('%15s' % c for c in columns))
+    for result in results:
+        values = [result.get(c, '') for c in columns]
+        print(' '.join(('%15.2f' if isinstance(v, float) else '%15s') % v for v in values))
+
+
+def measureImport(repeat=3):
+    """ Time added by importing the plugin protocols (best of repeat fresh interpreters)
+    and the heavy modules it loads that pwem and pyworkflow had not loaded. """
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % HEAVY_MODULES])
+        results.append(json.loads(output.decode().strip().splitlines()[-1]))
+    best = min(results, key=lambda r: r['plugin'])
+    return {'stage': 'import', 'wallTime': best['plugin'], 'baselineTime': best['baseline'],
+            'heavyModules': best['heavy'], 'withinBudget': best['plugin'] <= IMPORT_TIME_BUDGET and not best['heavy']}
+
+
+def run(args):
+    workDir = args.workdir or tempfile.mkdtemp(prefix='datamanager_benchmark_')
+    results = [measureImport()]
+    cwd = os.getcwd()
+    project = None
+    try:
+        with measure('generate', results, traceMemory=args.trace_memory):
+            project = SyntheticProject(workDir, args)
+            project.generate()
+
+        dep = project.newDepositor()
+        with measure('outputs', results, dep._getExtraPath(), dep._getArchivePath(), args.trace_memory, project):
+            dep.startRendering()
+            try:
+                for output in project.iterOutputs():
+                    dep.getOutputDict(output)
+                dep._renderer.wait()
+            finally:
+                dep.stopRendering()
+
+        for stage in ['deposition', 'incremental']:
+            dep = project.newDepositor()
+            with measure(stage, results, dep._getExtraPath(), dep._getArchivePath(), args.trace_memory, project):
+                dep.createDepositionStep()
+    finally:
+        os.chdir(cwd)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workDir, ignore_errors=True)
+            if project is not None:
+                project.removeLink()
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the CryoEM Workflow Viewer deposition on a synthetic project.')
+    parser.add_argument('--protocols', type=int, default=8, help='number of protocols (micrographs, coordinates, particles and volumes in turn)')
+    parser.add_argument('--micrographs', type=int, default=5, help='micrographs per set')
+    parser.add_argument('--mic-size', type=int, default=1024, help='micrograph size (px)')
+    parser.add_argument('--coordinates', type=int, default=500, help='coordinates per micrograph')
+    parser.add_argument('--particles', type=int, default=100, help='particles per set')
+    parser.add_argument('--box', type=int, default=64, help='particle box size (px)')
+    parser.add_argument('--volume-size', type=int, default=128, help='volume size (px)')
+    parser.add_argument('--log-size', type=float, default=1, help='size of every protocol log (MB)')
+    parser.add_argument('--threads', type=int, default=4, help='deposition threads')
+    parser.add_argument('--cache', action='store_true', help='use the thumbnails cache')
+    parser.add_argument('--trace-memory', action='store_true', help='also measure the peak of python allocations')
+    parser.add_argument('--workdir', help='folder for the synthetic project, kept after the benchmark')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary synthetic project')
+    parser.add_argument('--json', help='also write the results to this json file, with the parameters used')
+    parser.add_argument('--import-only', action='store_true',
+                        help='only measure the import time, exits with 1 if it is over budget or loads heavy modules')
+    args = parser.parse_args(argv)
+
+    results = [measureImport()] if args.import_only else run(args)
+    printResults(results)
+    importResult = results[0]
+    print('Import of datamanager.protocols: %0.3f s (budget %0.3f s)%s'
+          % (importResult['wallTime'], IMPORT_TIME_BUDGET,
+             ', heavy modules loaded: %s' % ', '.join(importResult['heavyModules']) if importResult['heavyModules'] else ''))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'parameters': vars(args), 'results': results}, f, indent=4)
+    return 0 if importResult['withinBudget'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Content addressed cache of the thumbnails rendered for depositions.
+
+Entries are keyed on the source files (path, size and modification time)
+plus the rendering parameters, and evicted in least recently used order
+once the cache grows beyond its size limit.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+
+# Increase it whenever the rendering changes, so old thumbnails are not reused
+CACHE_VERSION = 4
+
+ENTRY_DATA = 'data'
+
+
+def getFileName(location):
+    """ Get the file name from an image location: (index, fileName), fileName or fileName:format. """
+    if isinstance(location, (tuple, list)):
+        location = location[1]
+    location = str(location)
+    if ':' in location and not os.path.exists(location):
+        location = location.rsplit(':', 1)[0]
+    return location
+
+
+def getSize(path):
+    """ Size in bytes of a file or of all the files under a folder. """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(base, f))
+                   for base, dirs, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+def encodeValue(value):
+    """ Encode values not supported by json in the cache keys. """
+    if hasattr(value, 'tobytes'):  # numpy arrays, e.g. coordinates
+        return [str(value.dtype), list(value.shape), hashlib.sha1(value.tobytes()).hexdigest()]
+    return str(value)
+
+
+def getRenderKey(source, params):
+    """ Identify a render by the real path of its source file (so links to the same
+    file match), the image index, if any, and the render parameters. """
+    index = source[0] if isinstance(source, (tuple, list)) else None
+    content = json.dumps([os.path.realpath(getFileName(source)), index, params], sort_keys=True, default=encodeValue)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+class ThumbnailCache:
+    """ Persistent thumbnails cache stored in a folder, one subfolder per entry. """
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+
+    def getKey(self, sources, params):
+        """ Key of the thumbnail rendered from the source files with the given parameters.
+        Returns None if some source file can not be found. """
+        fingerprint = [CACHE_VERSION]
+        for source in sources:
+            fileName = os.path.abspath(getFileName(source))
+            try:
+                st = os.stat(fileName)
+            except OSError:
+                return None
+            fingerprint.append([source, fileName, st.st_size, st.st_mtime_ns])
+        fingerprint.append(params)
+        content = json.dumps(fingerprint, sort_keys=True, default=encodeValue)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def _getEntryPath(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def restore(self, key, target):
+        """ Copy the cached thumbnail (file or folder) to target. Returns False if it is not cached. """
+        entry = self._getEntryPath(key)
+        data = os.path.join(entry, ENTRY_DATA)
+        if not os.path.exists(data):
+            return False
+        try:
+            if os.path.isdir(data):
+                shutil.copytree(data, target, dirs_exist_ok=True)
+            else:
+                shutil.copyfile(data, target)
+            os.utime(entry)  # mark it as recently used
+        except OSError:
+            return False
+        return True
+
+    def store(self, key, target):
+        """ Add the rendered thumbnail (file or folder) to the cache. """
+        entry = self._getEntryPath(key)
+        if os.path.exists(entry):
+            return
+        tmpEntry = '%s.tmp%d' % (entry, os.getpid())
+        try:
+            os.makedirs(tmpEntry, exist_ok=True)
+            data = os.path.join(tmpEntry, ENTRY_DATA)
+            if os.path.isdir(target):
+                shutil.copytree(target, data)
+            else:
+                shutil.copyfile(target, data)
+            os.rename(tmpEntry, entry)
+        except OSError:
+            # another process stored it first or the cache is not writable
+            shutil.rmtree(tmpEntry, ignore_errors=True)
+
+    def prune(self):
+        """ Remove the least recently used entries until the cache fits in maxSize. """
+        if not os.path.isdir(self.path):
+            return
+        entries = []
+        for prefix in os.listdir(self.path):
+            prefixPath = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefixPath):
+                continue
+            for key in os.listdir(prefixPath):
+                entry = os.path.join(prefixPath, key)
+                try:
+                    entries.append((os.path.getmtime(entry), getSize(entry), entry))
+                except OSError:
+                    pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.maxSize:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
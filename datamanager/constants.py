@@ -0,0 +1,39 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+# Folder where thumbnails are cached between depositions
+DATAMANAGER_CACHE = 'DATAMANAGER_CACHE'
+DATAMANAGER_CACHE_DEFAULT = os.path.join(os.path.expanduser('~'), '.cache', 'scipion-datamanager')
+
+# Maximum size (in MB) of the thumbnails cache
+DATAMANAGER_CACHE_SIZE = 'DATAMANAGER_CACHE_SIZE'
+DATAMANAGER_CACHE_SIZE_DEFAULT = 2048
+
+# Low pass filter of the micrograph thumbnails
+LOW_PASS_CUTOFF = 0.05  # digital frequency (1/px), 0.5 is Nyquist
+LOW_PASS_WIDTH = 0.02  # width of the raised cosine, as in xmipp_transform_filter
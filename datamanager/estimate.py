@@ -0,0 +1,158 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Estimation of the size and cost of a deposition from the project metadata only.
+
+Outputs are described by OutputInfo (what would be rendered and how many
+times) and the estimate is computed for given render settings, so cheaper
+settings can be tried without walking the project again. The model constants
+are rough averages, the estimate is meant to tell the order of magnitude.
+"""
+
+# Kinds of representation
+KIND_IMAGE = 'image'  # converted and scaled down
+KIND_FILTERED = 'filtered'  # low pass filtered and scaled down (micrographs, particles)
+KIND_COORDINATES = 'coordinates'  # filtered micrograph with coordinates
+KIND_VOLUME = 'volume'  # slices of a volume
+KIND_NONE = 'none'  # no representation
+
+MAX_ITEMS = 'maxItems'  # items limit given by the maxItems setting
+DEFAULT_DIMS = (512, 512, 1)  # when the dimensions are unknown
+
+JPEG_BYTES_PER_PIXEL = 0.6
+LOG_COMPRESSION = 0.25  # deflated size of the logs
+ITEM_JSON_BYTES = 500  # json of an item (attributes and representation)
+PROTOCOL_JSON_BYTES = 4000  # json of a protocol (parameters and summary)
+UPLOAD_SPEED = 10 * 1024 * 1024  # bytes/s when there are no previous uploads
+
+# Render seconds per million source pixels (or voxels)
+RENDER_SECONDS = {KIND_IMAGE: 0.02, KIND_FILTERED: 0.03, KIND_COORDINATES: 0.04, KIND_VOLUME: 0.01}
+ALL_SLICES_SECONDS = 0.005  # per slice written by writeSlices
+
+
+class OutputInfo:
+    """ An output to export: its number of items, the limit of items represented
+    (None for all, MAX_ITEMS for the maxItems setting), and the kind and source
+    dimensions (x, y, z) of the representation of its items. """
+    def __init__(self, kind, size, limit=None, dims=None):
+        self.kind = kind
+        self.size = size
+        self.limit = limit
+        self.dims = tuple(dims or DEFAULT_DIMS)
+
+    def getItems(self, maxItems):
+        limit = maxItems if self.limit == MAX_ITEMS else self.limit
+        return self.size if limit is None else min(self.size, limit)
+
+
+class Estimate:
+    """ Predicted thumbnails, render time and sizes of a deposition. """
+    def __init__(self):
+        self.thumbnails = 0  # files
+        self.items = 0
+        self.renderSeconds = 0.
+        self.thumbnailBytes = 0.
+        self.logBytes = 0.
+        self.workflowBytes = 0.
+        self.uploadSeconds = 0.
+
+    def getArchiveBytes(self):
+        return self.thumbnailBytes + self.logBytes
+
+    def getUploadBytes(self):
+        return self.getArchiveBytes() + self.workflowBytes
+
+    def toDict(self):
+        return {'thumbnails': self.thumbnails, 'items': self.items, 'renderSeconds': self.renderSeconds,
+                'archiveBytes': self.getArchiveBytes(), 'uploadBytes': self.getUploadBytes(),
+                'uploadSeconds': self.uploadSeconds}
+
+
+def getThumbnailShape(dims, maxSize):
+    """ Size of the thumbnail of an image scaled down to maxSize. """
+    x, y = dims[0], dims[1]
+    scale = min(1., maxSize / max(x, y)) if maxSize else 1.
+    return x * scale, y * scale
+
+
+def _addVolume(estimate, dims, count, settings):
+    x, y, z = dims
+    voxels = float(x) * y * z
+    if settings['volumeMode'] == 'all':
+        # every slice along every axis, not scaled down
+        estimate.thumbnails += count * (x + y + z)
+        estimate.thumbnailBytes += count * 3 * voxels * JPEG_BYTES_PER_PIXEL
+        estimate.renderSeconds += count * (x + y + z) * ALL_SLICES_SECONDS
+        return
+
+    slices = settings['numberOfSlices']
+    files, pixels = 0, 0.
+    for w, h, n in ((y, z, x), (x, z, y), (x, y, z)):  # slices along x, y and z
+        sw, sh = getThumbnailShape((w, h), settings['thumbnailSize'])
+        n = min(slices, n) if slices else n
+        files += 1 if settings['volumeMode'] == 'montage' else n
+        pixels += sw * sh * n
+        if settings['projections']:
+            files += 2
+            pixels += 2 * sw * sh
+    estimate.thumbnails += count * files
+    estimate.thumbnailBytes += count * pixels * JPEG_BYTES_PER_PIXEL
+    estimate.renderSeconds += count * voxels / 1e6 * RENDER_SECONDS[KIND_VOLUME]
+
+
+def estimateDeposition(outputs, logSizes, protocols, settings, threads=1, uploadSpeed=UPLOAD_SPEED):
+    """ Estimate a deposition of the given OutputInfo's and logs (sizes in bytes) of a
+    number of protocols. settings: thumbnailSize, maxItems, volumeMode ('all', 'slices'
+    or 'montage'), numberOfSlices, projections and logMaxSize (bytes, 0 for whole logs). """
+    estimate = Estimate()
+    for output in outputs:
+        items = output.getItems(settings['maxItems'])
+        estimate.items += items
+        if output.kind == KIND_NONE or not items:
+            continue
+        if output.kind == KIND_VOLUME:
+            _addVolume(estimate, output.dims, items, settings)
+            continue
+        w, h = getThumbnailShape(output.dims, settings['thumbnailSize'])
+        estimate.thumbnails += items
+        estimate.thumbnailBytes += items * w * h * JPEG_BYTES_PER_PIXEL
+        estimate.renderSeconds += items * output.dims[0] * output.dims[1] / 1e6 * RENDER_SECONDS[output.kind]
+
+    logMaxSize = settings['logMaxSize']
+    estimate.logBytes = sum(min(size, logMaxSize) if logMaxSize else size for size in logSizes) * LOG_COMPRESSION
+    estimate.workflowBytes = protocols * PROTOCOL_JSON_BYTES + estimate.items * ITEM_JSON_BYTES
+    estimate.renderSeconds /= max(1, threads)
+    estimate.uploadSeconds = estimate.getUploadBytes() / uploadSpeed
+    return estimate
+
+
+def getUploadSpeed(uploads):
+    """ Average speed (bytes/s) of previous uploads, given as dicts with bytes and seconds. """
+    uploads = [u for u in uploads if u['seconds'] > 0]
+    if not uploads:
+        return UPLOAD_SPEED
+    return float(sum(u['bytes'] for u in uploads)) / sum(u['seconds'] for u in uploads)
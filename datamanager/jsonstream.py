@@ -0,0 +1,110 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Incremental json writers, so that big documents are never held in memory.
+"""
+
+import gzip
+import json
+
+INDENT = 4
+
+
+def openText(path, mode='r'):
+    """ Open a text file, gzipped if its name ends with .gz """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode)
+
+
+class JsonListWriter:
+    """
+    Writes a json list item by item. The indented output is the same as
+    json.dumps(items, indent=4, separators=(',', ': ')), compact drops
+    all whitespace. Files ending with .gz are gzipped while written.
+    """
+    def __init__(self, path, compact=False):
+        self.path = path
+        self.compact = compact
+        self._file = openText(path, 'w')
+        self._count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def write(self, item):
+        if self.compact:
+            text = json.dumps(item, separators=(',', ':'))
+            self._file.write((',' if self._count else '[') + text)
+        else:
+            text = json.dumps(item, indent=INDENT, separators=(',', ': '))
+            text = text.replace('\n', '\n' + ' ' * INDENT)
+            self._file.write((',\n' if self._count else '[\n') + ' ' * INDENT + text)
+        self._count += 1
+
+    def close(self):
+        if self._file is None:
+            return
+        if not self._count:
+            self._file.write('[')
+        self._file.write(']' if self.compact or not self._count else '\n]')
+        self._file.close()
+        self._file = None
+
+
+class JsonLinesWriter:
+    """ Writes one compact json document per line. """
+    def __init__(self, path):
+        self.path = path
+        self._file = openText(path, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, item):
+        self._file.write(json.dumps(item, separators=(',', ':')) + '\n')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def iterJsonLines(path):
+    with openText(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
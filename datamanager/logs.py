@@ -0,0 +1,96 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Protocol logs utils: plugin version lookup and truncation of big logs.
+"""
+
+import mmap
+import os
+
+TAIL_SIZE = 256 * 1024  # the plugin version is printed again when a run is continued
+VERSION_PATTERN = b'plugin v'
+
+
+def parseVersion(line):
+    fields = line.decode(errors='replace').split(':')
+    return fields[1].replace(' ', '').replace('\n', '') if len(fields) > 1 else None
+
+
+def _findLine(data, end):
+    """ Get the line containing the position end (last match), within data. """
+    start = data.rfind(b'\n', 0, end) + 1
+    stop = data.find(b'\n', end)
+    return data[start:stop + 1 if stop >= 0 else len(data)]
+
+
+def _findVersion(data):
+    """ Version in the last line of data containing the pattern, None if there is none. """
+    match = data.rfind(VERSION_PATTERN)
+    return parseVersion(_findLine(data, match)) if match >= 0 else None
+
+
+def getPluginVersion(logPath, tailSize=TAIL_SIZE):
+    """ Find the plugin version (the last line containing 'plugin v') of a log.
+    Big logs are searched in their tail first, where a continued run prints it
+    again, and, if it is not there, memory mapped from the end. """
+    size = os.path.getsize(logPath)
+    with open(logPath, 'rb') as f:
+        if size <= tailSize:
+            return _findVersion(f.read())
+
+        f.seek(size - tailSize)
+        tail = f.read(tailSize)
+        version = _findVersion(tail[tail.find(b'\n') + 1:])  # only whole lines
+        if version is not None:
+            return version
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _findVersion(data)
+        finally:
+            data.close()
+
+
+def iterTruncated(path, headSize, tailSize, chunkSize=1024 * 1024):
+    """ Yield the content of a file in chunks. If it is bigger than headSize + tailSize,
+    only its head and tail are yielded, with a note of the size skipped between them. """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if size <= headSize + tailSize:
+            ranges = [(0, size)]
+        else:
+            ranges = [(0, headSize), (size - tailSize, size)]
+        for i, (start, end) in enumerate(ranges):
+            if i:
+                yield b'\n\n[... %d bytes of the log skipped ...]\n\n' % (start - ranges[i - 1][1])
+            f.seek(start)
+            while start < end:
+                chunk = f.read(min(chunkSize, end - start))
+                if not chunk:
+                    break
+                start += len(chunk)
+                yield chunk
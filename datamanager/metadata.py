@@ -0,0 +1,117 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Read-only access to the sqlite databases of Scipion sets, to get sampled
+item ids and statistics with single SQL queries instead of loading items.
+"""
+
+import sqlite3
+
+OBJECTS_TABLE = 'Objects'
+CLASSES_TABLE = 'Classes'
+NUMERIC_CLASSES = ('Integer', 'Float')
+
+
+def connect(fileName):
+    """ Open a set database in read-only mode. """
+    return sqlite3.connect('file:%s?mode=ro' % fileName, uri=True)
+
+
+def getColumns(conn, prefix=''):
+    """ Map the attributes of the items to their columns: {attribute: (column, class name)}. """
+    rows = conn.execute('SELECT label_property, column_name, class_name FROM %s%s'
+                        % (prefix, CLASSES_TABLE)).fetchall()
+    return {label: (column, className) for label, column, className in rows}
+
+
+def getStatistics(fileName):
+    """ Number of items and min, max and mean of every numeric attribute, in one pass. """
+    conn = connect(fileName)
+    try:
+        numeric = [(label, column) for label, (column, className) in getColumns(conn).items()
+                   if className in NUMERIC_CLASSES]
+        aggregates = ''.join(', MIN(%s), MAX(%s), AVG(%s)' % (c, c, c) for _, c in numeric)
+        row = conn.execute('SELECT COUNT(*)%s FROM %s' % (aggregates, OBJECTS_TABLE)).fetchone()
+    finally:
+        conn.close()
+
+    stats = {'count': row[0], 'attributes': {}}
+    for i, (label, _) in enumerate(numeric):
+        minV, maxV, meanV = row[1 + 3 * i: 4 + 3 * i]
+        if minV is not None:
+            stats['attributes'][label] = {'min': minV, 'max': maxV, 'mean': round(meanV, 6)}
+    return stats
+
+
+def _randomOrder(column='id'):
+    # multiplicative hash: a random looking but repeatable order, so depositions are reproducible
+    return '(%s * 2654435761) %% 4294967296' % column
+
+
+def getRandomIds(fileName, limit):
+    """ Ids of limit items spread randomly over the set. """
+    conn = connect(fileName)
+    try:
+        rows = conn.execute('SELECT id FROM %s ORDER BY %s LIMIT %d'
+                            % (OBJECTS_TABLE, _randomOrder(), limit)).fetchall()
+    finally:
+        conn.close()
+    return sorted(r[0] for r in rows)
+
+
+def getStratifiedIds(fileName, attribute, limit):
+    """ Ids of about limit items, taking the same number from each value of attribute
+    (e.g. _classId). Returns None if the items do not have that attribute. """
+    conn = connect(fileName)
+    try:
+        columns = getColumns(conn)
+        if attribute not in columns:
+            return None
+        column = columns[attribute][0]
+        groups = conn.execute('SELECT COUNT(DISTINCT %s) FROM %s' % (column, OBJECTS_TABLE)).fetchone()[0]
+        perGroup = max(1, -(-limit // max(groups, 1)))
+        rows = conn.execute('SELECT id FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY %s ORDER BY %s) AS n FROM %s) '
+                            'WHERE n <= %d ORDER BY n, id LIMIT %d'
+                            % (column, _randomOrder(), OBJECTS_TABLE, perGroup, limit)).fetchall()
+    finally:
+        conn.close()
+    return sorted(r[0] for r in rows)
+
+
+def getCoordinates(fileName, micId):
+    """ Positions (_x, _y) of the coordinates of a micrograph as an (n, 2) float32 array,
+    read from their columns without building the coordinate objects. """
+    import numpy as np
+    conn = connect(fileName)
+    try:
+        columns = getColumns(conn)
+        rows = conn.execute('SELECT %s, %s FROM %s WHERE %s = ? ORDER BY id'
+                            % (columns['_x'][0], columns['_y'][0], OBJECTS_TABLE, columns['_micId'][0]),
+                            (micId,)).fetchall()
+    finally:
+        conn.close()
+    return np.array(rows, dtype=np.float32).reshape(-1, 2)
@@ -0,0 +1,116 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Metrics of the protocols (times, sizes, throughput), saved as json in their extra folder.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_FILE = 'metrics.json'
+
+
+class Metrics:
+    """
+    Thread safe collection of counters, aggregated timings (count, total and
+    maximum seconds per key of a group) and records (lists of dicts).
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.records = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.counters = data.get('counters', {})
+            self.timings = data.get('timings', {})
+            self.records = data.get('records', {})
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name, default=0):
+        return self.counters.get(name, default)
+
+    def addTime(self, group, key, seconds):
+        with self._lock:
+            timing = self.timings.setdefault(group, {}).setdefault(key, {'count': 0, 'total': 0., 'max': 0.})
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+
+    @contextmanager
+    def timer(self, group, key):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addTime(group, key, time.time() - start)
+
+    def record(self, group, **values):
+        with self._lock:
+            self.records.setdefault(group, []).append(values)
+
+    def getRecords(self, group):
+        return self.records.get(group, [])
+
+    def getTime(self, group, key):
+        """ Total seconds of a key of a group. """
+        return self.timings.get(group, {}).get(key, {}).get('total', 0.)
+
+    def toDict(self):
+        with self._lock:
+            return {'counters': dict(self.counters), 'timings': {g: dict(t) for g, t in self.timings.items()},
+                    'records': {g: list(r) for g, r in self.records.items()}}
+
+    def save(self, path=None):
+        path = path or self.path
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.toDict(), f, indent=4)
+        os.replace(path + '.tmp', path)
+
+
+def formatSize(nbytes):
+    """ Human readable size of a number of bytes. """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(nbytes) < 1024 or unit == 'GB':
+            return '%.1f %s' % (nbytes, unit) if unit != 'B' else '%d B' % nbytes
+        nbytes /= 1024.
+
+
+def loadMetrics(path):
+    """ Load saved metrics, None if there are not. """
+    try:
+        return Metrics(path) if os.path.exists(path) else None
+    except (OSError, ValueError):
+        return None
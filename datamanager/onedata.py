@@ -0,0 +1,465 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Client of the Onezone REST API for publicly shared data
+(https://onedata.org/#/home/api/stable/onezone), used to download shares
+without the external download script.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from datamanager import transfer
+
+ONEZONE_API = '/api/v3/onezone/'
+DEFAULT_ONEZONE = 'https://datahub.egi.eu'
+LIST_LIMIT = 1000
+DOWNLOAD_CHUNK = 1024 * 1024
+PART_SUFFIX = '.part'
+
+# Transfer scheduling
+SMALL_FILE_SIZE = 8 * 1024 * 1024  # smaller files are downloaded in batches
+BATCH_SIZE = 64 * 1024 * 1024  # bytes of each batch of small files
+LARGE_FILE_SIZE = 1024 * 1024 * 1024  # larger files are downloaded by ranges in parallel
+RANGE_SIZE = 256 * 1024 * 1024
+
+TYPE_DIR = 'DIR'
+TYPE_REG = 'REG'
+
+# File attributes that, when present, hold a checksum of the file content
+CHECKSUM_ALGORITHMS = ('md5', 'sha1', 'sha256')
+
+
+class OnedataFile:
+    """ A regular file of a share, path is relative to the download folder. """
+    def __init__(self, fileId, path, size=None, mtime=None, checksum=None):
+        self.fileId = fileId
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.checksum = checksum  # (algorithm, value) or None
+
+    def getVersion(self):
+        """ What identifies the remote content of the file. """
+        return {'fileId': self.fileId, 'size': self.size, 'mtime': self.mtime,
+                'checksum': list(self.checksum) if self.checksum else None}
+
+    def __str__(self):
+        return self.path
+
+
+class DownloadError:
+    """ Why a file (or folder listing) could not be downloaded. """
+    def __init__(self, path, fileId, reason):
+        self.path = path
+        self.fileId = fileId
+        self.reason = reason
+
+    def __str__(self):
+        return '%s (%s): %s' % (self.path, self.fileId, self.reason)
+
+    def toDict(self):
+        return {'path': self.path, 'fileId': self.fileId, 'reason': self.reason}
+
+
+class OnedataClient:
+    """ Lists and downloads publicly shared files through Onezone. """
+    def __init__(self, onezone=DEFAULT_ONEZONE, session=None, retries=3):
+        self.url = (onezone or DEFAULT_ONEZONE).rstrip('/') + ONEZONE_API
+        self.session = session or transfer.createSession()
+        self.retries = retries
+
+    def _get(self, path, **kwargs):
+        def get():
+            response = self.session.get(self.url + path, timeout=transfer.TIMEOUT, **kwargs)
+            if response.status_code >= 500:
+                raise transfer.TransferError('server error %d' % response.status_code)
+            response.raise_for_status()
+            return response
+        return transfer.retry(get, self.retries, label='GET %s' % path)
+
+    def getAttributes(self, fileId):
+        return self._get('shares/data/%s' % fileId).json()
+
+    def iterChildren(self, fileId):
+        """ Iterate over the attributes of the children of a folder, page by page. """
+        params = {'limit': LIST_LIMIT}
+        while True:
+            page = self._get('shares/data/%s/children' % fileId, params=params).json()
+            for child in page.get('children', []):
+                if 'type' not in child:  # old Onezone versions only list ids and names
+                    child = dict(child, **self.getAttributes(child.get('id') or child.get('file_id')))
+                yield child
+            if page.get('isLast', True) or not page.get('nextPageToken'):
+                break
+            params = {'limit': LIST_LIMIT, 'token': page['nextPageToken']}
+
+    def listTree(self, fileId):
+        """ List once all regular files under a shared file or folder.
+        Returns the files and the errors found while listing. """
+        files, errors = [], []
+        root = self.getAttributes(fileId)
+        pending = [(root, root['name'])]
+        while pending:
+            node, path = pending.pop()
+            nodeId = node.get('file_id') or node.get('id') or fileId
+            nodeType = str(node.get('type', '')).upper()
+            if nodeType == TYPE_DIR:
+                try:
+                    for child in self.iterChildren(nodeId):
+                        pending.append((child, os.path.join(path, child['name'])))
+                except (requests.RequestException, transfer.TransferError) as e:
+                    errors.append(DownloadError(path, nodeId, 'cannot list folder: %s' % e))
+            elif nodeType == TYPE_REG:
+                checksum = next(((a, node[a]) for a in CHECKSUM_ALGORITHMS if node.get(a)), None)
+                files.append(OnedataFile(nodeId, path, node.get('size'), node.get('mtime'), checksum))
+        return sorted(files, key=lambda f: f.path), errors
+
+    def _getContent(self, onedataFile, headers, write):
+        """ Stream the content of a file, calling write(offset, chunk) for each chunk
+        (offset relative to the first byte received). Returns the response status. """
+        with self.session.get(self.url + 'shares/data/%s/content' % onedataFile.fileId, stream=True,
+                              headers=headers, timeout=transfer.TIMEOUT) as response:
+            if response.status_code >= 500:
+                raise transfer.TransferError('server error %d' % response.status_code)
+            response.raise_for_status()
+            offset = 0
+            for chunk in response.iter_content(DOWNLOAD_CHUNK):
+                write(offset, chunk, response.status_code)
+                offset += len(chunk)
+            return response.status_code
+
+    def download(self, onedataFile, downloadPath, resume=False, onChunk=None):
+        """ Download a file to downloadPath, through a partial file renamed when complete.
+        If resume, an existing partial file is completed with a range request (or just
+        renamed if it is already complete).
+        onChunk(nbytes) is called for every chunk received.
+        Returns the size of the file and the bytes that were already downloaded. """
+        partPath = self.getPartPath(onedataFile, downloadPath)
+        resumed = []
+        if resume and os.path.exists(partPath) and onedataFile.size is not None \
+                and os.path.getsize(partPath) >= int(onedataFile.size):
+            # interrupted before renaming it, there is nothing left to request
+            try:
+                size = self.finish(onedataFile, downloadPath)
+                return size, size
+            except transfer.TransferError as e:
+                print('Downloading %s again: %s' % (onedataFile.path, e))
+                resume = False
+
+        def get():
+            offset = os.path.getsize(partPath) if resume and os.path.exists(partPath) else 0
+            headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+            received = [0]
+            with open(partPath, 'ab' if offset else 'wb') as f:
+                def write(_, chunk, status):
+                    if not received[0] and status != 206 and offset:  # range not supported, start over
+                        f.seek(0)
+                        f.truncate()
+                    f.write(chunk)
+                    received[0] += len(chunk)
+                    if onChunk is not None:
+                        onChunk(len(chunk))
+                try:
+                    status = self._getContent(onedataFile, headers, write)
+                except Exception as e:
+                    if onChunk is not None:
+                        onChunk(-received[0])
+                    if offset and getattr(e, 'response', None) is not None and e.response.status_code == 416:
+                        # the partial file is not a prefix of the remote one, start over
+                        f.truncate(0)
+                        raise transfer.TransferError('range not satisfiable, downloading it again')
+                    raise
+            resumed.append(offset if status == 206 else 0)
+
+        transfer.retry(get, self.retries, label='Download of %s' % onedataFile.path)
+        return self.finish(onedataFile, downloadPath), resumed[-1]
+
+    def downloadRange(self, onedataFile, downloadPath, start, end, onChunk=None):
+        """ Download the bytes start-end (included) of a file into its partial
+        file, that must already exist with the final size. """
+        partPath = self.getPartPath(onedataFile, downloadPath)
+
+        def get():
+            received = [0]
+            fd = os.open(partPath, os.O_WRONLY)
+            try:
+                def write(offset, chunk, status):
+                    if status != 206:
+                        raise transfer.TransferError('range requests not supported')
+                    os.pwrite(fd, chunk, start + offset)
+                    received[0] += len(chunk)
+                    if onChunk is not None:
+                        onChunk(len(chunk))
+                self._getContent(onedataFile, {'Range': 'bytes=%d-%d' % (start, end)}, write)
+            except Exception:
+                if onChunk is not None:
+                    onChunk(-received[0])
+                raise
+            finally:
+                os.close(fd)
+            if received[0] != end - start + 1:
+                raise transfer.TransferError('got %d bytes of range %d-%d' % (received[0], start, end))
+
+        transfer.retry(get, self.retries, label='Download of %s (bytes %d-%d)' % (onedataFile.path, start, end))
+
+    def getPartPath(self, onedataFile, downloadPath):
+        path = os.path.join(downloadPath, onedataFile.path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path + PART_SUFFIX
+
+    def finish(self, onedataFile, downloadPath):
+        """ Verify the size (and checksum) of the partial file and rename it. Returns its size. """
+        path = os.path.join(downloadPath, onedataFile.path)
+        partPath = path + PART_SUFFIX
+        size = os.path.getsize(partPath)
+        if onedataFile.size is not None and size != int(onedataFile.size):
+            raise transfer.TransferError('got %d bytes of %s' % (size, onedataFile.size))
+        if onedataFile.checksum is not None:
+            algorithm, value = onedataFile.checksum
+            if getChecksum(partPath, algorithm) != str(value).lower():
+                os.remove(partPath)
+                raise transfer.TransferError('%s checksum does not match' % algorithm)
+        os.replace(partPath, path)
+        return size
+
+
+def getChecksum(path, algorithm):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DownloadManifest:
+    """ Remote version of the files already downloaded (or partially downloaded)
+    to a folder, stored in that folder, to only download new or changed files. """
+    FILE_NAME = '.onedata_manifest.json'
+
+    def __init__(self, downloadPath):
+        self.downloadPath = downloadPath
+        self.path = os.path.join(downloadPath, self.FILE_NAME)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print('Ignoring corrupted manifest %s' % self.path)
+
+    def isUpToDate(self, onedataFile):
+        """ True if the local file is the same version as the remote one. """
+        localPath = os.path.join(self.downloadPath, onedataFile.path)
+        if not os.path.exists(localPath):
+            return False
+        if onedataFile.size is not None and os.path.getsize(localPath) != int(onedataFile.size):
+            return False
+        entry = self.entries.get(onedataFile.path)
+        if entry is None:
+            # downloaded without manifest, trust it if it is not older than the remote one
+            return onedataFile.mtime is not None and os.path.getmtime(localPath) >= float(onedataFile.mtime)
+        return 'partial' not in entry and entry['version'] == onedataFile.getVersion()
+
+    def canResume(self, onedataFile):
+        """ True if the partial file is from the same remote version. """
+        entry = self.entries.get(onedataFile.path)
+        return bool(entry is not None and entry.get('partial') and entry['version'] == onedataFile.getVersion())
+
+    def setPartial(self, onedataFile, resumable=True):
+        """ Mark a file as being downloaded. Partial files downloaded by ranges
+        have holes, so they can not be resumed. """
+        with self._lock:
+            self.entries[onedataFile.path] = {'version': onedataFile.getVersion(), 'partial': resumable}
+
+    def setComplete(self, onedataFile):
+        with self._lock:
+            self.entries[onedataFile.path] = {'version': onedataFile.getVersion()}
+
+    def save(self):
+        with self._lock:
+            os.makedirs(self.downloadPath, exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(self.path + '.tmp', self.path)
+
+
+class TransferScheduler:
+    """
+    Downloads files concurrently, ordering and grouping them so that the link
+    is kept busy: small files are downloaded in batches (one task per batch),
+    large files are split in ranges fetched in parallel, and the biggest tasks
+    start first. The total bandwidth can be capped and the throughput and ETA
+    are reported periodically.
+    """
+    def __init__(self, client, downloadPath, workers=1, bandwidth=0, manifest=None, onDone=None,
+                 smallFileSize=SMALL_FILE_SIZE, batchSize=BATCH_SIZE,
+                 largeFileSize=LARGE_FILE_SIZE, rangeSize=RANGE_SIZE):
+        self.client = client
+        self.downloadPath = downloadPath
+        self.workers = max(1, workers)
+        self.limiter = transfer.BandwidthLimiter(bandwidth) if bandwidth else None
+        self.manifest = manifest
+        self.onDone = onDone
+        self.smallFileSize = smallFileSize
+        self.batchSize = batchSize
+        self.largeFileSize = largeFileSize
+        self.rangeSize = rangeSize
+        self._lock = threading.Lock()
+        self._ranges = {}  # path: [ranges left, error]
+        self.progress = None
+
+    def _onChunk(self, nbytes):
+        if self.limiter is not None and nbytes > 0:
+            self.limiter.consume(nbytes)
+        self.progress.update(nbytes)
+
+    def _canResume(self, onedataFile):
+        return self.manifest is not None and self.manifest.canResume(onedataFile)
+
+    def getTasks(self, files):
+        """ Group files in tasks: (bytes, kind, files or (file, start, end)), biggest first. """
+        tasks, batch, batchBytes = [], [], 0
+        for f in files:
+            size = int(f.size or 0)
+            if size >= self.largeFileSize and self.workers > 1 and not self._canResume(f):
+                for start in range(0, size, self.rangeSize):
+                    end = min(start + self.rangeSize, size) - 1
+                    tasks.append((end - start + 1, 'range', (f, start, end)))
+            elif size < self.smallFileSize:
+                batch.append(f)
+                batchBytes += size
+                if batchBytes >= self.batchSize:
+                    tasks.append((batchBytes, 'files', batch))
+                    batch, batchBytes = [], 0
+            else:
+                tasks.append((size, 'files', [f]))
+        if batch:
+            tasks.append((batchBytes, 'files', batch))
+        return sorted(tasks, key=lambda t: t[0], reverse=True)
+
+    def _downloadFiles(self, files):
+        """ Download files one after the other, returns the completed and the errors. """
+        completed, errors = [], []
+        for f in files:
+            resume = self._canResume(f)
+            if self.manifest is not None and not resume:
+                self.manifest.setPartial(f)
+                if int(f.size or 0) >= self.smallFileSize:
+                    # persist it before downloading, so a killed run can resume the partial file
+                    self.manifest.save()
+            try:
+                start = time.time()
+                size, resumedBytes = self.client.download(f, self.downloadPath, resume, self._onChunk)
+                completed.append((f, size, resumedBytes, time.time() - start))
+            except Exception as e:
+                errors.append(DownloadError(f.path, f.fileId, str(e)))
+        return completed, errors
+
+    def _prepareRanges(self, tasks):
+        """ Create the partial files (with their final size) of the files downloaded by ranges. """
+        for _, kind, (f, start, end) in (t for t in tasks if t[1] == 'range'):
+            if f.path not in self._ranges:
+                self._ranges[f.path] = [0, None, None]  # ranges left, error, start time
+                if self.manifest is not None:
+                    self.manifest.setPartial(f, resumable=False)
+                with open(self.client.getPartPath(f, self.downloadPath), 'wb') as part:
+                    part.truncate(int(f.size))
+            self._ranges[f.path][0] += 1
+        if self.manifest is not None and self._ranges:
+            self.manifest.save()
+
+    def _downloadRange(self, task):
+        f, start, end = task
+        error = None
+        with self._lock:
+            state = self._ranges[f.path]
+            state[2] = state[2] or time.time()
+        try:
+            self.client.downloadRange(f, self.downloadPath, start, end, self._onChunk)
+        except Exception as e:
+            error = str(e)
+        with self._lock:
+            state = self._ranges[f.path]
+            state[0] -= 1
+            state[1] = state[1] or error
+            last = state[0] == 0
+        if not last:
+            return [], []
+        # the last range of a file finishes it
+        try:
+            if state[1]:
+                raise transfer.TransferError(state[1])
+            return [(f, self.client.finish(f, self.downloadPath), 0, time.time() - state[2])], []
+        except Exception as e:
+            return [], [DownloadError(f.path, f.fileId, str(e))]
+
+    def run(self, files):
+        """ Download all files. onDone(onedataFile, size, resumedBytes, seconds) is called for
+        every file downloaded. Returns the list of DownloadError of the files that failed. """
+        tasks = self.getTasks(files)
+        self._prepareRanges(tasks)
+        self.progress = transfer.Progress(sum(int(f.size or 0) for f in files), 'Downloaded')
+        errors = []
+        count = 0
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = [executor.submit(self._downloadRange if kind == 'range' else self._downloadFiles, task)
+                       for _, kind, task in tasks]
+            for future in as_completed(futures):
+                completed, taskErrors = future.result()
+                for f, size, resumedBytes, seconds in completed:
+                    if self.manifest is not None:
+                        self.manifest.setComplete(f)
+                    if self.onDone is not None:
+                        self.onDone(f, size, resumedBytes, seconds)
+                for error in taskErrors:
+                    print('Download of %s failed: %s' % (error.path, error.reason), flush=True)
+                errors += taskErrors
+                count += len(completed) + len(taskErrors)
+                if self.manifest is not None and count >= 100:
+                    self.manifest.save()
+                    count = 0
+        if self.manifest is not None:
+            self.manifest.save()
+        self.progress.report()
+        return errors
+
+
+def downloadFiles(client, files, downloadPath, workers=1, onDone=None, manifest=None, bandwidth=0):
+    """ Download files concurrently with a TransferScheduler. onDone(onedataFile, size, resumedBytes, seconds)
+    is called for every file downloaded. With a manifest, partial downloads are resumed and
+    it is kept up to date. bandwidth is the maximum throughput in bytes/s (0 for no limit).
+    Returns the list of DownloadError of the files that failed. """
+    scheduler = TransferScheduler(client, downloadPath, workers, bandwidth, manifest, onDone)
+    return scheduler.run(files)
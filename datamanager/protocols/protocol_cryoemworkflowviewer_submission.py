@@ -26,18 +26,22 @@
 
 import os
 import json
-import re
-from pwem import emlib, Domain
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pwem.protocols import EMProtocol
-from pwem.objects import Class2D, Class3D, Image, CTFModel, Volume, Micrograph, Movie, Particle, SetOfCoordinates
+from pwem.objects import Class2D, Class3D, Image, CTFModel, Volume, Micrograph, Particle, SetOfCoordinates, SetOfMicrographs
 from pyworkflow.protocol import params
 from pyworkflow.object import String, Set
 import pyworkflow.utils as pwutils
 from pyworkflow.project import config
-from PIL import Image as ImagePIL
-from PIL import ImageDraw
-from zipfile import ZipFile, ZIP_DEFLATED
-import requests
+
+from datamanager import Plugin, estimate, logs, metadata
+from datamanager.cache import ThumbnailCache, CACHE_VERSION
+from datamanager.jsonstream import JsonListWriter, JsonLinesWriter, iterJsonLines
+from datamanager.constants import LOW_PASS_CUTOFF
+from datamanager.metrics import Metrics, loadMetrics, formatSize, METRICS_FILE
 
 class CryoEMWorkflowViewerDepositor(EMProtocol):
     """
@@ -45,22 +49,46 @@ class CryoEMWorkflowViewerDepositor(EMProtocol):
     By using it you allow your workflow and thumnbails to be uploaded to a machine hosted in the Spanish National Centre for Biotechnology (CNB).
     """
     _label = 'CryoEM Workflow Viewer deposition'
-    _ih = emlib.image.ImageHandler()
+
+    SERVER_URL = 'https://nolan.cnb.csic.es/cryoemworkflowviewer/'
+    RESUMABLE_UPLOADS = 'uploadfiles/'
 
     OUTPUT_WORKFLOW = 'workflow.json'
+    UPLOADS_STATE = 'uploads.json'
+    EXPORT_CACHE = 'export_cache.json'
     DIR_IMAGES = 'images_representation'
 
     OUTPUT_NAME = 'outputName'
     OUTPUT_TYPE = 'outputType'
     OUTPUT_ITEMS = 'outputItems'
     OUTPUT_SIZE = 'outputSize'
+    OUTPUT_STATS = 'outputStats'
     ITEM_ID = 'item_id'
     ITEM_REPRESENTATION = 'item_representation'
 
+    VOLUME_ALL_SLICES = 0
+    VOLUME_SLICES = 1
+    VOLUME_MONTAGE = 2
+
+    SAMPLING_FIRST = 0
+    SAMPLING_RANDOM = 1
+    SAMPLING_STRATIFIED = 2
+    STRATIFY_ATTRIBUTE = '_classId'
+
+    # Number of items represented for some types (None for all), other types get maxItems
+    ITEMS_LIMITS = [(Micrograph, 3), (CTFModel, 3), (Particle, 15), (Class2D, None), (Class3D, None)]
+
+    # Cheapest settings the caps can switch to
+    MIN_ITEMS = 5
+    MIN_THUMBNAIL_SIZE = 128
+    MIN_LOG_SIZE = 1  # MB
+    WARN_UPLOAD_SIZE = 1024  # MB, warn about bigger uploads without caps
+
 
     def __init__(self, **kwargs):
         EMProtocol.__init__(self, **kwargs)
         self.response = String()
+        self.estimation = String()
 
     # --------------- DEFINE param functions ---------------
 
@@ -76,35 +104,153 @@ class CryoEMWorkflowViewerDepositor(EMProtocol):
                       help='Specify a descriptive entry title')
         form.addParam('public', params.BooleanParam, label='Make entry public?', default=False,
                       help='Do you want the entry be publicly visible at http://nolan.cnb.csic.es/cryoemworkflowviewer/entries ?')
+        form.addParam('dryRun', params.BooleanParam, label='Only estimate the deposition?', default=False,
+                      help='Do not deposit anything, just estimate from the project metadata the number of thumbnails, '
+                           'render time, archive size and upload time of the deposition (see the summary).')
+        form.addParam('maxThumbnails', params.IntParam, label='Maximum thumbnails', default=0,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If the deposition is estimated to produce more thumbnail files, cheaper settings are used '
+                           '(volume montages, fewer items, smaller thumbnails, truncated logs) until it fits. If it does not '
+                           'fit even with the cheapest settings, nothing is deposited. 0 means no limit.')
+        form.addParam('maxUploadSize', params.FloatParam, label='Maximum upload size (MB)', default=0,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If the upload is estimated to be bigger, cheaper settings are used as with the maximum '
+                           'thumbnails. 0 means no limit.')
+        form.addParam('useCache', params.BooleanParam, label='Reuse cached thumbnails?', default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Thumbnails are cached (in DATAMANAGER_CACHE folder, limited to DATAMANAGER_CACHE_SIZE MB) '
+                           'so unchanged images are not rendered again in later depositions or updates')
+        form.addParam('thumbnailSize', params.IntParam, label='Maximum thumbnail size (px)', default=512,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Images are binned or scaled down while rendering so that their largest edge is at most this size. '
+                           'It keeps memory, disk usage and upload size independent of the detector size.')
+        form.addParam('volumeSlices', params.EnumParam, label='Volume representation', default=self.VOLUME_ALL_SLICES,
+                      choices=['All slices', 'Evenly spaced slices', 'Montage per axis'],
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Volumes and 3D classes are represented by their slices in x, y and z directions: all of them, '
+                           'a number of evenly spaced ones or those slices tiled in a single image (montage) per axis. '
+                           'The last two read the volume only once and write far fewer files.')
+        form.addParam('numberOfSlices', params.IntParam, label='Slices per axis', default=16,
+                      condition='volumeSlices != %d' % self.VOLUME_ALL_SLICES, expertLevel=params.LEVEL_ADVANCED,
+                      help='Number of evenly spaced slices per axis.')
+        form.addParam('volumeProjections', params.BooleanParam, label='Add central slices and projections?', default=False,
+                      condition='volumeSlices != %d' % self.VOLUME_ALL_SLICES, expertLevel=params.LEVEL_ADVANCED,
+                      help='Also represent volumes by their central slice and their maximum projection along every axis.')
+        form.addParam('keepImages', params.BooleanParam, label='Keep thumbnails folder?', default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Thumbnails and logs are zipped as soon as they are ready. If not kept, each file is '
+                           'removed from the %s folder right after being zipped and only the zip remains.' % self.DIR_IMAGES)
+        form.addParam('compactJson', params.BooleanParam, label='Compact workflow file?', default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Write %s without indentation nor spaces, which makes it noticeably smaller.' % self.OUTPUT_WORKFLOW)
+        form.addParam('compressJson', params.BooleanParam, label='Gzip workflow file?', default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Upload %s gzipped (as %s.gz). Only use it if the server accepts gzipped workflows.'
+                           % (self.OUTPUT_WORKFLOW, self.OUTPUT_WORKFLOW))
+        form.addParam('logMaxSize', params.FloatParam, label='Maximum log size (MB)', default=0,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Logs bigger than this are uploaded truncated, keeping only their beginning and end '
+                           '(half of this size each). Use 0 to upload the whole logs.')
+        form.addParam('samplingMode', params.EnumParam, label='Items sampling', default=self.SAMPLING_FIRST,
+                      choices=['First items', 'Random items', 'Stratified by class'],
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Which items of big sets are represented: 3 micrographs, movies or CTFs, 15 particles and up to '
+                           '"Maximum items" of other types (all the classes of a classification). Random items are '
+                           'spread over the set in a reproducible way and stratified ones are taken evenly from each class '
+                           '(_classId). Statistics of the numeric attributes of every set are always included.')
+        form.addParam('maxItems', params.IntParam, label='Maximum items', default=50,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Maximum number of items represented for sets of types without a specific limit.')
+        form.addParam('incremental', params.BooleanParam, label='Incremental export?', default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Reuse the export of the protocols that did not change since the previous deposition '
+                           'of this project instead of processing them again. The resulting workflow is the same.')
+
+        form.addParam('uploadRetries', params.IntParam, label='Upload retries', default=5,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Number of times the upload is retried, with increasing waits, after a connection or server error. '
+                           'The submission that creates the entry is only repeated if it did not reach the server.')
+        form.addParam('resumableUpload', params.BooleanParam, label='Resumable upload?', default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If the server accepts chunked uploads, files are uploaded in chunks and an interrupted '
+                           'upload is resumed (also when continuing the protocol) instead of started over.')
+
+        form.addParallelSection(threads=4, mpi=0)
 
     # --------------- INSERT steps functions ----------------
 
     def _insertAllSteps(self):
-            self._insertFunctionStep('createDepositionStep')
-            self._insertFunctionStep('makeDepositionStep')
+            self._insertFunctionStep('estimateStep')
+            if not self.dryRun:
+                self._insertFunctionStep('createDepositionStep')
+                self._insertFunctionStep('makeDepositionStep')
 
     # --------------- STEPS functions -----------------------
 
-    def createDepositionStep(self):
-        # make thumbnails folder in extra
-        pwutils.makePath(self._getExtraPath(self.DIR_IMAGES))
-
-        # export workflow json
-        self.exportWorkflow()
+    def estimateStep(self):
+        # estimate the deposition from the metadata, switching to cheaper settings if it exceeds the caps
+        workflow = self._describeWorkflow()
+        settings = self._getEstimateSettings()
+        result = self._estimate(workflow, settings)
+        # the form parameters are kept, the capped values are applied when rendering (see _getSetting)
+        capped = {}
+        while self._exceedsCaps(result):
+            cheaper = self._getCheaperSettings(settings)
+            if cheaper is None:
+                break
+            changes = {k: v for k, v in cheaper.items() if v != settings[k]}
+            settings = cheaper
+            # only keep the steps that make the deposition cheaper
+            cheaperResult = self._estimate(workflow, dict(self._getEstimateSettings(), **dict(capped, **changes)))
+            if cheaperResult.thumbnails < result.thumbnails or cheaperResult.getUploadBytes() < result.getUploadBytes():
+                capped.update(changes)
+                result = cheaperResult
+
+        self._caps = capped
+        self.estimation.set(json.dumps({'estimate': result.toDict(), 'capped': capped}))
+        self._store()
+        self.info('Estimated deposition: %s' % self._formatEstimate(result.toDict()))
+        if capped:
+            self.info('Cheaper settings used to fit the caps: %s' % capped)
+        if self._exceedsCaps(result):
+            message = ('The deposition exceeds the maximum thumbnails or upload size even with the cheapest '
+                       'settings (%s), remove protocols from the project or raise the limits' % self._formatEstimate(result.toDict()))
+            if not self.dryRun:
+                raise Exception(message)
+            self.warning(message)
 
-        # zip thumbnails folder
-        zipObj = ZipFile(self._getExtraPath(pwutils.replaceBaseExt(self.DIR_IMAGES, 'zip')), 'w', ZIP_DEFLATED)
-        rootlen = len(self._getExtraPath(self.DIR_IMAGES)) + 1
-        for base, dirs, files in os.walk(self._getExtraPath(self.DIR_IMAGES)):
-            for file in files:
-                fn = os.path.join(base, file)
-                zipObj.write(fn, fn[rootlen:])
+    def createDepositionStep(self):
+        # export workflow json, rendering the thumbnails in parallel
+        # and zipping them as soon as they are ready
+        self.startRendering()
+        try:
+            with self._metrics.timer('stages', 'export'):
+                self.exportWorkflow()
+        finally:
+            self.stopRendering()
+            self._metrics.save(self._getExtraPath(METRICS_FILE))
 
     def makeDepositionStep(self):
-        workflow = open(self._getExtraPath(self.OUTPUT_WORKFLOW), 'rb')
-        thumbnails = open(self._getExtraPath(pwutils.replaceBaseExt(self.DIR_IMAGES, 'zip')), 'rb')
-        url = 'https://nolan.cnb.csic.es/cryoemworkflowviewer/uploaddata/%s/%s/%s%s' % (self.apitoken, '1' if self.public else '0', self.entrytitle, '/' + str(self.entryid) if self.update else '')
-        response = requests.post(url, files={'workflow': ('workflow.json', workflow), 'thumbnails': ('images_representation.zip', thumbnails)}, verify=False)
+        from datamanager import transfer
+        files = {'workflow': (os.path.basename(self._getWorkflowPath()), self._getWorkflowPath()),
+                 'thumbnails': (os.path.basename(self._getArchivePath()), self._getArchivePath())}
+        url = self.SERVER_URL + 'uploaddata/%s/%s/%s%s' % (self.apitoken, '1' if self.public else '0', self.entrytitle, '/' + str(self.entryid) if self.update else '')
+        session = transfer.createSession()
+        retries = self.uploadRetries.get()
+        start = time.time()
+
+        if self.resumableUpload and transfer.supportsTus(session, self.SERVER_URL + self.RESUMABLE_UPLOADS, verify=False):
+            # upload the files in chunks, resuming them after any failure, and then submit their upload urls
+            uploads = transfer.uploadResumable(session, self.SERVER_URL + self.RESUMABLE_UPLOADS,
+                                               {field: path for field, (_, path) in files.items()},
+                                               self._getExtraPath(self.UPLOADS_STATE), retries, verify=False)
+            response = transfer.postForm(session, url, uploads, retries, verify=False)
+        else:
+            response = transfer.postMultipart(session, url, files, retries, verify=False)
+        metrics = Metrics(self._getExtraPath(METRICS_FILE))
+        metrics.record('uploads', bytes=sum(os.path.getsize(path) for _, path in files.values()),
+                       seconds=time.time() - start, status=response.status_code)
+        metrics.save()
 
         self.response.set(str(response.text))
         self._store()
@@ -117,6 +263,8 @@ class CryoEMWorkflowViewerDepositor(EMProtocol):
 
     def _validate(self):
         errors = []
+        if self.dryRun:
+            return errors
         if self.apitoken == '':
             errors.append('You have to provide an API Token (yo can get one at http://nolan.cnb.csic.es/cryoemworkflowviewer/profile )')
         if self.entrytitle == '':
@@ -125,6 +273,20 @@ class CryoEMWorkflowViewerDepositor(EMProtocol):
             errors.append('You have to provide the ID of the entry you want to update. If you do not remember it, check it at http://nolan.cnb.csic.es/cryoemworkflowviewer/profile')
         return errors
 
+    def _warnings(self):
+        warnings = []
+        if self.dryRun:
+            return warnings
+        result = self._estimate(self._describeWorkflow(), self._getEstimateSettings())
+        if self._exceedsCaps(result):
+            warnings.append('The deposition is estimated to exceed the maximum thumbnails or upload size (%s), '
+                            'cheaper settings will be used' % self._formatEstimate(result.toDict()))
+        elif not self.maxThumbnails.get() and not self.maxUploadSize.get() \
+                and result.getUploadBytes() > self.WARN_UPLOAD_SIZE * 1024 * 1024:
+            warnings.append('The deposition is estimated to be big (%s), you can limit it with the maximum '
+                            'thumbnails or upload size' % self._formatEstimate(result.toDict()))
+        return warnings
+
     def _citations(self):
         citations = []
         return citations
@@ -135,6 +297,31 @@ class CryoEMWorkflowViewerDepositor(EMProtocol):
             summary.append("Deposition result: %s" % (self.response))
         else:
             summary.append('No deposition done yet')
+
+        if self.estimation.get():
+            estimation = json.loads(self.estimation.get())
+            summary.append('Estimated deposition: %s' % self._formatEstimate(estimation['estimate']))
+            if estimation['capped']:
+                summary.append('Cheaper settings used to fit the caps: %s'
+                               % ', '.join('%s = %s' % item for item in estimation['capped'].items()))
+
+        metrics = loadMetrics(self._getExtraPath(METRICS_FILE))
+        if metrics is not None:
+            protocols = metrics.getRecords('protocols')
+            if protocols:
+                slowest = max(protocols, key=lambda p: p['seconds'])
+                summary.append('Export of %d protocols (%d reused) took %0.1f s, slowest: %s (%0.1f s)'
+                               % (len(protocols), sum(p['restored'] for p in protocols), metrics.getTime('stages', 'export'),
+                                  slowest['label'], slowest['seconds']))
+            summary.append('%d thumbnails (%d cached, %d shared by several items) rendered in %0.1f s, %s zipped into %s'
+                           % (metrics.get('renderedThumbnails') + metrics.get('cachedThumbnails'), metrics.get('cachedThumbnails'),
+                              metrics.get('sharedThumbnails'),
+                              sum(t['total'] for t in metrics.timings.get('render', {}).values()),
+                              formatSize(metrics.get('archivedBytes')), formatSize(metrics.get('archiveSize'))))
+            for upload in metrics.getRecords('uploads')[-1:]:
+                summary.append('Uploaded %s in %0.1f s (%s/s)' % (formatSize(upload['bytes']), upload['seconds'],
+                                                                  formatSize(upload['bytes'] / max(upload['seconds'], 1e-3))))
+            summary.append('Metrics in %s' % metrics.path)
         return summary
 
     def _methods(self):
@@ -142,15 +329,32 @@ class CryoEMWorkflowViewerDepositor(EMProtocol):
 
     # -------------------- UTILS functions -------------------------
 
+    def startRendering(self):
+        """ Create the thumbnails folder, its archive and the renderer that fills them. """
+        from datamanager import thumbnails
+        from datamanager.archive import ThumbnailsArchive
+        pwutils.makePath(self._getExtraPath(self.DIR_IMAGES))
+        self._archive = ThumbnailsArchive(self._getArchivePath(), self._getExtraPath(self.DIR_IMAGES), self.keepImages.get())
+        cache = ThumbnailCache(Plugin.getCachePath('thumbnails'), Plugin.getCacheSize()) if self.useCache else None
+        self._metrics = Metrics()
+        self._renderer = thumbnails.ThumbnailRenderer(self.numberOfThreads.get(), cache, self._archive.add, self._metrics)
+        self._exportLocal = threading.local()
+
+    def stopRendering(self):
+        self._renderer.shutdown()
+        self._archive.close()
+        self._metrics.add('archivedFiles', self._archive.files)
+        self._metrics.add('archivedBytes', self._archive.bytes)
+        self._metrics.add('archiveSize', os.path.getsize(self._getArchivePath()))
+
+    def _getWorkflowProtocols(self):
+        """ Protocols of the project to deposit, all but the depositions. """
+        return [p for p in self.getProject().getRuns() if not isinstance(p, CryoEMWorkflowViewerDepositor)]
+
     def exportWorkflow(self):
         project = self.getProject()
-        workflowProts = [p for p in project.getRuns()]
-
-        for step in workflowProts:
-            if self._label in step.__dict__['_objLabel']:
-                workflowProts.remove(step)
+        workflowProts = self._getWorkflowProtocols()
 
-        workflowJsonPath = self._getExtraPath(self.OUTPUT_WORKFLOW)
         protDicts = project.getProtocolsDict(workflowProts)
 
         # labels and colors
@@ -171,60 +375,274 @@ class CryoEMWorkflowViewerDepositor(EMProtocol):
                 for label in protConfigInfo['labels']:
                     protsLabelsDict[protConfigInfo['id']].append(label)
 
-        # Add extra info to protocosDict
-        for prot in workflowProts:
-            # Get summary and add input and output information
-            summary = prot.summary()
+        # Reuse the export of protocols unchanged since the previous deposition
+        previousExport = self._loadExportCache() if self.incremental else {}
+
+        # Protocols are written, in order, as soon as their thumbnails are done
+        workflowWriter = JsonListWriter(self._getWorkflowPath(), self.compactJson.get())
+        cacheWriter = JsonLinesWriter(self._getExtraPath(self.EXPORT_CACHE))
+        cacheWriter.write({'imagesDir': self._getExtraPath(self.DIR_IMAGES)})
+        pending = []
+        try:
+            for prot, result in self._iterExportTasks(workflowProts, protDicts, previousExport):
+                pending.append(self.exportProtocolDict(prot, protDicts, result, previousExport, labelsDict, protsLabelsDict))
+                self._renderer.collect()
+                self._writeExported(pending, workflowWriter, cacheWriter)
+
+            # wait for the thumbnails, items whose representation failed are left without it
+            self._renderer.wait()
+            self._writeExported(pending, workflowWriter, cacheWriter)
+        finally:
+            workflowWriter.close()
+            cacheWriter.close()
+
+    def _iterExportTasks(self, prots, protDicts, previousExport):
+        """ Export the protocols in a thread pool and yield their results in project order.
+        Only a few protocols ahead of the one being assembled are exported at the same time. """
+        threads = max(1, self.numberOfThreads.get())
+        with ThreadPoolExecutor(threads) as pool:
+            tasks = deque()
+            for prot in prots:
+                cached = previousExport.get(str(prot.getObjId()))
+                tasks.append((prot, pool.submit(self._exportProtocolTask, prot.getObjId(), protDicts, cached)))
+                if len(tasks) > 2 * threads:
+                    prot, task = tasks.popleft()
+                    yield prot, task.result()
+            while tasks:
+                prot, task = tasks.popleft()
+                yield prot, task.result()
+
+    def _exportProtocolTask(self, protId, protDicts, cached):
+        """ Export the metadata of a protocol in a worker thread, unless its cached export can be reused.
+        Renders and archive additions are returned to be done by the main thread. """
+        self._exportLocal.deferred = []
+        start = time.time()
+        prot, mapper = self._loadProtocol(protId)
+        try:
+            fingerprint = self._getProtocolFingerprint(prot, protDicts)
+            exported = None
+            if cached is None or cached['fingerprint'] != fingerprint:
+                exported = self.exportProtocol(prot, protDicts)
+            return fingerprint, exported, self._exportLocal.deferred, time.time() - start
+        finally:
+            self._exportLocal.deferred = None
             for a, input in prot.iterInputAttributes():
-                if input.isPointer():
-                    try:
-                        inputLabel = ' (from %s) ' % protDicts[int(input.getUniqueId().split('.')[0])]['object.label']
-                    except:
-                        inputLabel = ''
-                summary.append('Input: %s%s- %s\n' % (input.getUniqueId() if input.isPointer() else input.getObjName(), inputLabel, str(input.get())))
-
-            protDicts[prot.getObjId()]['output'] = []
-            num = 0
-            for a, output in prot.iterOutputAttributes():
-                print('output key is %s' % a)
-                protDicts[prot.getObjId()]['output'].append(self.getOutputDict(output))
-                summary.append('Output: %s - %s\n' % (output.getObjName(), str(output)))
-
-            protDicts[prot.getObjId()]['summary'] = ''.join(summary)
-
-            # Get log (stdout)
-            outputs = []
-            logs = list(prot.getLogPaths())
-            if pwutils.exists(logs[0]):
-                logPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s.log' % (prot.getObjId(), prot.getClassName()))
-                pwutils.copyFile(logs[0], logPath)
-                outputs = logPath
-
-            protDicts[prot.getObjId()]['log'] =  outputs
-
-            # labels
-            if prot.getObjId() in protsLabelsDict.keys():
-                protDicts[prot.getObjId()]['label'] = protsLabelsDict[prot.getObjId()]
-                protDicts[prot.getObjId()]['labelColor'] = []
-                for label in protDicts[prot.getObjId()]['label']:
-                    protDicts[prot.getObjId()]['labelColor'].append(labelsDict[label])
-
-            # Get plugin and binary version
-            protDicts[prot.getObjId()]['plugin'] = prot.getClassPackageName()
-            if len(outputs) > 0:
-                with open(logPath) as log:
-                    for line in log:
-                        if re.search(r'plugin v', line):
-                            version = line.split(':')[1].replace(' ', '').replace('\n', '')
-                            protDicts[prot.getObjId()]['pluginVersion'] = version
-
-        with open(workflowJsonPath, 'w') as f:
-            f.write(json.dumps(list(protDicts.values()), indent=4, separators=(',', ': ')))
+                if isinstance(input.get(), Set):
+                    input.get().close()
+            prot.closeMappers()
+            mapper.close()
+
+    def _loadProtocol(self, protId):
+        """ Load a protocol with its own connection to the project database. The objects
+        its inputs point to (e.g. the outputs of other protocols) are loaded with it, so
+        the Sets used by an export thread are not shared with the other ones.
+        Returns the protocol and the mapper to close. """
+        project = self.getProject()
+        mapper = project.createMapper(os.path.join(project.getPath(), project.getDbPath()))
+        prot = mapper.selectById(protId)
+        prot.setProject(project)
+        prot.setMapper(mapper)
+        return prot, mapper
+
+    def exportProtocolDict(self, prot, protDicts, result, previousExport, labelsDict, protsLabelsDict):
+        """ Add the exported info to the protocol dict. Returns it with its export cache
+        entry and the number of thumbnails that must be finished before writing it. """
+        protDict = protDicts[prot.getObjId()]
+        fingerprint, exported, deferred, seconds = result
+        start = time.time()
+        restored = exported is None
+        if restored:
+            exported, renders = self._restoreExport(previousExport.get(str(prot.getObjId())), fingerprint)
+        if exported is None:
+            # the previous thumbnails are not available
+            restored = False
+            exported = self.exportProtocol(prot, protDicts)
+        for func, args, kwargs in deferred:
+            func(*args, **kwargs)
+        if not restored:
+            renders = self._renderer.popRequests()
+        self._metrics.record('protocols', id=prot.getObjId(), label=prot.getObjLabel(), className=prot.getClassName(),
+                             seconds=seconds + time.time() - start, restored=restored, outputs=len(exported['output']))
+
+        protDict['output'] = exported['output']
+        protDict['summary'] = exported['summary']
+        protDict['log'] = exported['log']
+
+        # labels
+        if prot.getObjId() in protsLabelsDict.keys():
+            protDict['label'] = protsLabelsDict[prot.getObjId()]
+            protDict['labelColor'] = []
+            for label in protDict['label']:
+                protDict['labelColor'].append(labelsDict[label])
+
+        # Get plugin and binary version
+        protDict['plugin'] = prot.getClassPackageName()
+        if 'pluginVersion' in exported:
+            protDict['pluginVersion'] = exported['pluginVersion']
+
+        cacheEntry = {'id': str(prot.getObjId()), 'fingerprint': fingerprint, 'export': exported, 'renders': renders}
+        return self._renderer.getSubmitted(), protDict, cacheEntry
+
+    def _writeExported(self, pending, workflowWriter, cacheWriter):
+        """ Write the pending protocols whose thumbnails are all processed, keeping their order,
+        and release their exported info (the basic dict is still needed for input labels). """
+        finished = self._renderer.getFinished()
+        while pending and pending[0][0] <= finished:
+            _, protDict, cacheEntry = pending.pop(0)
+            workflowWriter.write(protDict)
+            cacheWriter.write(cacheEntry)
+            for key in ('output', 'summary', 'log'):
+                protDict.pop(key, None)
+
+    def exportProtocol(self, prot, protDicts):
+        """ Export the summary, outputs, log and plugin version of a protocol. """
+        exported = {}
+
+        # Get summary and add input and output information
+        summary = prot.summary()
+        for a, input in prot.iterInputAttributes():
+            if input.isPointer():
+                try:
+                    inputLabel = ' (from %s) ' % protDicts[int(input.getUniqueId().split('.')[0])]['object.label']
+                except:
+                    inputLabel = ''
+            summary.append('Input: %s%s- %s\n' % (input.getUniqueId() if input.isPointer() else input.getObjName(), inputLabel, str(input.get())))
+
+        exported['output'] = []
+        for a, output in prot.iterOutputAttributes():
+            print('output key is %s' % a)
+            exported['output'].append(self.getOutputDict(output))
+            summary.append('Output: %s - %s\n' % (output.getObjName(), str(output)))
+            if isinstance(output, Set):
+                # do not keep its database connection, it may be used from another thread
+                output.close()
+
+        exported['summary'] = ''.join(summary)
+
+        # Get log (stdout), only its head and tail if it is too big
+        outputs = []
+        logPaths = list(prot.getLogPaths())
+        if pwutils.exists(logPaths[0]):
+            logPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s.log' % (prot.getObjId(), prot.getClassName()))
+            maxSize = int(self._getSetting('logMaxSize') * 1024 * 1024)
+            if maxSize and os.path.getsize(logPaths[0]) > maxSize:
+                self._defer(self._archive.addChunks, logs.iterTruncated(logPaths[0], maxSize // 2, maxSize // 2), logPath)
+            else:
+                self._defer(self._archive.add, logPaths[0], logPath)
+            outputs = logPath
+
+        exported['log'] = outputs
+
+        # Get plugin version, read from the log header
+        if len(outputs) > 0:
+            version = logs.getPluginVersion(logPaths[0])
+            if version is not None:
+                exported['pluginVersion'] = version
+
+        return exported
+
+    # --------------- incremental export utils -------------------------
+
+    def _getRenderSettings(self):
+        """ Parameters that change the thumbnails, a cached export is only valid for the same ones. """
+        return {'version': CACHE_VERSION, 'lowPassCutoff': LOW_PASS_CUTOFF,
+                'thumbnailSize': self._getSetting('thumbnailSize'), 'samplingMode': self.samplingMode.get(),
+                'maxItems': self._getSetting('maxItems'), 'logMaxSize': self._getSetting('logMaxSize'),
+                'volumeSlices': self._getSetting('volumeSlices'), 'numberOfSlices': self._getSetting('numberOfSlices'),
+                'volumeProjections': self._getSetting('volumeProjections')}
+
+    def _getProtocolFingerprint(self, prot, protDicts):
+        """ Values that change whenever the export of the protocol would change. """
+        inputs = []
+        for a, input in prot.iterInputAttributes():
+            if input.isPointer():
+                protId = input.getUniqueId().split('.')[0]
+                inputs.append([input.getUniqueId(), protDicts.get(int(protId), {}).get('object.label') if protId.isdigit() else None])
+
+        outputs = []
+        for a, output in prot.iterOutputAttributes():
+            outputs.append([a, output.getClassName(), output.getSize() if isinstance(output, Set) else None])
+
+        log = None
+        logPaths = list(prot.getLogPaths())
+        if pwutils.exists(logPaths[0]):
+            log = [os.path.getsize(logPaths[0]), os.path.getmtime(logPaths[0])]
+
+        return {'label': prot.getObjLabel(), 'status': prot.getStatus(), 'endTime': str(prot.endTime),
+                'inputs': inputs, 'outputs': outputs, 'log': log, 'render': self._getRenderSettings()}
+
+    def _loadExportCache(self):
+        """ Load the per protocol export of the most recent previous deposition in the project. """
+        previous = None
+        for prot in self.getProject().getRuns():
+            if not isinstance(prot, CryoEMWorkflowViewerDepositor) or prot.getObjId() == self.getObjId():
+                continue
+            cachePath = prot._getExtraPath(self.EXPORT_CACHE)
+            if os.path.exists(cachePath) and (previous is None or os.path.getmtime(cachePath) > os.path.getmtime(previous)):
+                previous = cachePath
+
+        if previous is None:
+            return {}
+        try:
+            entries = list(iterJsonLines(previous))
+            self._previousImagesDir = entries[0]['imagesDir']
+            exportCache = entries[0].get('protocols', {})  # written as a single document by older versions
+            for entry in entries[1:]:
+                exportCache[entry['id']] = entry
+        except (OSError, ValueError, LookupError, AttributeError, TypeError) as e:
+            # empty or truncated by an interrupted deposition, do a full export
+            print('Ignoring unreadable export cache %s: %s' % (previous, e))
+            return {}
+        return exportCache
+
+    def _restoreExport(self, cached, fingerprint):
+        """ Get the cached export of a protocol and its thumbnail renders if its fingerprint
+        did not change, copying its thumbnails and log from the previous deposition archive.
+        The renders are registered, so the next protocols reference the same thumbnails
+        as in a full export. Returns (None, None) if it can not be reused. """
+        # entries without renders come from an older version, their references can not be matched
+        if cached is None or cached['fingerprint'] != fingerprint or 'renders' not in cached:
+            return None, None
+
+        oldDir = self._previousImagesDir
+        newDir = self._getExtraPath(self.DIR_IMAGES)
+        files = []
+
+        def relocate(value):
+            if isinstance(value, dict):
+                return {k: relocate(v) for k, v in value.items()}
+            if isinstance(value, list):
+                return [relocate(v) for v in value]
+            if isinstance(value, str) and value.startswith(oldDir + os.sep):
+                files.append(value)
+                return newDir + value[len(oldDir):]
+            return value
+
+        exported = relocate(cached['export'])
+        previousArchive = os.path.join(os.path.dirname(oldDir), os.path.basename(self._getArchivePath()))
+        arcnames = [os.path.relpath(f, oldDir) for f in files]
+        if not all(self._archive.hasFromZip(previousArchive, arcname) for arcname in arcnames):
+            return None, None
+
+        for arcname in arcnames:
+            self._archive.addFromZip(previousArchive, arcname)
+
+        # failed renders are not in the archive, their next requests fail as in a full export
+        renders = []
+        for renderKey, target in cached['renders']:
+            arcname = os.path.relpath(target, oldDir)
+            target = os.path.join(newDir, arcname)
+            self._renderer.register(renderKey, target, self._archive.hasFromZip(previousArchive, arcname))
+            renders.append((renderKey, target))
+
+        print('Reusing export of %s from previous deposition' % fingerprint['label'])
+        return exported, renders
 
     # --------------- imageSet utils -------------------------
 
     def getOutputDict(self, output):
-        self.outputName = output.getObjName()
+        from datamanager import thumbnails
+        outputName = output.getObjName()
         outputDict = {}
         outputDict[self.OUTPUT_NAME] = output.getObjName()
         outputDict[self.OUTPUT_TYPE] = output.getClassName()
@@ -237,56 +655,75 @@ class CryoEMWorkflowViewerDepositor(EMProtocol):
             count = 0
             if isinstance(output, SetOfCoordinates):
                 coordinatesDict = {}
-                for micrograph in output.getMicrographs(): # get the first three micrographs
-                    count += 1
-                    # apply a low pass filter
-                    args = ' -i %s -o %s --fourier low_pass %f' % (micrograph.getLocation()[1], self._getTmpPath(os.path.basename(micrograph.getFileName())), 0.05)
-                    getEnviron = Domain.importFromPlugin('xmipp3', 'Plugin', doRaise=True).getEnviron
-                    self.runJob('xmipp_transform_filter', args, env=getEnviron())
-                    # save jpg
-                    repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (self.outputName, pwutils.replaceBaseExt(micrograph.getFileName(), 'jpg')))
-                    self._ih.convert(self._getTmpPath(os.path.basename(micrograph.getFileName())), repPath)
-                    coordinatesDict[micrograph.getMicName()] = {'path': repPath, 'Xdim': micrograph.getXDim(), 'Ydim': micrograph.getYDim()}
-
-                    items.append({self.ITEM_REPRESENTATION: repPath})
-                    if count == 3: break;
-
-                for coordinate in output: # for each micrograph, get its coordinates
-                    if coordinate.getMicName() in coordinatesDict:
-                        coordinatesDict[coordinate.getMicName()].setdefault('coords', []).append([coordinate.getX(), coordinate.getY()])
-
-                for micrograph, values in coordinatesDict.items(): # draw coordinates in micrographs jpgs
-                    if 'coords' in values:
-                        image = ImagePIL.open(values['path']).convert('RGB')
-                        W_mic = values['Xdim']
-                        H_mic = values['Ydim']
-                        W_jpg, H_jpg = image.size
-                        draw = ImageDraw.Draw(image)
-                        r = W_jpg / 256
-                        for coord in values['coords']:
-                            x = coord[0] * (W_jpg / W_mic)
-                            y = coord[1] * (H_jpg / H_mic)
-                            draw.ellipse((x - r, y - r, x + r, y + r), fill=(0, 255, 0))
-                        image.save(values['path'], quality=95)
+                # the set of the micrographs protocol may be in use by another export thread, open it again
+                micrographs = SetOfMicrographs(filename=output.getMicrographs().getFileName())
+                try:
+                    for micrograph in micrographs: # get the first three micrographs
+                        count += 1
+                        repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (outputName, pwutils.replaceBaseExt(micrograph.getFileName(), 'jpg')))
+                        coordinatesDict[micrograph.getMicName()] = {'path': repPath, 'fileName': micrograph.getLocation()[1],
+                                                                     'Xdim': micrograph.getXDim(), 'Ydim': micrograph.getYDim(),
+                                                                     'micId': micrograph.getObjId()}
+                        if count == 3: break;
+                finally:
+                    micrographs.close()
+
+                for micrograph, values in coordinatesDict.items(): # apply a low pass filter and draw coordinates in micrographs jpgs
+                    # read only the positions of this micrograph, without building coordinate objects
+                    values['coords'] = metadata.getCoordinates(output.getFileName(), values['micId'])
+                    itemDict = {self.ITEM_REPRESENTATION: values['path']}
+                    self._submitRender(itemDict, micrograph, thumbnails.renderCoordinates,
+                                       values['fileName'], values['path'], (values['Xdim'], values['Ydim']), values['coords'],
+                                       self._getSetting('thumbnailSize'), tmpDir=self._getTmpPath())
+                    items.append(itemDict)
 
             else:
-                for item in output.iterItems():
-                    itemDict = self.getItemDict(item)
+                # In some types get only a limited number of items
+                for item in self._iterSampledItems(output):
+                    itemDict = self.getItemDict(item, outputName)
                     items.append(itemDict)
-                    count += 1
-                    # In some types get only a limited number of items
-                    if (isinstance(item, Micrograph) or isinstance(item, Movie) or isinstance(item, CTFModel)) and count == 3: break;
-                    if isinstance(item, Particle) and count == 15: break;
+
+            try:
+                outputDict[self.OUTPUT_STATS] = metadata.getStatistics(output.getFileName())
+            except Exception as e:
+                print('Cannot obtain statistics of %s: %s' % (output.getObjName(), e))
 
         # If it is a single object then only one item is present
         else:
-            items.append(self.getItemDict(output))
+            items.append(self.getItemDict(output, outputName))
 
         outputDict[self.OUTPUT_ITEMS] = items
 
         return outputDict
 
-    def getItemDict(self, item):
+    def _getItemsLimit(self, item, maxItems=None):
+        """ Maximum number of items of a set to represent, None for all of them. """
+        for itemClass, limit in self.ITEMS_LIMITS:
+            if isinstance(item, itemClass):
+                return limit
+        return self._getSetting('maxItems') if maxItems is None else maxItems
+
+    def _iterSampledItems(self, output):
+        """ Iterate over a sample of the items of a set, with a limited query. """
+        limit = self._getItemsLimit(output.getFirstItem())
+        if limit is None:
+            return output.iterItems()
+
+        ids = None
+        try:
+            if self.samplingMode.get() == self.SAMPLING_RANDOM:
+                ids = metadata.getRandomIds(output.getFileName(), limit)
+            elif self.samplingMode.get() == self.SAMPLING_STRATIFIED:
+                ids = metadata.getStratifiedIds(output.getFileName(), self.STRATIFY_ATTRIBUTE, limit)
+        except Exception as e:
+            print('Cannot sample %s, using its first items: %s' % (output.getObjName(), e))
+
+        if ids is None:
+            return output.iterItems(limit=limit)
+        return output.iterItems(where='id IN (%s)' % ','.join(str(i) for i in ids)) if ids else iter([])
+
+    def getItemDict(self, item, outputName=''):
+        from datamanager import thumbnails
         itemDict = {}
         attributes = item.getAttributes()
         for key, value in attributes:
@@ -297,95 +734,199 @@ class CryoEMWorkflowViewerDepositor(EMProtocol):
         itemDict[self.ITEM_ID] = item.getObjId()
 
         try:
-            # Get item representation
+            # Get item representation, it is rendered by self._renderer
             if isinstance(item, Class2D):
                 # use representative as item representation
-                repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s_%s' % (self.outputName, item.getRepresentative().getIndex(), pwutils.replaceBaseExt(item.getRepresentative().getFileName(), 'jpg')))
+                repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s_%s' % (outputName, item.getRepresentative().getIndex(), pwutils.replaceBaseExt(item.getRepresentative().getFileName(), 'jpg')))
                 itemPath = item.getRepresentative().getLocation()
-                self._ih.convert(itemPath, repPath)
-
-                if '_size' in itemDict:  # write number of particles over the class
-                    text = itemDict['_size'] + ' ptcls'
-                    image = ImagePIL.open(repPath).convert('RGB')
-                    W, H = image.size
-                    draw = ImageDraw.Draw(image)
-                    draw.text((5, H - 15), text, fill=(0, 255, 0))
-                    image.save(repPath, quality=95)
-
+                # write number of particles over the class
+                text = itemDict['_size'] + ' ptcls' if '_size' in itemDict else None
                 itemDict[self.ITEM_REPRESENTATION] = repPath
+                self._submitRender(itemDict, item, thumbnails.renderImage, itemPath, repPath, text, self._getSetting('thumbnailSize'))
 
             elif isinstance(item, Class3D):
                 # Get all slices in x,y and z directions of representative to represent the class
-                repDir = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (self.outputName, pwutils.removeBaseExt(item.getRepresentative().getFileName())))
-                pwutils.makePath(repDir)
-                if item.getFileName().endswith('.mrc'):
-                    item.setFileName(item.getFileName() + ':mrc')
-                I = emlib.Image(item.getRepresentative().getFileName())
-                I.writeSlices(os.path.join(repDir, 'slicesX'), 'jpg', 'X')
-                I.writeSlices(os.path.join(repDir, 'slicesY'), 'jpg', 'Y')
-                I.writeSlices(os.path.join(repDir, 'slicesZ'), 'jpg', 'Z')
-
-                if '_size' in itemDict: # write number of particles over a class image
-                    text = itemDict['_size'] + ' ptcls'
-                    image = ImagePIL.open(os.path.join(repDir, 'slicesX_0000.jpg')).convert('RGB')
-                    W, H = image.size
-                    draw = ImageDraw.Draw(image)
-                    draw.text((5, H - 15), text, fill=(0, 255, 0))
-                    image.save(os.path.join(repDir, 'slicesX_0000.jpg'), quality=95)
-
+                repDir = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (outputName, pwutils.removeBaseExt(item.getRepresentative().getFileName())))
+                # write number of particles over a class image
+                text = itemDict['_size'] + ' ptcls' if '_size' in itemDict else None
                 itemDict[self.ITEM_REPRESENTATION] = repDir
+                self._submitVolumeRender(itemDict, item, item.getRepresentative().getFileName(), repDir, text)
 
             elif isinstance(item, Volume):
                 # Get all slices in x,y and z directions to represent the volume
-                repDir = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (self.outputName, pwutils.removeBaseExt(item.getFileName())))
-                pwutils.makePath(repDir)
-                if item.getFileName().endswith('.mrc'):
-                    item.setFileName(item.getFileName() + ':mrc')
-                I = emlib.Image(item.getFileName())
-                I.writeSlices(os.path.join(repDir,'slicesX'), 'jpg', 'X')
-                I.writeSlices(os.path.join(repDir, 'slicesY'), 'jpg', 'Y')
-                I.writeSlices(os.path.join(repDir, 'slicesZ'), 'jpg', 'Z')
-
+                repDir = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (outputName, pwutils.removeBaseExt(item.getFileName())))
                 itemDict[self.ITEM_REPRESENTATION] = repDir
+                self._submitVolumeRender(itemDict, item, item.getFileName(), repDir)
 
             elif isinstance(item, Image):
                 # use Location as item representation
-                repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s_%s' % (self.outputName, item.getIndex(), pwutils.replaceBaseExt(item.getFileName(), 'jpg')))
+                repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s_%s' % (outputName, item.getIndex(), pwutils.replaceBaseExt(item.getFileName(), 'jpg')))
                 itemPath = item.getLocation()
+                itemDict[self.ITEM_REPRESENTATION] = repPath
                 # apply a low pass filter
                 if item.getFileName().endswith('.stk'):
-                    self._ih.convert(itemPath[1], repPath)
+                    self._submitRender(itemDict, item, thumbnails.renderImage, itemPath, repPath, None, self._getSetting('thumbnailSize'))
                 else:
-                    args = ' -i %s -o %s --fourier low_pass %f' % (itemPath[1], self._getTmpPath(os.path.basename(item.getFileName())), 0.05)
-                    getEnviron = Domain.importFromPlugin('xmipp3', 'Plugin', doRaise=True).getEnviron
-                    self.runJob('xmipp_transform_filter', args, env=getEnviron())
-                    self._ih.convert(self._getTmpPath(os.path.basename(item.getFileName())), repPath)
-                itemDict[self.ITEM_REPRESENTATION] = repPath
+                    self._submitRender(itemDict, item, thumbnails.renderFiltered, itemPath, repPath,
+                                       LOW_PASS_CUTOFF, self._getSetting('thumbnailSize'), tmpDir=self._getTmpPath())
 
             elif isinstance(item, CTFModel):
                 # if exists use ctfmodel_quadrant as item representation, in other case use psdFile
                 if item.hasAttribute('_xmipp_ctfmodel_quadrant'):
-                    repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (self.outputName, pwutils.replaceBaseExt(str(item._xmipp_ctfmodel_quadrant), 'jpg')))
+                    repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (outputName, pwutils.replaceBaseExt(str(item._xmipp_ctfmodel_quadrant), 'jpg')))
                     itemPath = str(item._xmipp_ctfmodel_quadrant)
 
                 else:
-                    repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (self.outputName, pwutils.replaceBaseExt(item.getPsdFile(), 'jpg')))
+                    repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (outputName, pwutils.replaceBaseExt(item.getPsdFile(), 'jpg')))
                     itemPath = item.getPsdFile()
 
-                self._ih.convert(itemPath, repPath)
                 itemDict[self.ITEM_REPRESENTATION] = repPath
+                self._submitRender(itemDict, item, thumbnails.renderImage, itemPath, repPath, None, self._getSetting('thumbnailSize'))
 
             else:
                 # in any other case look for a representation on attributes
                 for key, value in attributes:
                     if os.path.exists(str(value)):
-                        repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (self.outputName, pwutils.replaceBaseExt(str(value), 'png')))
+                        repPath = self._getExtraPath(self.DIR_IMAGES, '%s_%s' % (outputName, pwutils.replaceBaseExt(str(value), 'png')))
                         itemPath = str(value)
-                        self._ih.convert(itemPath, repPath)
                         itemDict[self.ITEM_REPRESENTATION] = repPath
+                        self._submitRender(itemDict, item, thumbnails.renderImage, itemPath, repPath, None, self._getSetting('thumbnailSize'))
                         break
 
         except Exception as e:
             print('Cannot obtain item representation for %s' % str(item))
+            itemDict.pop(self.ITEM_REPRESENTATION, None)
+
+        return itemDict
+
+    # --------------- estimation utils -------------------------
 
-        return itemDict
\ No newline at end of file
+    def _describeWorkflow(self):
+        """ Outputs (as estimate.OutputInfo) and log sizes of the protocols to deposit, from their metadata. """
+        outputs, logSizes = [], []
+        workflowProts = self._getWorkflowProtocols()
+        for prot in workflowProts:
+            logPath = list(prot.getLogPaths())[0]
+            if os.path.exists(logPath):
+                logSizes.append(os.path.getsize(logPath))
+            for a, output in prot.iterOutputAttributes():
+                try:
+                    outputs.append(self._describeOutput(output))
+                except Exception as e:
+                    print('Cannot describe %s: %s' % (output.getObjName(), e))
+                if isinstance(output, Set):
+                    output.close()
+        return outputs, logSizes, len(workflowProts)
+
+    def _describeOutput(self, output):
+        """ What would be represented of an output. """
+        if isinstance(output, SetOfCoordinates):
+            micrographs = output.getMicrographs()
+            return estimate.OutputInfo(estimate.KIND_COORDINATES, micrographs.getSize(), 3, micrographs.getDimensions())
+        if isinstance(output, Set):
+            item = output.getFirstItem() if output.getSize() else None
+            if item is None:
+                return estimate.OutputInfo(estimate.KIND_NONE, 0)
+            return self._describeItem(item, output.getSize(), self._getItemsLimit(item, estimate.MAX_ITEMS))
+        return self._describeItem(output, 1)
+
+    def _describeItem(self, item, size, limit=None):
+        kind, dims = estimate.KIND_NONE, None
+        if isinstance(item, Class2D):
+            kind, dims = estimate.KIND_IMAGE, item.getRepresentative().getDim()
+        elif isinstance(item, Class3D):
+            kind, dims = estimate.KIND_VOLUME, item.getRepresentative().getDim()
+        elif isinstance(item, Volume):
+            kind, dims = estimate.KIND_VOLUME, item.getDim()
+        elif isinstance(item, Image):
+            kind = estimate.KIND_IMAGE if item.getFileName().endswith('.stk') else estimate.KIND_FILTERED
+            dims = item.getDim()
+        elif isinstance(item, CTFModel):
+            kind = estimate.KIND_IMAGE
+        return estimate.OutputInfo(kind, size, limit, dims)
+
+    def _getSetting(self, key):
+        """ Value of a parameter that changes the cost of the deposition, unless it was capped by estimateStep. """
+        if not hasattr(self, '_caps'):
+            self._caps = json.loads(self.estimation.get())['capped'] if self.estimation.get() else {}
+        return self._caps.get(key, getattr(self, key).get())
+
+    def _getEstimateSettings(self):
+        """ Parameters that change the cost of the deposition. """
+        return {'thumbnailSize': self.thumbnailSize.get(), 'maxItems': self.maxItems.get(),
+                'volumeSlices': self.volumeSlices.get(), 'numberOfSlices': self.numberOfSlices.get(),
+                'volumeProjections': self.volumeProjections.get(), 'logMaxSize': self.logMaxSize.get()}
+
+    def _getCheaperSettings(self, settings):
+        """ The next cheaper settings, None if there are not. """
+        cheaper = dict(settings)
+        if settings['volumeSlices'] == self.VOLUME_ALL_SLICES:
+            cheaper['volumeSlices'] = self.VOLUME_MONTAGE
+        elif settings['volumeProjections']:
+            cheaper['volumeProjections'] = False
+        elif settings['maxItems'] > self.MIN_ITEMS:
+            cheaper['maxItems'] = max(self.MIN_ITEMS, settings['maxItems'] // 2)
+        elif settings['thumbnailSize'] > self.MIN_THUMBNAIL_SIZE:
+            cheaper['thumbnailSize'] = max(self.MIN_THUMBNAIL_SIZE, settings['thumbnailSize'] // 2)
+        elif not settings['logMaxSize'] or settings['logMaxSize'] > self.MIN_LOG_SIZE:
+            cheaper['logMaxSize'] = self.MIN_LOG_SIZE
+        else:
+            return None
+        return cheaper
+
+    def _estimate(self, workflow, settings):
+        outputs, logSizes, protocols = workflow
+        volumeModes = {self.VOLUME_ALL_SLICES: 'all', self.VOLUME_SLICES: 'slices', self.VOLUME_MONTAGE: 'montage'}
+        return estimate.estimateDeposition(outputs, logSizes, protocols,
+                                           {'thumbnailSize': settings['thumbnailSize'], 'maxItems': settings['maxItems'],
+                                            'volumeMode': volumeModes[settings['volumeSlices']],
+                                            'numberOfSlices': settings['numberOfSlices'],
+                                            'projections': settings['volumeProjections'],
+                                            'logMaxSize': settings['logMaxSize'] * 1024 * 1024},
+                                           self.numberOfThreads.get(), self._getUploadSpeed())
+
+    def _getUploadSpeed(self):
+        """ Speed of the previous uploads of the project. """
+        uploads = []
+        for prot in self.getProject().getRuns():
+            if isinstance(prot, CryoEMWorkflowViewerDepositor) and prot.getObjId() != self.getObjId():
+                metrics = loadMetrics(prot._getExtraPath(METRICS_FILE))
+                if metrics is not None:
+                    uploads += metrics.getRecords('uploads')
+        return estimate.getUploadSpeed(uploads)
+
+    def _exceedsCaps(self, result):
+        return bool((self.maxThumbnails.get() and result.thumbnails > self.maxThumbnails.get()) or
+                    (self.maxUploadSize.get() and result.getUploadBytes() > self.maxUploadSize.get() * 1024 * 1024))
+
+    def _formatEstimate(self, result):
+        return '%d thumbnails of %d items, render ~%0.0f s, archive ~%s, upload ~%s in ~%0.0f s' \
+               % (result['thumbnails'], result['items'], result['renderSeconds'],
+                  formatSize(result['archiveBytes']), formatSize(result['uploadBytes']),
+                  result['uploadSeconds'])
+
+    def _getWorkflowPath(self):
+        return self._getExtraPath(self.OUTPUT_WORKFLOW + ('.gz' if self.compressJson else ''))
+
+    def _getArchivePath(self):
+        return self._getExtraPath(pwutils.replaceBaseExt(self.DIR_IMAGES, 'zip'))
+
+    def _submitRender(self, itemDict, item, func, *args, **kwargs):
+        self._defer(self._renderer.submit, itemDict, self.ITEM_REPRESENTATION, str(item), func, *args, **kwargs)
+
+    def _submitVolumeRender(self, itemDict, item, fileName, repDir, text=None):
+        from datamanager import thumbnails
+        if self._getSetting('volumeSlices') == self.VOLUME_ALL_SLICES:
+            self._submitRender(itemDict, item, thumbnails.renderSlices, fileName, repDir, text)
+        else:
+            self._submitRender(itemDict, item, thumbnails.renderVolume, fileName, repDir, text, self._getSetting('numberOfSlices'),
+                               self._getSetting('volumeSlices') == self.VOLUME_MONTAGE, self._getSetting('volumeProjections'),
+                               self._getSetting('thumbnailSize'))
+
+    def _defer(self, func, *args, **kwargs):
+        """ Call func now or, within an export task, when the main thread assembles its result. """
+        deferred = getattr(self._exportLocal, 'deferred', None)
+        if deferred is None:
+            func(*args, **kwargs)
+        else:
+            deferred.append((func, args, kwargs))
@@ -24,9 +24,17 @@
 # *
 # **************************************************************************
 
+import os
+import json
+import time
+from fnmatch import fnmatch
 from pwem.protocols import EMProtocol
+from pwem.objects import Movie, SetOfMovies, EMFile
 from pyworkflow.protocol import params
-from subprocess import STDOUT, PIPE, Popen
+from pyworkflow.object import Integer, Set
+
+from datamanager.metrics import Metrics, loadMetrics, formatSize, METRICS_FILE
+from datamanager.objects import SetOfOnedataFiles
 
 class OnedataDownloader(EMProtocol):
     """
@@ -34,8 +42,19 @@ class OnedataDownloader(EMProtocol):
     """
     _label = 'Onedata downloader'
 
+    DOWNLOAD_ERRORS = 'download_errors.json'
+
+    OUTPUT_NONE = 0
+    OUTPUT_MOVIES = 1
+    OUTPUT_FILES = 2
+    OUTPUT_NAMES = {OUTPUT_MOVIES: 'outputMovies', OUTPUT_FILES: 'outputFiles'}
+    OUTPUT_UPDATE_INTERVAL = 30  # seconds between updates of the streaming output
+
     def __init__(self, **kwargs):
         EMProtocol.__init__(self, **kwargs)
+        self.downloadedFiles = Integer(0)
+        self.skippedFiles = Integer(0)
+        self.savedBytes = Integer(0)
 
     # --------------- DEFINE param functions ---------------
 
@@ -44,6 +63,36 @@ class OnedataDownloader(EMProtocol):
         form.addParam('dataID', params.StringParam, label='Onedata space/folder/file ID', help='Onedata space, forder or file ID you want to download.')
         form.addParam('onezone', params.StringParam, label='Onezone URL', help='Onedata Onezone URL with specified protocol (ie: https://datahub.egi.eu)')
         form.addParam('downloadPath', params.PathParam, label='Download path', help='Specify the path where you want to download the data.')
+        form.addParam('sync', params.BooleanParam, label='Only download new or changed files?', default=True,
+                      help='Files already in the download path with the same size, modification time (and checksum, '
+                           'if Onedata provides it) are skipped and partially downloaded files are resumed.')
+
+        form.addParam('bandwidthLimit', params.FloatParam, label='Bandwidth limit (MB/s)', default=0,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Maximum total download throughput, so the link is not saturated. 0 means no limit.')
+
+        form.addSection(label='Output')
+        form.addParam('outputType', params.EnumParam, label='Output', default=self.OUTPUT_NONE,
+                      choices=['None', 'Movies', 'Files'], display=params.EnumParam.DISPLAY_HLIST,
+                      help='Register the downloaded files as an output set. It is open (streaming) while downloading '
+                           'and files are added as soon as they are downloaded and verified, so following protocols '
+                           '(e.g. motion correction) can start processing them before the download finishes.')
+        form.addParam('filesPattern', params.StringParam, label='Files pattern', default='',
+                      condition='outputType != %d' % self.OUTPUT_NONE,
+                      help='Only files whose name match this pattern (e.g. *.tif) are added to the output. '
+                           'Leave it empty to add all of them.')
+        form.addParam('samplingRate', params.FloatParam, label='Pixel size (A/px)', default=1.0,
+                      condition='outputType == %d' % self.OUTPUT_MOVIES)
+        form.addParam('voltage', params.FloatParam, label='Voltage (kV)', default=300,
+                      condition='outputType == %d' % self.OUTPUT_MOVIES)
+        form.addParam('sphericalAberration', params.FloatParam, label='Spherical aberration (mm)', default=2.7,
+                      condition='outputType == %d' % self.OUTPUT_MOVIES)
+        form.addParam('amplitudeContrast', params.FloatParam, label='Amplitude contrast', default=0.1,
+                      condition='outputType == %d' % self.OUTPUT_MOVIES)
+        form.addParam('dosePerFrame', params.FloatParam, label='Dose per frame (e/A^2)', default=0.0,
+                      condition='outputType == %d' % self.OUTPUT_MOVIES)
+
+        form.addParallelSection(threads=4, mpi=0)
 
     # --------------- INSERT steps functions ----------------
 
@@ -53,16 +102,113 @@ class OnedataDownloader(EMProtocol):
     # --------------- STEPS functions -----------------------
 
     def downloadDataStep(self):
-        p = Popen('cd {} && curl -s https://raw.githubusercontent.com/CERIT-SC/onedata-downloader/master/download.py | python3 - --onezone {} {}'.format(str(self.downloadPath), str(self.onezone) if str(self.onezone) != '' else 'https://datahub.egi.eu', str(self.dataID)), stdout=PIPE, stderr=STDOUT, shell=True)
-        while True:
-            output = p.stdout.readline().decode('utf-8')
-            if output == '' and p.poll() is not None:
-                break
-            if output:
-                l = output.rstrip()
-                print(l, flush=True)
-                if 'fail' in l and 'to process directory' not in l:
-                    raise Exception(l)
+        from datamanager import onedata, transfer
+        workers = self.numberOfThreads.get()
+        client = onedata.OnedataClient(self.onezone.get(), transfer.createSession(workers))
+        self._metrics = Metrics()
+
+        # list the whole tree once and download the files concurrently
+        with self._metrics.timer('stages', 'list'):
+            files, errors = client.listTree(str(self.dataID))
+        self._metrics.add('listedFiles', len(files))
+        manifest = None
+        skipped = []
+        if self.sync:
+            # only new or changed files, completing partial ones
+            manifest = onedata.DownloadManifest(str(self.downloadPath))
+            upToDate = {f.path for f in files if manifest.isUpToDate(f)}
+            files, skipped = [f for f in files if f.path not in upToDate], [f for f in files if f.path in upToDate]
+            self.skippedFiles.set(len(skipped))
+            self.savedBytes.set(sum(int(f.size or 0) for f in skipped))
+        print('%d files to download' % len(files), flush=True)
+        # files already downloaded go to the output from the beginning
+        self._pendingOutput = [f for f in skipped if self._isOutputFile(f)]
+        self._outputPaths = None
+        self._lastOutputUpdate = 0
+        with self._metrics.timer('stages', 'download'):
+            errors += onedata.downloadFiles(client, files, str(self.downloadPath), workers, self._onFileDownloaded, manifest,
+                                            self.bandwidthLimit.get() * 1024 * 1024)
+        self._updateOutput(Set.STREAM_CLOSED)
+        self._store()
+        self._metrics.add('errors', len(errors))
+        self._metrics.save(self._getExtraPath(METRICS_FILE))
+
+        with open(self._getExtraPath(self.DOWNLOAD_ERRORS), 'w') as f:
+            json.dump([e.toDict() for e in errors], f, indent=4)
+        if errors:
+            raise Exception('%d files could not be downloaded (see %s):\n%s'
+                            % (len(errors), self._getExtraPath(self.DOWNLOAD_ERRORS), '\n'.join(str(e) for e in errors[:10])))
+
+    def _onFileDownloaded(self, onedataFile, size, resumedBytes, seconds):
+        print('Downloaded %s (%s%s)' % (onedataFile.path, formatSize(size),
+                                        ', resumed at %s' % formatSize(resumedBytes) if resumedBytes else ''), flush=True)
+        self._metrics.add('downloadedBytes', size - resumedBytes)
+        self._metrics.record('files', path=onedataFile.path, size=size, resumedBytes=resumedBytes, seconds=seconds,
+                             throughput=(size - resumedBytes) / seconds if seconds > 0 else None)
+        self.downloadedFiles.increment()
+        self.savedBytes.set(self.savedBytes.get() + resumedBytes)
+        if self._isOutputFile(onedataFile):
+            self._pendingOutput.append(onedataFile)
+        if time.time() - self._lastOutputUpdate > self.OUTPUT_UPDATE_INTERVAL:
+            self._updateOutput(Set.STREAM_OPEN)
+
+    # --------------- streaming output -----------------------
+
+    def _isOutputFile(self, onedataFile):
+        pattern = self.filesPattern.get()
+        return self.outputType.get() != self.OUTPUT_NONE and (not pattern or fnmatch(os.path.basename(onedataFile.path), pattern))
+
+    def _loadOutputSet(self):
+        """ Open the output set to append items, creating it the first time.
+        The paths already in it (e.g. added by a previous run) are read once. """
+        outputName = self.OUTPUT_NAMES[self.outputType.get()]
+        setFile = self._getPath('%s.sqlite' % outputName)
+        SetClass = SetOfMovies if self.outputType.get() == self.OUTPUT_MOVIES else SetOfOnedataFiles
+        if os.path.exists(setFile):
+            outputSet = SetClass(filename=setFile)
+            outputSet.loadAllProperties()
+            if self._outputPaths is None:
+                self._outputPaths = {item.getFileName() for item in outputSet.iterItems()}
+            outputSet.enableAppend()
+        else:
+            self._outputPaths = set()
+            outputSet = SetClass(filename=setFile)
+            outputSet.setStreamState(Set.STREAM_OPEN)
+            if self.outputType.get() == self.OUTPUT_MOVIES:
+                outputSet.setSamplingRate(self.samplingRate.get())
+                acquisition = outputSet.getAcquisition()
+                acquisition.setVoltage(self.voltage.get())
+                acquisition.setSphericalAberration(self.sphericalAberration.get())
+                acquisition.setAmplitudeContrast(self.amplitudeContrast.get())
+                acquisition.setDosePerFrame(self.dosePerFrame.get())
+        return outputName, outputSet
+
+    def _updateOutput(self, state):
+        """ Add the files downloaded since the last update to the output set, unless they are already in it. """
+        self._lastOutputUpdate = time.time()
+        if self.outputType.get() == self.OUTPUT_NONE or (not self._pendingOutput and state == Set.STREAM_OPEN):
+            return
+        outputName, outputSet = self._loadOutputSet()
+        for onedataFile in self._pendingOutput:
+            path = os.path.abspath(os.path.join(str(self.downloadPath), onedataFile.path))
+            if path in self._outputPaths:
+                continue
+            self._outputPaths.add(path)
+            if self.outputType.get() == self.OUTPUT_MOVIES:
+                item = Movie(location=path)
+                item.setMicName(os.path.basename(path))
+                item.setSamplingRate(self.samplingRate.get())
+                item.setAcquisition(outputSet.getAcquisition())
+                if outputSet.getSize() == 0:
+                    from pwem.emlib.image import ImageHandler
+                    x, y, z, n = ImageHandler().getDimensions(path)
+                    outputSet.setFramesRange([1, max(z, n), 1])
+                item.setFramesRange(outputSet.getFramesRange())
+            else:
+                item = EMFile(filename=path)
+            outputSet.append(item)
+        self._pendingOutput = []
+        self._updateOutputSet(outputName, outputSet, state)
 
     # --------------- INFO functions -------------------------
 
@@ -76,6 +222,22 @@ class OnedataDownloader(EMProtocol):
 
     def _summary(self):
         summary = []
+        if self.downloadedFiles.get() or self.skippedFiles.get():
+            summary.append('%d files downloaded, %d already up to date' % (self.downloadedFiles, self.skippedFiles))
+        if self.savedBytes.get():
+            summary.append('%s not downloaded again thanks to the sync' % formatSize(self.savedBytes.get()))
+        errorsPath = self._getExtraPath(self.DOWNLOAD_ERRORS)
+        if os.path.exists(errorsPath):
+            with open(errorsPath) as f:
+                errors = json.load(f)
+            if errors:
+                summary.append('%d files could not be downloaded, see %s' % (len(errors), errorsPath))
+        metrics = loadMetrics(self._getExtraPath(METRICS_FILE))
+        if metrics is not None:
+            downloaded, seconds = metrics.get('downloadedBytes'), metrics.getTime('stages', 'download')
+            summary.append('Listing took %0.1f s, downloading %s took %0.1f s (%s/s), metrics in %s'
+                           % (metrics.getTime('stages', 'list'), formatSize(downloaded), seconds,
+                              formatSize(downloaded / max(seconds, 1e-3)), metrics.path))
         return summary
 
     def _methods(self):
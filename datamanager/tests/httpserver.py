@@ -0,0 +1,72 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Local stand-ins of the remote services, served by http.server in a thread.
+"""
+
+import http.server
+import threading
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """ Keep-alive request handler, the served state is in self.server. """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def readBody(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def reply(self, code, body=b'', headers=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+class LocalServer(http.server.ThreadingHTTPServer):
+    """ Server on a free local port, running in a daemon thread until closed. """
+    daemon_threads = True
+
+    def __init__(self, handlerClass):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), handlerClass)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.requests = []  # (method, path, headers) of every request
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def log(self, handler):
+        with self._lock:
+            self.requests.append((handler.command, handler.path, dict(handler.headers)))
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
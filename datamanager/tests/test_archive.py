@@ -0,0 +1,74 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+from zipfile import ZipFile
+
+from datamanager.archive import ThumbnailsArchive
+
+
+class TestThumbnailsArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rootDir = os.path.join(self.tmpDir, 'images')
+        os.makedirs(self.rootDir)
+        self.previous = os.path.join(self.tmpDir, 'previous.zip')
+        with ZipFile(self.previous, 'w') as previous:
+            previous.writestr('shared.jpg', b'old')
+            previous.writestr('restored.jpg', b'restored')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeFile(self, name, content):
+        path = os.path.join(self.rootDir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def testProducedFilesWin(self):
+        """ A file produced again replaces the copy from the previous archive, even if requested before. """
+        archive = ThumbnailsArchive(os.path.join(self.tmpDir, 'new.zip'), self.rootDir)
+        self.assertTrue(archive.hasFromZip(self.previous, 'shared.jpg'))
+        self.assertFalse(archive.hasFromZip(self.previous, 'missing.jpg'))
+        archive.addFromZip(self.previous, 'shared.jpg')
+        archive.addFromZip(self.previous, 'restored.jpg')
+        archive.add(self.writeFile('shared.jpg', b'new'))
+        archive.close()
+
+        with ZipFile(archive.zipPath) as result:
+            self.assertEqual(sorted(result.namelist()), ['restored.jpg', 'shared.jpg'])
+            self.assertEqual(result.read('shared.jpg'), b'new')
+            self.assertEqual(result.read('restored.jpg'), b'restored')
+        self.assertEqual(archive.files, 2)
+        # the kept files are not overwritten by the old copies
+        with open(os.path.join(self.rootDir, 'shared.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+        self.assertTrue(os.path.exists(os.path.join(self.rootDir, 'restored.jpg')))
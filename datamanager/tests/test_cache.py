@@ -0,0 +1,140 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from datamanager import cache
+from datamanager.cache import ThumbnailCache
+
+
+class TestThumbnailCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cache = ThumbnailCache(os.path.join(self.tmpDir, 'cache'), 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeFile(self, name, content):
+        path = os.path.join(self.tmpDir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def storeEntry(self, name, size, age):
+        """ Store a thumbnail of size bytes whose entry was last used age seconds ago. """
+        key = self.cache.getKey([self.writeFile(name + '.mrc', name.encode())], [name])
+        self.cache.store(key, self.writeFile(name + '.jpg', b'x' * size))
+        when = time.time() - age
+        os.utime(self.cache._getEntryPath(key), (when, when))
+        return key
+
+    def testKeyInvalidation(self):
+        source = self.writeFile('mic.mrc', b'1234')
+        key = self.cache.getKey([source], ['renderFiltered', 512])
+        self.assertEqual(self.cache.getKey([source], ['renderFiltered', 512]), key)
+        # other parameters
+        self.assertNotEqual(self.cache.getKey([source], ['renderFiltered', 256]), key)
+        # the source is rewritten with another size or modification time
+        st = os.stat(source)
+        os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        touchedKey = self.cache.getKey([source], ['renderFiltered', 512])
+        self.assertNotEqual(touchedKey, key)
+        self.writeFile('mic.mrc', b'12345')
+        os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertNotIn(self.cache.getKey([source], ['renderFiltered', 512]), (key, touchedKey))
+
+    def testMissingSource(self):
+        source = self.writeFile('mic.mrc', b'1234')
+        self.assertIsNone(self.cache.getKey([source, os.path.join(self.tmpDir, 'missing.mrc')], []))
+        self.assertIsNone(self.cache.getKey([(2, os.path.join(self.tmpDir, 'missing.mrcs'))], []))
+
+    def testStoreAndRestore(self):
+        key = self.cache.getKey([self.writeFile('mic.mrc', b'1234')], [])
+        target = os.path.join(self.tmpDir, 'restored.jpg')
+        self.assertFalse(self.cache.restore(key, target))
+        self.cache.store(key, self.writeFile('mic.jpg', b'thumbnail'))
+        self.assertTrue(self.cache.restore(key, target))
+        self.assertEqual(self.read(target), b'thumbnail')
+
+        # folders, e.g. volume slices
+        folder = os.path.join(self.tmpDir, 'slices')
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'slice_0.jpg'), 'wb') as f:
+            f.write(b'slice')
+        self.cache.store('folderkey', folder)
+        target = os.path.join(self.tmpDir, 'restoredSlices')
+        self.assertTrue(self.cache.restore('folderkey', target))
+        self.assertEqual(self.read(os.path.join(target, 'slice_0.jpg')), b'slice')
+
+    def testPruneLeastRecentlyUsed(self):
+        oldest = self.storeEntry('oldest', 400, 300)
+        old = self.storeEntry('old', 400, 200)
+        recent = self.storeEntry('recent', 400, 100)
+        # restoring an entry marks it as recently used
+        self.assertTrue(self.cache.restore(oldest, os.path.join(self.tmpDir, 'restored.jpg')))
+
+        self.cache.prune()
+        exists = lambda key: os.path.exists(self.cache._getEntryPath(key))
+        self.assertFalse(exists(old))
+        self.assertTrue(exists(recent))
+        self.assertTrue(exists(oldest))
+        self.assertLessEqual(cache.getSize(self.cache.path), self.cache.maxSize)
+
+        self.cache.maxSize = 500
+        self.cache.prune()
+        self.assertFalse(exists(recent))
+        self.assertTrue(exists(oldest))
+
+    def testConcurrentStore(self):
+        """ If another process stores the same entry first, its thumbnail is kept. """
+        key = self.cache.getKey([self.writeFile('mic.mrc', b'1234')], [])
+        rename = os.rename
+
+        def renameAfterOther(src, dst):
+            other = self.writeFile('other.jpg', b'other')
+            os.makedirs(dst)
+            shutil.copyfile(other, os.path.join(dst, cache.ENTRY_DATA))
+            rename(src, dst)
+
+        with mock.patch.object(cache.os, 'rename', side_effect=renameAfterOther):
+            self.cache.store(key, self.writeFile('mine.jpg', b'mine'))
+
+        entry = self.cache._getEntryPath(key)
+        self.assertEqual(os.listdir(os.path.dirname(entry)), [key])  # no temporary entries left
+        target = os.path.join(self.tmpDir, 'restored.jpg')
+        self.assertTrue(self.cache.restore(key, target))
+        self.assertEqual(self.read(target), b'other')
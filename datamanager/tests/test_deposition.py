@@ -0,0 +1,165 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from zipfile import ZipFile
+
+import pyworkflow as pw
+from pwem.objects import Micrograph
+from pwem.protocols import ProtImportCoordinates, ProtImportMicrographs, ProtImportParticles
+
+from datamanager.benchmark import SyntheticProject
+
+
+class TestDeposition(unittest.TestCase):
+    """ The deposition export of a small synthetic project, without uploading it. """
+
+    def setUp(self):
+        if pw.Config.getDomain() is None:  # set by scipion when it runs the tests
+            pw.Config.setDomain('pwem')
+        self.cwd = os.getcwd()
+        self.tmpDir = tempfile.mkdtemp()
+        self.args = argparse.Namespace(protocols=8, micrographs=3, mic_size=256, coordinates=20, particles=20, box=32,
+                                       volume_size=16, log_size=0.01, threads=2, cache=False)
+        self.synthetic = SyntheticProject(self.tmpDir, self.args)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.synthetic.removeLink()
+        shutil.rmtree(self.tmpDir)
+
+    def readWorkflow(self, dep):
+        with open(dep._getExtraPath(dep.OUTPUT_WORKFLOW)) as f:
+            return json.load(f)
+
+    def testParallelExport(self):
+        self.synthetic.generate()
+        dep = self.synthetic.newDepositor()
+        dep.createDepositionStep()
+
+        # the coordinates of both chains describe their input micrographs
+        inputs = [p['summary'] for p in self.readWorkflow(dep) if 'Input:' in p['summary']]
+        self.assertEqual(len(inputs), 2)
+        for summary in inputs:
+            self.assertIn('Micrographs (3 items', summary)
+
+        # export threads load their own copy of the protocols, so the sets they read are not shared
+        coordinates = next(p for p in self.synthetic.project.getRuns() if isinstance(p, ProtImportCoordinates))
+        copy, mapper = dep._loadProtocol(coordinates.getObjId())
+        try:
+            self.assertIsNot(copy.inputMicrographs.get(), coordinates.inputMicrographs.get())
+            self.assertEqual(copy.inputMicrographs.get().getFileName(), coordinates.inputMicrographs.get().getFileName())
+        finally:
+            mapper.close()
+
+    def testRepeatedDepositions(self):
+        self.args.protocols = 2
+        self.synthetic.generate()
+        workflowIds = sorted(str(p.getObjId()) for p in self.synthetic.project.getRuns())
+        for i in range(3):
+            dep = self.synthetic.newDepositor()
+            dep.createDepositionStep()
+            # the previous depositions are not workflow steps
+            self.assertEqual(sorted(p['object.id'] for p in self.readWorkflow(dep)), workflowIds)
+            self.assertEqual(dep._describeWorkflow()[2], len(workflowIds))
+
+    def getRepresentations(self, dep, prot):
+        protDict = next(p for p in self.readWorkflow(dep) if p['object.id'] == str(prot.getObjId()))
+        return [item.get(dep.ITEM_REPRESENTATION) for output in protDict['output'] for item in output[dep.OUTPUT_ITEMS]]
+
+    def testStackThumbnails(self):
+        self.args.protocols = 3  # micrographs, coordinates and particles
+        self.synthetic.generate()
+        dep = self.synthetic.newDepositor()
+        dep.createDepositionStep()
+
+        # the particles of one stack are different images, they do not share a thumbnail
+        particles = next(p for p in self.synthetic.project.getRuns() if isinstance(p, ProtImportParticles))
+        representations = self.getRepresentations(dep, particles)
+        self.assertGreater(len(representations), 1)
+        self.assertEqual(len(set(representations)), len(representations))
+        self.assertEqual(dep._metrics.get('sharedThumbnails'), 0)
+
+    def testIncrementalSharedThumbnails(self):
+        self.args.protocols = 1
+        self.synthetic.generate()
+        self.synthetic.newDepositor().createDepositionStep()
+
+        # a new protocol with the same micrographs as the one restored from the previous deposition
+        prot = self.synthetic._newProtocol(ProtImportMicrographs, 'shared')
+        micSet = prot._createSetOfMicrographs()
+        micSet.setSamplingRate(self.synthetic.micrographs.getSamplingRate())
+        for mic in self.synthetic.micrographs:
+            micSet.append(Micrograph(location=mic.getFileName()))
+        self.synthetic._finish(prot, outputMicrographs=micSet)
+
+        dep = self.synthetic.newDepositor()
+        dep.createDepositionStep()
+        self.assertEqual([r['restored'] for r in dep._metrics.getRecords('protocols')], [True, False])
+        # as in a full export, it references the restored thumbnails instead of rendering its own
+        restored = self.getRepresentations(dep, self.synthetic.micrographsProt)
+        self.assertEqual(self.getRepresentations(dep, prot), restored)
+        with ZipFile(dep._getArchivePath()) as archive:
+            thumbnails = [n for n in archive.namelist() if n.endswith('.jpg')]
+        self.assertEqual(sorted(thumbnails), sorted(os.path.relpath(r, dep._getExtraPath(dep.DIR_IMAGES)) for r in restored))
+
+    def testCaps(self):
+        self.args.protocols = 3  # micrographs, coordinates and particles, no volumes
+        self.synthetic.generate()
+        dep = self.synthetic.newDepositor()
+        dep.dryRun.set(True)  # it does not fit even with the cheapest settings, only estimate it
+        dep.maxThumbnails.set(1)
+        dep.estimateStep()
+
+        # only the steps that lowered the estimate: the 256 px micrographs are only smaller at 128 px,
+        # the volume settings and the items limit (these types have their own) change nothing
+        estimation = json.loads(dep.estimation.get())
+        self.assertEqual(estimation['capped'], {'thumbnailSize': dep.MIN_THUMBNAIL_SIZE})
+        # the caps are applied when running, the form keeps the original value
+        self.assertEqual(dep._getSetting('thumbnailSize'), dep.MIN_THUMBNAIL_SIZE)
+        self.assertEqual(dep.thumbnailSize.get(), 512)
+        # so a restart estimates it again from the original settings
+        dep.estimateStep()
+        self.assertEqual(json.loads(dep.estimation.get()), estimation)
+
+    def testCapsExceeded(self):
+        self.args.protocols = 3
+        self.synthetic.generate()
+        dep = self.synthetic.newDepositor()
+        dep.maxThumbnails.set(1)
+        # the caps are hard limits, it is not deposited past them
+        with self.assertRaisesRegex(Exception, 'even with the cheapest settings'):
+            dep.estimateStep()
+        self.assertEqual(json.loads(dep.estimation.get())['capped'], {'thumbnailSize': dep.MIN_THUMBNAIL_SIZE})
+        # it fits when the limits are raised
+        dep.maxThumbnails.set(1000)
+        dep.estimateStep()
+        self.assertEqual(json.loads(dep.estimation.get())['capped'], {})
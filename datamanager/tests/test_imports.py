@@ -0,0 +1,62 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+import subprocess
+import sys
+import unittest
+
+from datamanager.benchmark import measureImport, HEAVY_MODULES, IMPORT_TIME_BUDGET
+
+ESTIMATE_SCRIPT = '''
+import sys, json
+import datamanager.protocols
+loaded = set(sys.modules)
+from datamanager import estimate
+from datamanager.metrics import formatSize
+outputs = [estimate.OutputInfo(kind, 100, estimate.MAX_ITEMS, (1024, 1024, 1))
+           for kind in (estimate.KIND_IMAGE, estimate.KIND_FILTERED, estimate.KIND_COORDINATES)]
+outputs.append(estimate.OutputInfo(estimate.KIND_VOLUME, 1, dims=(128, 128, 128)))
+settings = {'thumbnailSize': 512, 'maxItems': 20, 'volumeMode': 'slices', 'numberOfSlices': 5,
+            'projections': True, 'logMaxSize': 0}
+formatSize(estimate.estimateDeposition(outputs, [1024], 4, settings).thumbnailBytes)
+print(json.dumps([m for m in %r if m in sys.modules and m not in loaded]))
+'''
+
+
+class TestImports(unittest.TestCase):
+    """ The protocols are imported whenever Scipion lists the plugins, so the
+    heavy modules must only be loaded when they run. """
+
+    def testProtocolsImport(self):
+        result = measureImport()
+        self.assertEqual(result['heavyModules'], [])
+        self.assertLessEqual(result['wallTime'], IMPORT_TIME_BUDGET)
+
+    def testEstimateIsLight(self):
+        """ The estimate and the summary formatting do not load the render or transfer modules. """
+        output = subprocess.check_output([sys.executable, '-c', ESTIMATE_SCRIPT % HEAVY_MODULES])
+        self.assertEqual(json.loads(output.decode().strip().splitlines()[-1]), [])
@@ -0,0 +1,78 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from datamanager import logs
+
+FILLER = b'00001: Iteration running, computing something rather long to log\n'
+
+
+class TestLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeLog(self, *parts):
+        """ Log made of version lines (str) and numbers of filler lines (int). """
+        path = os.path.join(self.tmpDir, 'run.stdout')
+        with open(path, 'wb') as f:
+            for part in parts:
+                if isinstance(part, int):
+                    f.write(FILLER * part)
+                else:
+                    f.write(b'plugin v: %s\n' % part.encode())
+        return path
+
+    def testContinuedRun(self):
+        """ The newest version wins, wherever the header of the continued run is. """
+        self.assertEqual(logs.getPluginVersion(self.writeLog('3.0.0', 10, '3.1.0', 10)), '3.1.0')
+        tail = logs.TAIL_SIZE // len(FILLER) // 2
+        self.assertEqual(logs.getPluginVersion(self.writeLog('3.0.0', 20000, '3.1.0', tail)), '3.1.0')
+        self.assertEqual(logs.getPluginVersion(self.writeLog('3.0.0', 20000)), '3.0.0')
+        # neither at the end: the last one in the whole log, not the one in the header
+        self.assertEqual(logs.getPluginVersion(self.writeLog('3.0.0', 24000, '3.1.0', 24000)), '3.1.0')
+
+    def testVersionOutsideHeader(self):
+        self.assertEqual(logs.getPluginVersion(self.writeLog(20000, '3.2.0', 20000)), '3.2.0')
+        self.assertIsNone(logs.getPluginVersion(self.writeLog(20000)))
+        self.assertIsNone(logs.getPluginVersion(self.writeLog()))
+
+    def testTruncated(self):
+        path = self.writeLog('3.0.0', 100)
+        data = b''.join(logs.iterTruncated(path, 1000, 500, chunkSize=300))
+        with open(path, 'rb') as f:
+            content = f.read()
+        self.assertTrue(data.startswith(content[:1000]))
+        self.assertTrue(data.endswith(content[-500:]))
+        self.assertIn(b'[... %d bytes of the log skipped ...]' % (len(content) - 1500), data)
+        self.assertEqual(b''.join(logs.iterTruncated(path, len(content), 0)), content)
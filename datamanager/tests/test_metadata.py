@@ -0,0 +1,133 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pyworkflow as pw
+from pwem.objects import Coordinate, Micrograph, Particle, SetOfCoordinates, SetOfParticles
+from pyworkflow.object import Float
+
+from datamanager import metadata
+
+PARTICLES = 40
+CLASSES = 4
+
+
+class TestMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.particlesFile = os.path.join(self.tmpDir, 'particles.sqlite')
+        partSet = SetOfParticles(filename=self.particlesFile)
+        partSet.setSamplingRate(1.)
+        for i in range(PARTICLES):
+            particle = Particle(location=(i + 1, 'particles.mrcs'))
+            particle.setClassId(i % CLASSES + 1)
+            particle._score = Float(i)
+            partSet.append(particle)
+        partSet.write()
+        partSet.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def getClassCounts(self, ids):
+        return [sum(1 for i in ids if (i - 1) % CLASSES + 1 == classId) for classId in range(1, CLASSES + 1)]
+
+    def testStatistics(self):
+        stats = metadata.getStatistics(self.particlesFile)
+        self.assertEqual(stats['count'], PARTICLES)
+        self.assertEqual(stats['attributes']['_score'], {'min': 0, 'max': PARTICLES - 1, 'mean': (PARTICLES - 1) / 2})
+        self.assertEqual(stats['attributes']['_classId'], {'min': 1, 'max': CLASSES, 'mean': 2.5})
+        self.assertEqual(stats['attributes']['_samplingRate'], {'min': 1., 'max': 1., 'mean': 1.})
+        self.assertNotIn('_filename', stats['attributes'])  # not numeric
+
+    def testRandomIds(self):
+        ids = metadata.getRandomIds(self.particlesFile, 10)
+        self.assertEqual(len(ids), 10)
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertTrue(all(1 <= i <= PARTICLES for i in ids))
+        self.assertNotEqual(ids, list(range(1, 11)))  # spread over the set
+        # repeatable, so depositions are reproducible
+        self.assertEqual(metadata.getRandomIds(self.particlesFile, 10), ids)
+        self.assertEqual(len(metadata.getRandomIds(self.particlesFile, 2 * PARTICLES)), PARTICLES)
+
+    def testStratifiedIds(self):
+        ids = metadata.getStratifiedIds(self.particlesFile, '_classId', 8)
+        self.assertEqual(len(ids), 8)
+        self.assertEqual(self.getClassCounts(ids), [2] * CLASSES)
+        self.assertEqual(metadata.getStratifiedIds(self.particlesFile, '_classId', 8), ids)
+        # a limit not divisible by the number of classes is still respected
+        ids = metadata.getStratifiedIds(self.particlesFile, '_classId', 6)
+        self.assertEqual(len(ids), 6)
+        self.assertLessEqual(max(self.getClassCounts(ids)) - min(self.getClassCounts(ids)), 1)
+        self.assertIsNone(metadata.getStratifiedIds(self.particlesFile, '_missing', 8))
+
+    def testSampledItems(self):
+        if pw.Config.getDomain() is None:  # set by scipion when it runs the tests
+            pw.Config.setDomain('pwem')
+        from datamanager.protocols import CryoEMWorkflowViewerDepositor
+        dep = CryoEMWorkflowViewerDepositor()
+        partSet = SetOfParticles(filename=self.particlesFile)
+        try:
+            limit = dep._getItemsLimit(partSet.getFirstItem())
+            self.assertEqual([p.getObjId() for p in dep._iterSampledItems(partSet)], list(range(1, limit + 1)))
+
+            dep.samplingMode.set(dep.SAMPLING_RANDOM)
+            ids = [p.getObjId() for p in dep._iterSampledItems(partSet)]
+            self.assertEqual(ids, metadata.getRandomIds(self.particlesFile, limit))
+
+            dep.samplingMode.set(dep.SAMPLING_STRATIFIED)
+            ids = [p.getObjId() for p in dep._iterSampledItems(partSet)]
+            self.assertEqual(len(ids), limit)
+            self.assertLessEqual(max(self.getClassCounts(ids)) - min(self.getClassCounts(ids)), 1)
+        finally:
+            partSet.close()
+
+    def testCoordinates(self):
+        fileName = os.path.join(self.tmpDir, 'coordinates.sqlite')
+        coordSet = SetOfCoordinates(filename=fileName)
+        positions = {1: [(10, 20), (30, 40)], 2: [(50, 60)], 3: []}
+        for micId, micPositions in positions.items():
+            mic = Micrograph()
+            mic.setObjId(micId)
+            for x, y in micPositions:
+                coord = Coordinate()
+                coord.setPosition(x, y)
+                coord.setMicrograph(mic)
+                coordSet.append(coord)
+        coordSet.write()
+        coordSet.close()
+
+        for micId, micPositions in positions.items():
+            coords = metadata.getCoordinates(fileName, micId)
+            self.assertEqual(coords.dtype, np.float32)
+            self.assertEqual(coords.shape, (len(micPositions), 2))
+            np.testing.assert_array_equal(coords, np.array(micPositions, dtype=np.float32).reshape(-1, 2))
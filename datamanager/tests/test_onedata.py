@@ -0,0 +1,348 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+
+import pyworkflow as pw
+import pyworkflow.utils as pwutils
+from pyworkflow.project import Manager
+
+from datamanager import onedata, transfer
+from datamanager.protocols import OnedataDownloader
+from datamanager.tests.httpserver import Handler, LocalServer
+
+
+class OnezoneHandler(Handler):
+    """ Public share API of Onezone: attributes, paged children and content (with ranges). """
+
+    def do_GET(self):
+        self.server.log(self)
+        url = urlparse(self.path)
+        parts = url.path[len(onedata.ONEZONE_API):].split('/')  # shares/data/<id>[/children|/content]
+        node = self.server.nodes.get(parts[2])
+        if node is None or parts[2] in self.server.broken:
+            return self.reply(404 if node is None else 500, b'{}')
+        if len(parts) == 3:
+            return self.replyJson(self.server.getAttributes(parts[2]))
+        if parts[3] == 'children':
+            return self.sendChildren(node, parse_qs(url.query))
+        self.sendContent(parts[2], node)
+
+    def replyJson(self, value):
+        self.reply(200, json.dumps(value).encode(), {'Content-Type': 'application/json'})
+
+    def sendChildren(self, node, query):
+        limit = min(int(query['limit'][0]), self.server.pageSize)
+        start = int(query.get('token', ['0'])[0])
+        children = node['children'][start:start + limit]
+        isLast = start + limit >= len(node['children'])
+        self.replyJson({'children': [self.server.getAttributes(c) for c in children],
+                        'isLast': isLast, 'nextPageToken': None if isLast else str(start + limit)})
+
+    def sendContent(self, fileId, node):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.maxActive = max(self.server.maxActive, self.server.active)
+        try:
+            time.sleep(self.server.delay)
+            data = node['data']
+            start, end, code, headers = 0, len(data) - 1, 200, {}
+            if 'Range' in self.headers:
+                first, last = self.headers['Range'][len('bytes='):].split('-')
+                start, end = int(first), int(last) if last else len(data) - 1
+                if start >= len(data):
+                    return self.reply(416, headers={'Content-Range': 'bytes */%d' % len(data)})
+                code, headers = 206, {'Content-Range': 'bytes %d-%d/%d' % (start, end, len(data))}
+            body = data[start:end + 1]
+            cut = self.server.cut.pop(fileId, None)
+            if cut is None:
+                return self.reply(code, body, headers)
+            # the connection is lost after cut bytes
+            self.send_response(code)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:cut])
+            self.wfile.flush()
+            self.close_connection = True
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+
+class OnezoneServer(LocalServer):
+
+    def __init__(self):
+        LocalServer.__init__(self, OnezoneHandler)
+        self.nodes = {}
+        self.pageSize = 1000
+        self.delay = 0
+        self.broken = set()  # ids that give server errors
+        self.cut = {}  # id: bytes sent before the connection is lost (once)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.maxActive = 0
+
+    def addDir(self, fileId, name, parent=None):
+        self.nodes[fileId] = {'name': name, 'type': onedata.TYPE_DIR, 'children': []}
+        if parent is not None:
+            self.nodes[parent]['children'].append(fileId)
+
+    def addFile(self, fileId, name, parent, size):
+        self.nodes[fileId] = {'name': name, 'type': onedata.TYPE_REG, 'data': os.urandom(size)}
+        self.nodes[parent]['children'].append(fileId)
+        return self.nodes[fileId]['data']
+
+    def getAttributes(self, fileId):
+        node = self.nodes[fileId]
+        attributes = {'file_id': fileId, 'name': node['name'], 'type': node['type'], 'mtime': 1000}
+        if 'data' in node:
+            attributes['size'] = len(node['data'])
+            attributes['md5'] = hashlib.md5(node['data']).hexdigest()
+        return attributes
+
+    def getContentRequests(self, fileId=None):
+        return [(path, headers) for method, path, headers in self.requests
+                if path.endswith('/content') and (fileId is None or '/%s/' % fileId in path)]
+
+
+class TestOnedata(unittest.TestCase):
+
+    def setUp(self):
+        self.server = OnezoneServer()
+        self.client = onedata.OnedataClient(self.server.url)
+        self.tmpDir = tempfile.mkdtemp()
+        patcher = mock.patch.object(transfer.time, 'sleep')  # retries do not wait
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.client.session.close()
+        self.server.close()
+        shutil.rmtree(self.tmpDir)
+
+    def makeShare(self, sizes):
+        """ Share with the files of the given sizes in a subfolder. Returns their contents by path. """
+        self.server.addDir('root', 'share')
+        self.server.addDir('movies', 'movies', 'root')
+        contents = {}
+        for i, size in enumerate(sizes):
+            contents[os.path.join('share', 'movies', 'movie%02d.tif' % i)] = \
+                self.server.addFile('m%d' % i, 'movie%02d.tif' % i, 'movies', size)
+        return contents
+
+    def assertDownloaded(self, contents):
+        for path, data in contents.items():
+            with open(os.path.join(self.tmpDir, path), 'rb') as f:
+                self.assertEqual(f.read(), data, path)
+
+    def testListTree(self):
+        self.server.pageSize = 2
+        contents = self.makeShare([10] * 5)
+        self.server.addFile('gain', 'gain.mrc', 'root', 20)
+        files, errors = self.client.listTree('root')
+
+        self.assertEqual(errors, [])
+        self.assertEqual([f.path for f in files], sorted(list(contents) + [os.path.join('share', 'gain.mrc')]))
+        self.assertEqual(files[0].checksum, ('md5', self.server.getAttributes(files[0].fileId)['md5']))
+        pages = [path for _, path, _ in self.server.requests if '/movies/children' in path]
+        self.assertEqual(len(pages), 3)
+        self.assertIn('token=4', pages[-1])
+
+    def testListTreeErrors(self):
+        self.makeShare([10])
+        self.server.addDir('private', 'private', 'root')
+        self.server.broken.add('private')
+        files, errors = self.client.listTree('root')
+        self.assertEqual([f.fileId for f in files], ['m0'])
+        self.assertEqual([(e.path, e.fileId) for e in errors], [(os.path.join('share', 'private'), 'private')])
+
+    def testDownloadFiles(self):
+        self.server.delay = 0.05
+        # small files are downloaded in one batch, these ones by separate workers
+        contents = self.makeShare([onedata.SMALL_FILE_SIZE + i for i in range(4)] + [100] * 4)
+        files, _ = self.client.listTree('root')
+        done = []
+        errors = onedata.downloadFiles(self.client, files, self.tmpDir, workers=4,
+                                       onDone=lambda f, size, resumed, seconds: done.append((f.path, size)))
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(done), sorted((path, len(data)) for path, data in contents.items()))
+        self.assertDownloaded(contents)
+        self.assertGreater(self.server.maxActive, 1)
+        self.assertFalse(any(name.endswith(onedata.PART_SUFFIX)
+                             for _, _, names in os.walk(self.tmpDir) for name in names))
+
+    def testDownloadErrors(self):
+        contents = self.makeShare([100, 200, 300])
+        files, _ = self.client.listTree('root')
+        self.server.broken.add('m1')
+        files[2].checksum = ('md5', '0' * 32)
+        errors = onedata.downloadFiles(self.client, files, self.tmpDir, workers=2)
+
+        self.assertEqual(sorted((e.path, e.fileId) for e in errors), [(files[1].path, 'm1'), (files[2].path, 'm2')])
+        self.assertIn('checksum', next(e for e in errors if e.fileId == 'm2').reason)
+        self.assertEqual(set(errors[0].toDict()), {'path', 'fileId', 'reason'})
+        self.assertDownloaded({files[0].path: contents[files[0].path]})
+        self.assertFalse(os.path.exists(os.path.join(self.tmpDir, files[1].path)))
+
+    def testResume(self):
+        contents = self.makeShare([3 * onedata.DOWNLOAD_CHUNK])
+        files, _ = self.client.listTree('root')
+        self.server.cut['m0'] = 2 * onedata.DOWNLOAD_CHUNK
+
+        # the connection is lost, the partial file is kept in the manifest (saved before the download)
+        download = self.client.download
+        saved = []
+        def checkManifest(*args):
+            saved.append(onedata.DownloadManifest(self.tmpDir).entries.get(files[0].path))
+            return download(*args)
+        scheduler = onedata.TransferScheduler(self.client, self.tmpDir, manifest=onedata.DownloadManifest(self.tmpDir),
+                                              smallFileSize=onedata.DOWNLOAD_CHUNK)
+        with mock.patch.object(self.client, 'download', checkManifest):
+            errors = scheduler.run(files)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(saved[0] and saved[0]['partial'])
+        partSize = os.path.getsize(self.client.getPartPath(files[0], self.tmpDir))
+        self.assertGreater(partSize, 0)
+
+        # a new run completes it from where it stopped
+        done = []
+        errors = onedata.downloadFiles(self.client, files, self.tmpDir, manifest=onedata.DownloadManifest(self.tmpDir),
+                                       onDone=lambda f, size, resumed, seconds: done.append(resumed))
+        self.assertEqual(errors, [])
+        self.assertEqual(done, [partSize])
+        self.assertEqual(self.server.getContentRequests('m0')[-1][1]['Range'], 'bytes=%d-' % partSize)
+        self.assertDownloaded(contents)
+
+        # and the following ones skip it
+        manifest = onedata.DownloadManifest(self.tmpDir)
+        self.assertTrue(manifest.isUpToDate(files[0]))
+        self.assertFalse(manifest.canResume(files[0]))
+
+    def testResumeCompletePart(self):
+        contents = self.makeShare([1000, 2000])
+        files, _ = self.client.listTree('root')
+        manifest = onedata.DownloadManifest(self.tmpDir)
+        for f in files:
+            # killed after writing the whole partial file, before renaming it
+            with open(self.client.getPartPath(f, self.tmpDir), 'wb') as part:
+                part.write(contents[f.path])
+            manifest.setPartial(f)
+
+        done = []
+        errors = onedata.downloadFiles(self.client, files, self.tmpDir, manifest=manifest,
+                                       onDone=lambda f, size, resumed, seconds: done.append((size, resumed)))
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(done), [(1000, 1000), (2000, 2000)])
+        self.assertEqual(self.server.getContentRequests(), [])
+        self.assertDownloaded(contents)
+
+        # without the size to check it, the server refuses the range and the file is downloaded again
+        files[0].size = None
+        os.replace(os.path.join(self.tmpDir, files[0].path), self.client.getPartPath(files[0], self.tmpDir))
+        self.assertEqual(self.client.download(files[0], self.tmpDir, resume=True), (1000, 0))
+        self.assertEqual([headers.get('Range') for _, headers in self.server.getContentRequests()], ['bytes=1000-', None])
+        self.assertDownloaded(contents)
+
+    def testRangesAndBatches(self):
+        contents = self.makeShare([100] * 6 + [2000, 10000])
+        files, _ = self.client.listTree('root')
+        scheduler = onedata.TransferScheduler(self.client, self.tmpDir, workers=4, smallFileSize=1000,
+                                              batchSize=250, largeFileSize=5000, rangeSize=4000)
+        tasks = scheduler.getTasks(files)
+        kinds = [(kind, len(task) if kind == 'files' else task[1:]) for _, kind, task in tasks]
+        self.assertEqual(kinds, [('range', (0, 3999)), ('range', (4000, 7999)), ('files', 1),
+                                 ('range', (8000, 9999)), ('files', 3), ('files', 3)])
+
+        self.assertEqual(scheduler.run(files), [])
+        self.assertDownloaded(contents)
+        ranges = sorted(headers.get('Range') for _, headers in self.server.getContentRequests('m7'))
+        self.assertEqual(ranges, ['bytes=0-3999', 'bytes=4000-7999', 'bytes=8000-9999'])
+
+
+class TestOnedataDownloader(unittest.TestCase):
+    """ The protocol in a temporary project, downloading from the local Onezone. """
+
+    def setUp(self):
+        self.server = OnezoneServer()
+        self.tmpDir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        if pw.Config.getDomain() is None:  # set by scipion when it runs the tests
+            pw.Config.setDomain('pwem')
+        manager = Manager()
+        pwutils.makePath(manager.PROJECTS)
+        name = os.path.basename(self.tmpDir)
+        self.link = manager.getProjectPath(name)
+        self.project = manager.createProject(name, location=os.path.join(self.tmpDir, 'project'))
+        os.chdir(self.project.getPath())
+        patcher = mock.patch.object(transfer.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.server.close()
+        if os.path.islink(self.link):
+            os.remove(self.link)
+        shutil.rmtree(self.tmpDir)
+
+    def testStreamingOutput(self):
+        self.server.addDir('root', 'share')
+        for i in range(4):
+            self.server.addFile('m%d' % i, 'movie%d.tif' % i, 'root', 100)
+        self.server.addFile('log', 'notes.txt', 'root', 10)
+        self.server.broken.add('m3')
+        downloadPath = os.path.join(self.tmpDir, 'data')
+        prot = self.project.newProtocol(OnedataDownloader, dataID='root', onezone=self.server.url,
+                                        downloadPath=downloadPath, outputType=OnedataDownloader.OUTPUT_FILES,
+                                        filesPattern='*.tif', numberOfThreads=2)
+        self.project.saveProtocol(prot)
+        pwutils.makePath(prot._getExtraPath())
+
+        def getOutputPaths():
+            return sorted(os.path.relpath(f.getFileName(), downloadPath) for f in prot.outputFiles)
+
+        # a file fails, the rest are in the output
+        with self.assertRaisesRegex(Exception, '1 files could not be downloaded'):
+            prot.downloadDataStep()
+        self.assertEqual(getOutputPaths(), [os.path.join('share', 'movie%d.tif' % i) for i in range(3)])
+
+        # continuing, the files of the failed run are up to date but not added again
+        self.server.broken.clear()
+        prot.downloadDataStep()
+        self.assertEqual(getOutputPaths(), [os.path.join('share', 'movie%d.tif' % i) for i in range(4)])
+        self.assertEqual(prot.skippedFiles.get(), 4)
+        self.assertTrue(prot.outputFiles.isStreamClosed())
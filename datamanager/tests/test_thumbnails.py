@@ -0,0 +1,170 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image as ImagePIL
+
+from datamanager import thumbnails
+from datamanager.benchmark import writeMrc
+
+
+class TestThumbnails(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def getPath(self, name):
+        return os.path.join(self.tmpDir, name)
+
+    def readJpg(self, path):
+        return np.asarray(ImagePIL.open(path).convert('L'), dtype=np.float32)
+
+    def testStackImages(self):
+        """ Each image of a stack is rendered from its own data. """
+        box = 32
+        ramp = np.tile(np.linspace(0, 1, box, dtype=np.float32), (box, 1))
+        stack = self.getPath('particles.mrcs')
+        writeMrc(stack, [ramp, ramp.T])
+        thumbnails.renderFiltered((1, stack), self.getPath('1.jpg'), maxSize=box)
+        thumbnails.renderFiltered((2, stack), self.getPath('2.jpg'), maxSize=box)
+        first, second = self.readJpg(self.getPath('1.jpg')), self.readJpg(self.getPath('2.jpg'))
+        # the ramp goes along x in the first image and along y in the second one
+        self.assertGreater(first[:, -4:].mean(), first[:, :4].mean() + 100)
+        self.assertGreater(second[-4:].mean(), second[:4].mean() + 100)
+
+    def testLowPassBinSize(self):
+        data = self.rng.standard_normal((192, 256)).astype(np.float32)
+        self.assertEqual(thumbnails.lowPassBin(data, maxSize=64).shape, (48, 64))
+        # only binned when it is bigger than maxSize
+        self.assertEqual(thumbnails.lowPassBin(data, maxSize=512).shape, (192, 256))
+        self.assertEqual(thumbnails.lowPassBin(data).shape, (192, 256))
+
+    def testFilteredSizeCapped(self):
+        micrograph = self.getPath('mic.mrc')
+        writeMrc(micrograph, self.rng.standard_normal((200, 300)))
+        thumbnails.renderFiltered(micrograph, self.getPath('mic.jpg'), maxSize=100)
+        self.assertEqual(ImagePIL.open(self.getPath('mic.jpg')).size, (100, 67))
+
+        thumbnails.renderFiltered(micrograph, self.getPath('full.jpg'))
+        self.assertEqual(ImagePIL.open(self.getPath('full.jpg')).size, (300, 200))
+
+    def testShrinkImage(self):
+        path = self.getPath('image.jpg')
+        ImagePIL.new('L', (300, 200)).save(path)
+        thumbnails.shrinkImage(path, 500)
+        self.assertEqual(ImagePIL.open(path).size, (300, 200))
+        thumbnails.shrinkImage(path, 150)
+        self.assertEqual(ImagePIL.open(path).size, (150, 100))
+
+    def assertGreen(self, pixel):
+        r, g, b = (int(v) for v in pixel)
+        self.assertTrue(g > 200 and r < 80 and b < 80, 'not green: %s' % [r, g, b])
+
+    def testDrawCoordinates(self):
+        """ Coordinates in micrograph pixels are drawn rescaled to the thumbnail size. """
+        path = self.getPath('coordinates.png')
+        ImagePIL.new('RGB', (128, 64)).save(path)
+        thumbnails.drawCoordinates(path, (256, 128), np.array([[100, 50], [254, 126], [300, 10]], dtype=np.float32))
+        image = np.asarray(ImagePIL.open(path))
+        self.assertGreen(image[25, 50])
+        self.assertGreen(image[63, 127])  # the disks are clipped at the edges, outside coordinates ignored
+        self.assertEqual(image.shape, (64, 128, 3))
+        self.assertEqual(image[5, 5].tolist(), [0, 0, 0])
+        self.assertEqual(image[25, 100].tolist(), [0, 0, 0])  # not at the micrograph position
+
+    def testRenderCoordinates(self):
+        micrograph = self.getPath('mic.mrc')
+        writeMrc(micrograph, np.zeros((128, 256), dtype=np.float32))
+        path = self.getPath('mic.jpg')
+        thumbnails.renderCoordinates(micrograph, path, (256, 128), np.array([[200, 100]], dtype=np.float32), maxSize=128)
+        image = np.asarray(ImagePIL.open(path).convert('RGB'))
+        self.assertEqual(image.shape, (64, 128, 3))
+        self.assertGreen(image[50, 100])
+
+    def writeVolume(self):
+        """ A 32 x 24 x 16 (x, y, z) volume, dark but for one voxel at x=7, y=5, z=3. """
+        volume = np.zeros((16, 24, 32), dtype=np.float32)
+        volume[3, 5, 7] = 1
+        fileName = self.getPath('volume.mrc')
+        writeMrc(fileName, volume)
+        return fileName
+
+    def listJpgs(self, repDir, prefix):
+        return sorted(f for f in os.listdir(repDir) if f.startswith(prefix))
+
+    def testSliceIndexes(self):
+        self.assertEqual(thumbnails.getSliceIndexes(16, 4), [2, 6, 10, 14])
+        self.assertEqual(thumbnails.getSliceIndexes(16, 0), list(range(16)))
+        self.assertEqual(thumbnails.getSliceIndexes(16, 20), list(range(16)))
+
+    def testMontage(self):
+        images = [np.full((3, 4), i, dtype=np.uint8) for i in range(5)]
+        montage = thumbnails.makeMontage(images)
+        self.assertEqual(montage.shape, (6, 12))  # 3 columns, 2 rows
+        self.assertEqual(montage[4, 5], 4)
+        self.assertEqual(montage[4, 9], 0)  # the last tile is empty
+
+    def testVolumeSlices(self):
+        repDir = self.getPath('slices')
+        thumbnails.renderVolume(self.writeVolume(), repDir, numberOfSlices=4)
+        for axis in 'XYZ':
+            self.assertEqual(self.listJpgs(repDir, 'slices' + axis), ['slices%s_%04d.jpg' % (axis, i) for i in range(4)])
+        self.assertEqual(ImagePIL.open(os.path.join(repDir, 'slicesX_0000.jpg')).size, (24, 16))
+        self.assertEqual(ImagePIL.open(os.path.join(repDir, 'slicesZ_0000.jpg')).size, (32, 24))
+
+        repDir = self.getPath('all')
+        thumbnails.renderVolume(self.writeVolume(), repDir, numberOfSlices=0, maxSize=16)
+        self.assertEqual(len(self.listJpgs(repDir, 'slicesZ')), 16)
+        self.assertEqual(ImagePIL.open(os.path.join(repDir, 'slicesZ_0000.jpg')).size, (16, 12))
+
+    def testVolumeMontage(self):
+        repDir = self.getPath('montage')
+        thumbnails.renderVolume(self.writeVolume(), repDir, numberOfSlices=4, montage=True)
+        self.assertEqual(sorted(os.listdir(repDir)), ['montageX.jpg', 'montageY.jpg', 'montageZ.jpg'])
+        # 2 x 2 tiles of the slices of each axis
+        self.assertEqual(ImagePIL.open(os.path.join(repDir, 'montageX.jpg')).size, (48, 32))
+        self.assertEqual(ImagePIL.open(os.path.join(repDir, 'montageZ.jpg')).size, (64, 48))
+
+    def testVolumeProjections(self):
+        repDir = self.getPath('projections')
+        thumbnails.renderVolume(self.writeVolume(), repDir, numberOfSlices=4, montage=True, projections=True)
+        for axis in 'XYZ':
+            self.assertTrue(os.path.exists(os.path.join(repDir, 'central%s.jpg' % axis)))
+        # the bright voxel is in every maximum projection, not in the central slices
+        projectionZ = self.readJpg(os.path.join(repDir, 'projectionZ.jpg'))
+        self.assertEqual(projectionZ.shape, (24, 32))
+        self.assertGreater(projectionZ[5, 7], 200)
+        self.assertGreater(self.readJpg(os.path.join(repDir, 'projectionX.jpg'))[3, 5], 200)
+        self.assertLess(self.readJpg(os.path.join(repDir, 'centralZ.jpg')).max(), 50)
@@ -0,0 +1,239 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import email
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from datamanager import transfer
+from datamanager.tests.httpserver import Handler, LocalServer
+
+
+class UploadHandler(Handler):
+    """ Form uploads to /upload and tus uploads to /files. """
+
+    def do_OPTIONS(self):
+        self.reply(204, headers={'Tus-Version': transfer.TUS_VERSION, 'Tus-Resumable': transfer.TUS_VERSION})
+
+    def do_POST(self):
+        self.server.log(self)
+        body = self.readBody()
+        if self.path == '/files' and self.server.createFailures > 0:
+            self.server.createFailures -= 1
+            self.reply(503)
+        elif self.path == '/files':
+            uploadId = str(len(self.server.uploads))
+            self.server.uploads[uploadId] = {'length': int(self.headers['Upload-Length']), 'data': b''}
+            self.reply(201, headers={'Location': '/files/' + uploadId})
+        elif self.server.failures > 0:
+            self.server.failures -= 1
+            self.reply(self.server.failureCode, headers=self.server.failureHeaders)
+        else:
+            self.server.posted.append((self.headers['Content-Type'], body))
+            self.reply(201, b'ok')
+
+    def do_HEAD(self):
+        self.server.log(self)
+        upload = self.server.uploads.get(self.path.split('/')[-1])
+        if upload is None:
+            return self.reply(404)
+        self.reply(200, headers={'Upload-Offset': len(upload['data']), 'Upload-Length': upload['length']})
+
+    def do_PATCH(self):
+        self.server.log(self)
+        upload = self.server.uploads[self.path.split('/')[-1]]
+        data = self.readBody()
+        if int(self.headers['Upload-Offset']) != len(upload['data']):
+            return self.reply(409)
+        if self.server.failures > 0 and upload['data']:
+            # the connection breaks in the middle of the chunk
+            self.server.failures -= 1
+            upload['data'] += data[:len(data) // 2]
+            return self.reply(500)
+        upload['data'] += data
+        self.reply(204, headers={'Upload-Offset': len(upload['data'])})
+
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalServer(UploadHandler)
+        self.server.uploads = {}
+        self.server.posted = []
+        self.server.failures = 0
+        self.server.createFailures = 0
+        self.server.failureCode = 503
+        self.server.failureHeaders = {'Retry-After': 3}
+        self.session = transfer.createSession()
+        self.tmpDir = tempfile.mkdtemp()
+        # retries do not wait
+        patcher = mock.patch.object(transfer.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.close()
+        shutil.rmtree(self.tmpDir)
+
+    def makeFile(self, name, size):
+        path = os.path.join(self.tmpDir, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def getRequests(self, method):
+        return [r for r in self.server.requests if r[0] == method]
+
+    def testMultipartStream(self):
+        path = self.makeFile('big.bin', 10000)
+        body = transfer.MultipartStream({'file': ('big.bin', path)}, chunkSize=1024)
+        chunks = list(body)
+        self.assertEqual(len(body), sum(len(c) for c in chunks))
+        self.assertLessEqual(max(len(c) for c in chunks), 1024)
+
+    def testPostMultipart(self):
+        paths = {'json': ('workflow.json', self.makeFile('workflow.json', 3000)),
+                 'file': ('images.zip', self.makeFile('images.zip', 100000))}
+        response = transfer.postMultipart(self.session, self.server.url + '/upload', paths)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.server.posted), 1)
+
+        contentType, body = self.server.posted[0]
+        message = email.message_from_bytes(b'Content-Type: ' + contentType.encode() + b'\r\n\r\n' + body)
+        parts = {p.get_param('name', header='content-disposition'): p for p in message.get_payload()}
+        self.assertEqual(set(parts), {'json', 'file'})
+        for field, (fileName, path) in paths.items():
+            self.assertEqual(parts[field].get_filename(), fileName)
+            self.assertEqual(parts[field].get_payload(decode=True), self.read(path))
+
+    def testPostRetriesBusyServer(self):
+        self.server.failures = 2
+        path = self.makeFile('workflow.json', 5000)
+        response = transfer.postMultipart(self.session, self.server.url + '/upload', {'json': ('workflow.json', path)})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.getRequests('POST')), 3)
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [3, 3])
+        # the whole body is sent again
+        self.assertIn(self.read(path), self.server.posted[0][1])
+
+    def testPostDoesNotRepeatServerErrors(self):
+        # a gateway error or a timeout may come after the server created the entry
+        self.server.failures = 1
+        self.server.failureCode = 502
+        self.server.failureHeaders = {}
+        path = self.makeFile('workflow.json', 100)
+        response = transfer.postMultipart(self.session, self.server.url + '/upload', {'json': ('workflow.json', path)})
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(len(self.getRequests('POST')), 1)
+
+        with mock.patch.object(self.session, 'post', side_effect=transfer.requests.ReadTimeout()) as post:
+            with self.assertRaises(transfer.requests.ReadTimeout):
+                transfer.postForm(self.session, self.server.url + '/upload', {'file': 'url'})
+        self.assertEqual(post.call_count, 1)
+
+    def testPostRetriesRefusedConnections(self):
+        closed = LocalServer(UploadHandler)
+        closed.close()
+        with self.assertRaises(transfer.requests.ConnectionError):
+            transfer.postForm(self.session, closed.url + '/upload', {'file': 'url'}, retries=2)
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def testPostGivesUp(self):
+        self.server.failures = 3
+        path = self.makeFile('workflow.json', 100)
+        with self.assertRaises(transfer.TransferError):
+            transfer.postMultipart(self.session, self.server.url + '/upload', {'json': ('workflow.json', path)},
+                                   retries=2)
+
+    def testSupportsTus(self):
+        self.assertTrue(transfer.supportsTus(self.session, self.server.url + '/files'))
+
+    def testTusResumesFromServerOffset(self):
+        self.server.failures = 1
+        path = self.makeFile('images.zip', 10000)
+        upload = transfer.TusUpload(self.session, self.server.url + '/files', path, chunkSize=1024)
+        upload.create()
+        url = upload.upload()
+
+        self.assertEqual(self.server.uploads[url.split('/')[-1]]['data'], self.read(path))
+        self.assertEqual(len(self.getRequests('POST')), 1)
+        # the chunk after the failure starts where the server stopped, not at a chunk boundary
+        offsets = [int(headers['Upload-Offset']) for _, _, headers in self.getRequests('PATCH')]
+        self.assertEqual(len(offsets), 11)  # first, failed and 9 chunks from offset 1536
+        self.assertTrue(any(offset % 1024 for offset in offsets))
+
+    def testUploadResumableContinues(self):
+        paths = {'file': self.makeFile('images.zip', 10000)}
+        statePath = os.path.join(self.tmpDir, 'upload.json')
+        endpoint = self.server.url + '/files'
+        self.server.failures = 100
+        with self.assertRaises(transfer.TransferError):
+            transfer.uploadResumable(self.session, endpoint, paths, statePath, retries=1, chunkSize=1024)
+        with open(statePath) as f:
+            uploadUrl = json.load(f)['file'][0]
+        received = len(self.server.uploads[uploadUrl.split('/')[-1]]['data'])
+        self.assertGreater(received, 1024)
+
+        # a new attempt (e.g. continuing the protocol) uses the same upload
+        self.server.failures = 0
+        self.server.requests = []
+        urls = transfer.uploadResumable(self.session, endpoint, paths, statePath, chunkSize=1024)
+        self.assertEqual(urls, {'file': uploadUrl})
+        self.assertEqual(self.getRequests('POST'), [])
+        self.assertEqual(int(self.getRequests('PATCH')[0][2]['Upload-Offset']), received)
+        self.assertEqual(self.server.uploads[uploadUrl.split('/')[-1]]['data'], self.read(paths['file']))
+
+    def testUploadResumableRetriesCreation(self):
+        paths = {'file': self.makeFile('images.zip', 3000)}
+        self.server.createFailures = 1
+        urls = transfer.uploadResumable(self.session, self.server.url + '/files', paths,
+                                        os.path.join(self.tmpDir, 'upload.json'), chunkSize=1024)
+        self.assertEqual(len(self.getRequests('POST')), 2)
+        self.assertEqual(self.server.uploads[urls['file'].split('/')[-1]]['data'], self.read(paths['file']))
+
+    def testUploadResumableRestartsChangedFile(self):
+        paths = {'file': self.makeFile('images.zip', 3000)}
+        statePath = os.path.join(self.tmpDir, 'upload.json')
+        endpoint = self.server.url + '/files'
+        firstUrl = transfer.uploadResumable(self.session, endpoint, paths, statePath, chunkSize=1024)['file']
+
+        # rewritten with the same size, the remote bytes are stale
+        with open(paths['file'], 'wb') as f:
+            f.write(os.urandom(3000))
+        stat = os.stat(paths['file'])
+        os.utime(paths['file'], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        urls = transfer.uploadResumable(self.session, endpoint, paths, statePath, chunkSize=1024)
+        self.assertNotEqual(urls['file'], firstUrl)
+        self.assertEqual(self.server.uploads[urls['file'].split('/')[-1]]['data'], self.read(paths['file']))
@@ -0,0 +1,483 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Thumbnail rendering for the CryoEM Workflow Viewer deposition.
+
+Render functions only take plain (picklable) arguments so that they can be
+executed on a process pool by ThumbnailRenderer.
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from pwem import emlib
+import pyworkflow.utils as pwutils
+from PIL import Image as ImagePIL
+from PIL import ImageDraw
+
+from datamanager.cache import getSize, getRenderKey
+from datamanager.constants import LOW_PASS_CUTOFF, LOW_PASS_WIDTH
+
+MRC_EXTENSIONS = ('.mrc', '.mrcs', '.st', '.ali', '.rec', '.map')
+MRC_MODES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16, 12: np.float16}
+
+
+# --------------- in memory image processing -------------------------
+
+def readMrcHeader(fileName):
+    """ Get the dimensions, data type and data offset of an mrc file. """
+    header = np.fromfile(fileName, dtype=np.int32, count=256)
+    byteorder = '<'
+    if not (0 <= header[3] < 100 and 0 < header[0] < 2**20):  # mode or x dimension make no sense
+        header = header.byteswap()
+        byteorder = '>'
+    nx, ny, nz, mode = (int(v) for v in header[:4])
+    if mode not in MRC_MODES:
+        raise ValueError('Unsupported mrc mode %d in %s' % (mode, fileName))
+    dtype = np.dtype(MRC_MODES[mode]).newbyteorder(byteorder)
+    offset = 1024 + int(header[23])  # plus extended header (nsymbt)
+    return (nx, ny, nz), dtype, offset
+
+
+def readMrc(fileName, index=1):
+    """ Memory map an image (or the index-th image of a stack) of an mrc file. """
+    (nx, ny, nz), dtype, offset = readMrcHeader(fileName)
+    index = min(max(index or 1, 1), nz)
+    offset += (index - 1) * nx * ny * dtype.itemsize
+    return np.memmap(fileName, dtype=dtype, mode='r', offset=offset, shape=(ny, nx))
+
+
+def stripFormat(fileName):
+    return fileName[:-4] if fileName.endswith(':mrc') else fileName
+
+
+def readImage(fileName, index=1):
+    """ Read an image as a 2D array, memory mapped if it is an mrc file. """
+    fileName = stripFormat(fileName)
+    if fileName.lower().endswith(MRC_EXTENSIONS):
+        return readMrc(fileName, index)
+    data = emlib.image.ImageHandler().read((index, fileName)).getData()
+    return data if data.ndim == 2 else data[0]
+
+
+def readVolume(fileName):
+    """ Read a volume as a (z, y, x) array, memory mapped if it is an mrc file. """
+    fileName = stripFormat(fileName)
+    if fileName.lower().endswith(MRC_EXTENSIONS):
+        (nx, ny, nz), dtype, offset = readMrcHeader(fileName)
+        return np.memmap(fileName, dtype=dtype, mode='r', offset=offset, shape=(nz, ny, nx))
+    data = emlib.image.ImageHandler().read(fileName).getData()
+    return data if data.ndim == 3 else data[None]
+
+
+def lowPassBin(data, cutoff=LOW_PASS_CUTOFF, maxSize=None, width=LOW_PASS_WIDTH):
+    """ Low pass filter an image with a raised cosine in Fourier space and, if its
+    largest edge is bigger than maxSize, bin it down to maxSize by cropping its spectrum. """
+    ny, nx = data.shape
+    scale = 1.
+    if maxSize and max(nx, ny) > maxSize:
+        scale = maxSize / max(nx, ny)
+        # avoid the ringing of a sharp crop when binning beyond the filter
+        cutoff = max(min(cutoff, 0.5 * scale - width), 0.5 * scale / 2)
+    ny2, nx2 = max(2, int(round(ny * scale))), max(2, int(round(nx * scale)))
+
+    ft = np.fft.rfft2(np.asarray(data, dtype=np.float32))
+    rows = np.r_[0:(ny2 + 1) // 2, ny - ny2 // 2:ny]
+    ft = ft[rows, :nx2 // 2 + 1]
+
+    fy = np.fft.fftfreq(ny)[rows][:, None]
+    fx = np.fft.rfftfreq(nx)[:nx2 // 2 + 1][None, :]
+    freq = np.sqrt(fx ** 2 + fy ** 2)
+    mask = 0.5 * (1 + np.cos(np.pi * np.clip(freq - cutoff, 0, width) / width))
+    return np.fft.irfft2(ft * mask, s=(ny2, nx2))
+
+
+def toUint8(data, minV=None, maxV=None):
+    """ Normalize an image to 8 bits, between its own or the given extremes. """
+    data = np.asarray(data, dtype=np.float32)
+    minV = data.min() if minV is None else minV
+    maxV = data.max() if maxV is None else maxV
+    data = (np.clip(data, minV, maxV) - minV) * (255. / (maxV - minV)) if maxV > minV else np.zeros_like(data)
+    return data.astype(np.uint8)
+
+
+def writeJpg(data, repPath, minV=None, maxV=None, maxSize=None):
+    """ Normalize an image to 8 bits and save it, scaled down to maxSize if given. """
+    image = ImagePIL.fromarray(toUint8(data, minV, maxV), 'L')
+    if maxSize and max(image.size) > maxSize:
+        image.thumbnail((maxSize, maxSize))
+    image.save(repPath, quality=95)
+
+
+# --------------- render functions -------------------------
+
+def shrinkImage(imagePath, maxSize):
+    """ Scale down an image file so that its largest edge is at most maxSize. """
+    image = ImagePIL.open(imagePath)
+    if maxSize and max(image.size) > maxSize:
+        image.thumbnail((maxSize, maxSize))
+        image.save(imagePath, quality=95)
+
+
+def writeText(imagePath, text):
+    """ Write a text (e.g. number of particles) over the bottom left corner of an image. """
+    image = ImagePIL.open(imagePath).convert('RGB')
+    W, H = image.size
+    draw = ImageDraw.Draw(image)
+    draw.text((5, H - 15), text, fill=(0, 255, 0))
+    image.save(imagePath, quality=95)
+
+
+def renderImage(itemPath, repPath, text=None, maxSize=None):
+    """ Convert an image (location or file name) to jpg/png. """
+    emlib.image.ImageHandler().convert(itemPath, repPath)
+    shrinkImage(repPath, maxSize)
+    if text:
+        writeText(repPath, text)
+
+
+def splitLocation(location):
+    """ Get the index (None if not given) and file name of an image location: (index, fileName) or fileName. """
+    if isinstance(location, (tuple, list)):
+        return location[0], location[1]
+    return None, location
+
+
+def renderFiltered(location, repPath, cutoff=LOW_PASS_CUTOFF, maxSize=None, tmpDir=None, env=None):
+    """ Apply a low pass filter to an image (location or file name) and save the binned result as jpg.
+    It is done in memory, xmipp_transform_filter is used if the image can not be read. """
+    index, fileName = splitLocation(location)
+    try:
+        data = readImage(fileName, index or 1)
+    except Exception as e:
+        print('Cannot read %s (%s), filtering it with xmipp' % (fileName, e))
+        renderFilteredXmipp(location, repPath, cutoff, maxSize, tmpDir, env)
+    else:
+        writeJpg(lowPassBin(data, cutoff, maxSize), repPath)
+
+
+def getXmippEnviron():
+    """ Environment to run xmipp programs, it requires the xmipp3 plugin. """
+    from pwem import Domain
+    return Domain.importFromPlugin('xmipp3', 'Plugin', doRaise=True).getEnviron()
+
+
+def renderFilteredXmipp(location, repPath, cutoff=LOW_PASS_CUTOFF, maxSize=None, tmpDir=None, env=None):
+    """ Apply a low pass filter with xmipp to an image (location or file name) and save the
+    result as jpg. If env is not given, the xmipp environment is resolved when needed. """
+    if env is None:
+        env = getXmippEnviron()
+    index, fileName = splitLocation(location)
+    fd, tmpPath = tempfile.mkstemp(dir=tmpDir, suffix='_' + os.path.basename(stripFormat(fileName)))
+    os.close(fd)
+    try:
+        inputPath = '%d@%s' % (index, fileName) if index else fileName
+        args = ' -i %s -o %s --fourier low_pass %f' % (inputPath, tmpPath, cutoff)
+        pwutils.runJob(None, 'xmipp_transform_filter', args, env=env)
+        emlib.image.ImageHandler().convert(tmpPath, repPath)
+        shrinkImage(repPath, maxSize)
+    finally:
+        pwutils.cleanPath(tmpPath)
+
+
+def renderCoordinates(fileName, repPath, micDims, coords, maxSize=None, tmpDir=None, env=None):
+    """ Render a filtered micrograph and draw its picked coordinates over it,
+    rescaled to the thumbnail size. """
+    renderFiltered(fileName, repPath, LOW_PASS_CUTOFF, maxSize, tmpDir, env)
+    if len(coords):
+        drawCoordinates(repPath, micDims, coords)
+
+
+def drawCoordinates(imagePath, micDims, coords):
+    """ Stamp a disk on every coordinate (in micrograph pixels) of an image, all at once. """
+    image = np.array(ImagePIL.open(imagePath).convert('RGB'))
+    H_jpg, W_jpg = image.shape[:2]
+    W_mic, H_mic = micDims
+    centers = np.rint(np.asarray(coords, dtype=np.float32) * (W_jpg / W_mic, H_jpg / H_mic)).astype(int)
+
+    r = max(W_jpg / 256, 1)
+    ri = int(np.ceil(r))
+    dy, dx = np.mgrid[-ri:ri + 1, -ri:ri + 1]
+    disk = dx ** 2 + dy ** 2 <= r ** 2
+    xs = (centers[:, 0, None] + dx[disk][None, :]).ravel()
+    ys = (centers[:, 1, None] + dy[disk][None, :]).ravel()
+    inside = (xs >= 0) & (xs < W_jpg) & (ys >= 0) & (ys < H_jpg)
+    image[ys[inside], xs[inside]] = (0, 255, 0)
+    ImagePIL.fromarray(image).save(imagePath, quality=95)
+
+
+def renderSlices(fileName, repDir, text=None):
+    """ Write all slices in x, y and z directions of a volume as jpgs. """
+    pwutils.makePath(repDir)
+    if fileName.endswith('.mrc'):
+        fileName += ':mrc'
+    I = emlib.Image(fileName)
+    I.writeSlices(os.path.join(repDir, 'slicesX'), 'jpg', 'X')
+    I.writeSlices(os.path.join(repDir, 'slicesY'), 'jpg', 'Y')
+    I.writeSlices(os.path.join(repDir, 'slicesZ'), 'jpg', 'Z')
+    if text:
+        writeText(os.path.join(repDir, 'slicesX_0000.jpg'), text)
+
+
+def getSliceIndexes(size, numberOfSlices):
+    """ Evenly spaced slices (at the center of equal parts) along an axis of the given size. """
+    if not numberOfSlices or numberOfSlices >= size:
+        return list(range(size))
+    return [int((i + 0.5) * size / numberOfSlices) for i in range(numberOfSlices)]
+
+
+def makeMontage(images):
+    """ Tile 8 bit images of the same size in an almost square grid. """
+    h, w = images[0].shape
+    cols = int(np.ceil(np.sqrt(len(images))))
+    rows = int(np.ceil(len(images) / cols))
+    montage = np.zeros((rows * h, cols * w), dtype=np.uint8)
+    for i, image in enumerate(images):
+        r, c = divmod(i, cols)
+        montage[r * h:(r + 1) * h, c * w:(c + 1) * w] = image
+    return montage
+
+
+def shrinkArray(image, maxSize):
+    if maxSize and max(image.shape) > maxSize:
+        image = ImagePIL.fromarray(image, 'L')
+        image.thumbnail((maxSize, maxSize))
+        image = np.asarray(image)
+    return image
+
+
+def renderVolume(fileName, repDir, text=None, numberOfSlices=16, montage=False, projections=False, maxSize=None):
+    """ Write evenly spaced slices in x, y and z directions of a volume (all of them if
+    numberOfSlices is 0), as separate jpgs (slicesX_0000.jpg...) or a montage per axis
+    (montageX.jpg...). The volume is read only once, memory mapped, and all slices share
+    its gray scale. Optionally write the central slice and the maximum projection along
+    every axis (centralX.jpg, projectionX.jpg...). Every slice is at most maxSize. """
+    pwutils.makePath(repDir)
+    data = readVolume(fileName)
+    minV, maxV = float(data.min()), float(data.max())
+    written = []
+    for axis, name in ((2, 'X'), (1, 'Y'), (0, 'Z')):
+        indexes = getSliceIndexes(data.shape[axis], numberOfSlices)
+        slices = [shrinkArray(toUint8(np.take(data, i, axis=axis), minV, maxV), maxSize) for i in indexes]
+        if montage:
+            path = os.path.join(repDir, 'montage%s.jpg' % name)
+            ImagePIL.fromarray(makeMontage(slices), 'L').save(path, quality=95)
+            written.append(path)
+        else:
+            for n, image in enumerate(slices):
+                path = os.path.join(repDir, 'slices%s_%04d.jpg' % (name, n))
+                ImagePIL.fromarray(image, 'L').save(path, quality=95)
+                written.append(path)
+
+        if projections:
+            writeJpg(np.take(data, data.shape[axis] // 2, axis=axis),
+                     os.path.join(repDir, 'central%s.jpg' % name), maxSize=maxSize)
+            writeJpg(data.max(axis=axis), os.path.join(repDir, 'projection%s.jpg' % name), maxSize=maxSize)
+
+    if text:
+        writeText(written[0], text)
+
+
+# --------------- renderer -------------------------
+
+def render(func, source, target, params, kwargs, cache=None, cacheKey=None):
+    """ Run a render function, reusing the cached thumbnail if there is one.
+    Returns the seconds it took and whether the thumbnail was cached. """
+    start = time.time()
+    if cacheKey is not None and cache.restore(cacheKey, target):
+        return time.time() - start, True
+    func(source, target, *params, **kwargs)
+    if cacheKey is not None:
+        cache.store(cacheKey, target)
+    return time.time() - start, False
+
+
+class RenderTask:
+    """ A thumbnail requested for itemDict[key]. result is the future (or, without
+    workers, the outcome) of its render, shared by the duplicates of a render. """
+    def __init__(self, seq, itemDict, key, label, funcName, target, result, duplicate=False):
+        self.seq = seq
+        self.itemDict = itemDict
+        self.key = key
+        self.label = label
+        self.funcName = funcName
+        self.target = target
+        self.result = result
+        self.duplicate = duplicate
+
+    def isDone(self):
+        return not hasattr(self.result, 'done') or self.result.done()
+
+    def getResult(self):
+        """ Render seconds and whether it was cached, or the exception that made it fail. """
+        if not hasattr(self.result, 'result'):
+            return self.result
+        try:
+            return self.result.result()
+        except Exception as e:
+            return e
+
+
+class ThumbnailRenderer:
+    """
+    Collects the representation tasks of the deposition and runs them,
+    on a process pool when more than one worker is requested.
+    onDone(target) is called (in the calling thread) for every thumbnail produced.
+    Thumbnails of the same source and parameters are rendered only once, the
+    following requests reference the first target, also when it was registered
+    (e.g. restored from a previous deposition). If metrics are given, the
+    render times (by render function), cache hits and bytes rendered are added.
+    """
+    def __init__(self, workers=1, cache=None, onDone=None, metrics=None):
+        self._executor = None
+        if workers > 1:
+            # the export runs in threads, forking the protocol process could copy held locks
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                # the workers import this module and the main one (unless it is a __main__
+                # submodule), they are imported once by the server instead of by every worker
+                preload = [__name__]
+                main = getattr(sys.modules['__main__'].__spec__, 'name', None)
+                if main and not main.endswith('__main__'):
+                    preload.append(main)
+                context.set_forkserver_preload(preload)
+            else:
+                context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(workers, mp_context=context)
+        self._cache = cache
+        self._onDone = onDone
+        self._metrics = metrics
+        self._tasks = []
+        self._submitted = 0
+        self._index = {}  # render key: (target, result) of the first request
+        self._requests = []  # (render key, target) requested since the last pop
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def _addTask(self, *args, **kwargs):
+        task = RenderTask(self._submitted, *args, **kwargs)
+        self._tasks.append(task)
+        self._submitted += 1
+        return task
+
+    def submit(self, itemDict, key, label, func, source, target, *params, **kwargs):
+        """ Schedule func(source, target, *params, **kwargs) to produce itemDict[key].
+        Only source and params identify the thumbnail in the cache, kwargs are
+        just the execution context. If it fails, the key is removed from itemDict when waiting.
+        If the same thumbnail was already requested, itemDict[key] is set to its target. """
+        renderKey = getRenderKey(source, [func.__name__, params])
+        if renderKey in self._index:
+            firstTarget, firstResult = self._index[renderKey]
+            itemDict[key] = firstTarget
+            self._requests.append((renderKey, firstTarget))
+            self._addTask(itemDict, key, label, func.__name__, firstTarget, firstResult, duplicate=True)
+            return
+
+        cacheKey = None
+        if self._cache is not None:
+            cacheKey = self._cache.getKey([source], [func.__name__, params])
+        args = (func, source, target, params, kwargs, self._cache, cacheKey)
+        if self._executor is not None:
+            result = self._executor.submit(render, *args)
+        else:
+            try:
+                result = render(*args)
+            except Exception as e:
+                result = e
+        self._index[renderKey] = (target, result)
+        self._requests.append((renderKey, target))
+        self._addTask(itemDict, key, label, func.__name__, target, result)
+
+    def register(self, renderKey, target, done=True):
+        """ Make target, a thumbnail produced elsewhere, the first request of renderKey,
+        unless it was already requested. If it is not done, its requests will fail. """
+        result = (0., True) if done else Exception('it was not rendered by the previous deposition')
+        self._index.setdefault(renderKey, (target, result))
+
+    def popRequests(self):
+        """ Render keys and targets of the thumbnails requested since the last call. """
+        requests, self._requests = self._requests, []
+        return requests
+
+    def getSubmitted(self):
+        """ Number of tasks submitted so far. """
+        return self._submitted
+
+    def getFinished(self):
+        """ Number of tasks, in submission order, that are already processed:
+        all the tasks submitted before it are done. """
+        return self._tasks[0].seq if self._tasks else self._submitted
+
+    def _finish(self, task):
+        result = task.getResult()
+        if isinstance(result, Exception):
+            print('Cannot obtain item representation for %s: %s' % (task.label, result))
+            task.itemDict.pop(task.key, None)
+            if self._metrics is not None and not task.duplicate:
+                self._metrics.add('renderErrors')
+            return
+
+        if task.duplicate:
+            if self._metrics is not None:
+                self._metrics.add('sharedThumbnails')
+            return
+        if self._metrics is not None:
+            seconds, cached = result
+            self._metrics.addTime('render', task.funcName, seconds)
+            self._metrics.add('cachedThumbnails' if cached else 'renderedThumbnails')
+            self._metrics.add('thumbnailBytes', getSize(task.target))
+        if self._onDone is not None:
+            self._onDone(task.target)
+
+    def collect(self):
+        """ Process the tasks already finished, without waiting for the rest. """
+        pending = []
+        for task in self._tasks:
+            if task.isDone():
+                self._finish(task)
+            else:
+                pending.append(task)
+        self._tasks = pending
+
+    def wait(self):
+        """ Wait for all submitted tasks and drop the representations that failed. """
+        for task in self._tasks:
+            self._finish(task)
+        self._tasks = []
+        if self._cache is not None:
+            self._cache.prune()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
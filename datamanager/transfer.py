@@ -0,0 +1,322 @@
+# **************************************************************************
+# *
+# * Authors:     Irene Sanchez Lopez (isanchez@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+HTTP transfer utilities: pooled sessions, retries with backoff, progress
+reporting, streamed multipart uploads and resumable (tus) uploads.
+"""
+
+import os
+import json
+import time
+import base64
+import uuid
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+
+from datamanager.metrics import formatSize
+
+CHUNK_SIZE = 8 * 1024 * 1024
+TIMEOUT = (30, 600)  # connect and read timeouts (s)
+TUS_VERSION = '1.0.0'
+
+
+class TransferError(Exception):
+    pass
+
+
+class ServerBusy(TransferError):
+    """ The server refused the request before processing it (503 with Retry-After). """
+    def __init__(self, retryAfter):
+        TransferError.__init__(self, 'server busy, retry after %s s' % retryAfter)
+        self.retryAfter = int(retryAfter) if str(retryAfter).isdigit() else None
+
+
+def createSession(poolSize=10):
+    """ Session reusing connections, with up to poolSize connections per host. """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def isUnsent(error):
+    """ Whether a request failed before reaching the server application,
+    so that repeating it can not duplicate its effects. """
+    if isinstance(error, ServerBusy):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        # the connection could not be established (refused, unresolved or timed out)
+        reason = getattr(error.args[0], 'reason', error.args[0]) if error.args else None
+        return isinstance(reason, ConnectTimeoutError)
+    return False
+
+
+def retry(func, retries=5, backoff=2, label='request', idempotent=True):
+    """ Call func, retrying on connection errors, timeouts and TransferError
+    with exponential backoff (or the wait asked by the server). If the request
+    is not idempotent, only the failures that did not reach the server are retried. """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except (requests.ConnectionError, requests.Timeout, TransferError) as e:
+            if attempt == retries or not (idempotent or isUnsent(e)):
+                raise
+            wait = getattr(e, 'retryAfter', None) or backoff * 2 ** attempt
+            print('%s failed (%s), retrying in %d s' % (label, e, wait), flush=True)
+            time.sleep(wait)
+
+
+class Progress:
+    """ Prints the transferred bytes, throughput and ETA every interval seconds.
+    It can be updated from several threads. """
+    def __init__(self, total, label='Transferred', interval=5):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self._lastPrint = self.start
+        self._lock = threading.Lock()
+
+    def update(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+            now = time.time()
+            if now - self._lastPrint < self.interval:
+                return
+            self._lastPrint = now
+        self.report()
+
+    def getThroughput(self):
+        elapsed = time.time() - self.start
+        return self.done / elapsed if elapsed > 0 else 0
+
+    def report(self):
+        throughput = self.getThroughput()
+        line = '%s %s' % (self.label, formatSize(self.done))
+        if self.total:
+            line += ' of %s (%d%%)' % (formatSize(self.total), 100 * self.done / self.total)
+        line += ' at %s/s' % formatSize(throughput)
+        if self.total and throughput > 0:
+            line += ', ETA %d s' % ((self.total - self.done) / throughput)
+        print(line, flush=True)
+
+
+class BandwidthLimiter:
+    """ Token bucket shared by several threads to keep the total
+    throughput under bytesPerSecond (allowing bursts of one second). """
+    def __init__(self, bytesPerSecond):
+        self.rate = float(bytesPerSecond)
+        self._allowance = self.rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """ Wait until nbytes can be transferred. """
+        with self._lock:
+            now = time.time()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= nbytes
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class MultipartStream:
+    """ multipart/form-data body read from the files while it is sent,
+    so they are never loaded in memory. files is {field: (fileName, path)}. """
+    def __init__(self, files, progress=None, chunkSize=CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.progress = progress
+        self.chunkSize = chunkSize
+        self._parts = []
+        for field, (fileName, path) in files.items():
+            self._parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                                'Content-Type: application/octet-stream\r\n\r\n'
+                                % (self.boundary, field, fileName)).encode())
+            self._parts.append(path)
+            self._parts.append(b'\r\n')
+        self._parts.append(('--%s--\r\n' % self.boundary).encode())
+
+    @property
+    def contentType(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return sum(len(p) if isinstance(p, bytes) else os.path.getsize(p) for p in self._parts)
+
+    def __iter__(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            with open(part, 'rb') as f:
+                while True:
+                    chunk = f.read(self.chunkSize)
+                    if not chunk:
+                        break
+                    if self.progress is not None:
+                        self.progress.update(len(chunk))
+                    yield chunk
+
+
+def checkBusy(response):
+    if response.status_code == 503 and 'Retry-After' in response.headers:
+        raise ServerBusy(response.headers['Retry-After'])
+    return response
+
+
+def postForm(session, url, data, retries=5, label='Submission', **kwargs):
+    """ POST form data that creates something in the server, so it is only
+    retried when the request did not reach it (see isUnsent). """
+    return retry(lambda: checkBusy(session.post(url, data=data, timeout=TIMEOUT, **kwargs)),
+                 retries, label=label, idempotent=False)
+
+
+def postMultipart(session, url, files, retries=5, label='Upload', **kwargs):
+    """ POST files ({field: (fileName, path)}) as a streamed multipart body.
+    As with postForm, the whole request is only retried when it did not reach the server,
+    other server errors are returned as the response. """
+    def post():
+        progress = Progress(sum(os.path.getsize(p) for _, p in files.values()), label)
+        body = MultipartStream(files, progress)
+        response = checkBusy(session.post(url, data=body, headers={'Content-Type': body.contentType},
+                                          timeout=TIMEOUT, **kwargs))
+        progress.report()
+        return response
+
+    return retry(post, retries, label=label, idempotent=False)
+
+
+# --------------- resumable uploads (tus protocol) -------------------------
+
+def supportsTus(session, endpoint, **kwargs):
+    """ Check if endpoint accepts resumable uploads (https://tus.io/protocols/resumable-upload). """
+    try:
+        response = session.options(endpoint, timeout=TIMEOUT, **kwargs)
+    except requests.RequestException:
+        return False
+    return response.status_code in (200, 204) and 'Tus-Version' in response.headers
+
+
+class TusUpload:
+    """ Upload a file in chunks with the tus protocol, resuming from the
+    offset stored in the server after any failure. """
+    def __init__(self, session, endpoint, path, uploadUrl=None, retries=5,
+                 chunkSize=CHUNK_SIZE, **kwargs):
+        self.session = session
+        self.endpoint = endpoint
+        self.path = path
+        self.uploadUrl = uploadUrl
+        self.retries = retries
+        self.chunkSize = chunkSize
+        self.kwargs = kwargs
+        self.size = os.path.getsize(path)
+
+    def _headers(self, **headers):
+        headers['Tus-Resumable'] = TUS_VERSION
+        return headers
+
+    def create(self):
+        metadata = 'filename %s' % base64.b64encode(os.path.basename(self.path).encode()).decode()
+        response = self.session.post(self.endpoint, timeout=TIMEOUT, **self.kwargs,
+                                     headers=self._headers(**{'Upload-Length': str(self.size),
+                                                              'Upload-Metadata': metadata}))
+        if response.status_code != 201:
+            raise TransferError('cannot create upload: %d %s' % (response.status_code, response.text))
+        self.uploadUrl = requests.compat.urljoin(self.endpoint, response.headers['Location'])
+
+    def getOffset(self):
+        """ Bytes already received by the server, None if the upload is unknown. """
+        response = self.session.head(self.uploadUrl, timeout=TIMEOUT, **self.kwargs, headers=self._headers())
+        if response.status_code in (404, 410):
+            return None
+        if response.status_code >= 400:
+            raise TransferError('cannot get upload offset: %d' % response.status_code)
+        return int(response.headers['Upload-Offset'])
+
+    def _sendChunk(self, progress):
+        offset = self.getOffset() if self.uploadUrl else None
+        if offset is None:
+            self.create()
+            offset = 0
+        if offset >= self.size:
+            return offset
+        progress.done = max(progress.done, offset)
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read(self.chunkSize)
+        response = self.session.patch(self.uploadUrl, data=chunk, timeout=TIMEOUT, **self.kwargs,
+                                      headers=self._headers(**{'Upload-Offset': str(offset),
+                                                               'Content-Type': 'application/offset+octet-stream'}))
+        if response.status_code != 204:
+            raise TransferError('chunk at offset %d not accepted: %d' % (offset, response.status_code))
+        progress.update(len(chunk))
+        return int(response.headers.get('Upload-Offset', offset + len(chunk)))
+
+    def upload(self, label='Upload'):
+        """ Upload the remaining chunks and return the upload url. """
+        progress = Progress(self.size, '%s %s' % (label, os.path.basename(self.path)))
+        offset = -1
+        while offset < self.size:
+            offset = retry(lambda: self._sendChunk(progress), self.retries, label=label)
+        progress.report()
+        return self.uploadUrl
+
+
+def uploadResumable(session, endpoint, paths, statePath, retries=5, **kwargs):
+    """ Upload several files with tus, remembering their upload urls in statePath
+    so that a new attempt (e.g. continuing the protocol) resumes them, unless
+    the file changed (its size or modification time). """
+    state = {}
+    if os.path.exists(statePath):
+        with open(statePath) as f:
+            state = json.load(f)
+    def saveState():
+        with open(statePath, 'w') as f:
+            json.dump(state, f)
+
+    urls = {}
+    for key, path in paths.items():
+        st = os.stat(path)
+        version = [st.st_size, st.st_mtime_ns]
+        saved = state.get(key)
+        uploadUrl = saved[0] if saved and saved[1:] == version else None
+        upload = TusUpload(session, endpoint, path, uploadUrl, retries, **kwargs)
+        if upload.uploadUrl is None:
+            retry(upload.create, retries, label='Upload creation')
+            state[key] = [upload.uploadUrl] + version
+            saveState()
+        urls[key] = upload.upload()
+        state[key] = [urls[key]] + version
+        saveState()
+    return urls